@@ -2,7 +2,9 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from flask import Flask
+from flask import Flask, jsonify, Response
+from database_manager import get_pool_stats
+from src.shared import metrics
 from routes.auth_routes import auth_bp
 from routes.pipeline_routes import pipeline_bp
 from routes.map_routes import map_bp
@@ -17,4 +19,14 @@ app.register_blueprint(map_bp)
 
 @app.route('/')
 def home():
-    return 'Hello, World!'
\ No newline at end of file
+    return 'Hello, World!'
+
+@app.route('/stats/db-pool')
+def db_pool_stats():
+    return jsonify(get_pool_stats()), 200
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # As estatísticas do pool são lidas no momento da coleta
+    metrics.set_gauges("cpted_db_pool", get_pool_stats(), "Estatística do pool de conexões do banco.")
+    return Response(metrics.render_prometheus(), content_type=metrics.CONTENT_TYPE)
@@ -1,13 +1,59 @@
-from flask import Blueprint, jsonify
-from src.map.map import gerar_mapa_de_marcadores_html
+from flask import Blueprint, Response, jsonify, make_response, request, stream_with_context
+from src.map.map import gerar_mapa_de_marcadores_html, obter_versao_mapa, etag_do_mapa
+from src.map.features import gerar_geojson_features, parse_bbox, validar_janela
 
 map_bp = Blueprint('map', __name__)
 
 @map_bp.route('/generate_map', methods=['GET'])
 def generate_map():
+    # A ETag muda só quando surgem novas análises: navegadores e proxies
+    # revalidam com If-None-Match e recebem 304 se o mapa não mudou.
+    versao = obter_versao_mapa()
+    etag = etag_do_mapa(versao) if versao else None
+    if etag and request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag, weak=True)
+        return response
+
     map_html = gerar_mapa_de_marcadores_html()
 
     if not map_html:
         return jsonify({"error": "Nenhum dado encontrado para gerar o mapa"}), 404
 
-    return map_html, 200
\ No newline at end of file
+    response = make_response(map_html, 200)
+    if etag:
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@map_bp.route('/map/features', methods=['GET'])
+def map_features():
+    """
+    Retorna, em GeoJSON, só as análises dentro da janela visível do mapa.
+
+    Query params:
+        bbox: minLon,minLat,maxLon,maxLat (obrigatório).
+        zoom: Nível de zoom do cliente (inteiro de 0 a 22, opcional). Abaixo
+            de MAP_CLUSTER_MAX_ZOOM a resposta traz grupos em vez de pontos,
+            e janelas com mais de MAP_FEATURES_MAX células são recusadas.
+    """
+    try:
+        bbox = parse_bbox(request.args.get('bbox'))
+        zoom = int(request.args['zoom']) if request.args.get('zoom') else None
+    except ValueError as e:
+        return jsonify({"error": f"Parâmetros inválidos: {e}"}), 400
+    if zoom is not None and not 0 <= zoom <= 22:
+        return jsonify({"error": "zoom deve estar entre 0 e 22"}), 400
+    try:
+        validar_janela(bbox, zoom)
+    except ValueError as e:
+        return jsonify({"error": f"Parâmetros inválidos: {e}"}), 400
+
+    partes = gerar_geojson_features(bbox, zoom)
+    if partes is None:
+        return jsonify({"error": "Falha ao consultar as análises do mapa"}), 500
+
+    return Response(
+        stream_with_context(partes),
+        mimetype='application/geo+json'
+    )
@@ -1,25 +1,164 @@
-from flask import Blueprint, request, jsonify
+import json
+from flask import Blueprint, Response, request, jsonify, url_for, stream_with_context
 from database_manager import (
-    add_capture, add_pipeline_output, get_full_analysis_by_url,
-    get_all_captures_by_user
+    submit_capture, get_full_analysis_by_url, get_all_captures_by_user,
+    get_pipeline_job, get_pipeline_output_by_capture_id, claim_pipeline_job
 )
-from pipeline import run_full_pipeline
+from src.jobs.worker import enqueue_job, process_job_stream
+from src import config
 
 pipeline_bp = Blueprint('pipeline', __name__)
 
-@pipeline_bp.route('/send-photo', methods=['POST'])
-def send_photo():
+def _registrar_envio():
+    """
+    (Função auxiliar) Valida o corpo e o Idempotency-Key de um envio de foto
+    e registra a captura e o job. Retorna (submissao, None) ou (None, resposta de erro).
+    """
     data = request.get_json()
     required = ['user_app_id', 'image_url', 'timestamp', 'lat', 'long']
     
     if not all(data.get(field) for field in required):
-        return jsonify({"error": "Todos os campos são obrigatórios"}), 400
+        return None, (jsonify({"error": "Todos os campos são obrigatórios"}), 400)
 
-    capture_id = add_capture(data['user_app_id'], data['image_url'], data['timestamp'], data['lat'], data['long'])
-    result = run_full_pipeline(data['image_url'])
-    add_pipeline_output(capture_id, result)
+    # Reenvios com a mesma chave (ou a mesma URL) não rodam o pipeline de novo
+    idempotency_key = request.headers.get('Idempotency-Key') or None
+    if idempotency_key and len(idempotency_key) > 255:
+        return None, (jsonify({"error": "Idempotency-Key deve ter no máximo 255 caracteres"}), 400)
 
-    return jsonify(result), 200
+    # Opcional: "two_stage" ou "fused" (sem ele, o worker usa PIPELINE_MODE)
+    pipeline_mode = data.get('pipeline_mode') or None
+    if pipeline_mode is not None and pipeline_mode not in config.PIPELINE_MODES:
+        return None, (jsonify({"error": f"pipeline_mode deve ser um de: {', '.join(config.PIPELINE_MODES)}"}), 400)
+
+    submissao = submit_capture(
+        data['user_app_id'], data['image_url'], data['timestamp'], data['lat'], data['long'],
+        idempotency_key=idempotency_key, pipeline_mode=pipeline_mode
+    )
+    if submissao is None:
+        return None, (jsonify({"error": "Não foi possível registrar a captura"}), 500)
+    if submissao['status'] == 'conflict':
+        return None, (jsonify({"error": "Esta URL já foi enviada por outro usuário"}), 409)
+    return submissao, None
+
+def _resposta_da_submissao(submissao, user_app_id):
+    """(Função auxiliar) Corpo e headers comuns às respostas de envio de foto."""
+    resposta = {
+        "job_id": submissao['job_id'],
+        "capture_id": submissao['capture_id'],
+        "status": submissao['status'],
+    }
+    headers = {}
+    if submissao['job_id'] is not None:
+        resposta["status_url"] = url_for('pipeline.job_status', job_id=submissao['job_id'],
+                                         user_app_id=user_app_id)
+        headers["Location"] = resposta["status_url"]
+    if not submissao['created']:
+        headers["Idempotent-Replayed"] = "true"
+    return resposta, headers
+
+@pipeline_bp.route('/send-photo', methods=['POST'])
+def send_photo():
+    submissao, erro = _registrar_envio()
+    if erro:
+        return erro
+
+    resposta, headers = _resposta_da_submissao(submissao, request.get_json()['user_app_id'])
+    if submissao['created']:
+        # O pipeline roda fora da requisição: a resposta sai assim que o job é enfileirado
+        enqueue_job(submissao['job_id'])
+        return jsonify(resposta), 202, headers
+
+    if submissao['status'] == 'done':
+        resposta["result"] = get_pipeline_output_by_capture_id(submissao['capture_id'])
+        return jsonify(resposta), 200, headers
+    if submissao['status'] == 'failed':
+        return jsonify(resposta), 200, headers
+    return jsonify(resposta), 202, headers
+
+def _evento_sse(evento: str, dados) -> str:
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False, default=str)}\n\n"
+
+@pipeline_bp.route('/send-photo/stream', methods=['POST'])
+def send_photo_stream():
+    """
+    Variante de /send-photo que processa a foto na própria requisição e
+    transmite o progresso como Server-Sent Events (text/event-stream):
+
+    - capture: captura e job registrados (mesmo corpo da resposta de /send-photo).
+    - description.delta: trecho da descrição, à medida que o modelo o gera.
+    - description: descrição completa (não há eventos de descrição no modo "fused").
+    - analysis: dados estruturados validados.
+    - output: análise gravada no banco (`result` igual ao de /jobs/<id>).
+    - queued: o job ficou com um worker; acompanhe por `status_url`.
+    - error: falha em uma etapa (`stage` e `message`).
+    - done: último evento, com o `status` final do job.
+
+    O cliente pode desconectar a qualquer momento (ex: só precisava do
+    capture_id): o job volta para a fila e é concluído por um worker.
+    """
+    submissao, erro = _registrar_envio()
+    if erro:
+        return erro
+    resposta, headers = _resposta_da_submissao(submissao, request.get_json()['user_app_id'])
+    headers.pop("Location", None)
+    headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def eventos():
+        yield _evento_sse("capture", resposta)
+
+        if not submissao['created']:
+            if submissao['status'] == 'done':
+                yield _evento_sse("output", {
+                    "capture_id": submissao['capture_id'],
+                    "result": get_pipeline_output_by_capture_id(submissao['capture_id']),
+                })
+            yield _evento_sse("done", {"status": submissao['status']})
+            return
+
+        job = claim_pipeline_job(
+            submissao['job_id'],
+            stale_after_s=config.JOB_STALE_AFTER_S,
+            max_attempts=config.JOB_MAX_ATTEMPTS,
+        )
+        if not job:
+            # Um worker externo pegou o job antes desta requisição
+            enqueue_job(submissao['job_id'])
+            yield _evento_sse("queued", {"job_id": submissao['job_id'], "status_url": resposta["status_url"]})
+            yield _evento_sse("done", {"status": "queued"})
+            return
+
+        status = "failed"
+        for evento, dados in process_job_stream(job):
+            if evento == "output":
+                status = "done"
+            yield _evento_sse(evento, dados)
+        if status != "done":
+            # A falha pode ter devolvido o job à fila para uma nova tentativa
+            atual = get_pipeline_job(submissao['job_id'])
+            status = atual['status'] if atual else status
+        yield _evento_sse("done", {"status": status})
+
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream', headers=headers)
+
+@pipeline_bp.route('/jobs/<int:job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Estado de um job. Query param `user_app_id` (obrigatório): só o dono da
+    captura enxerga o job; para os demais ele não existe (404).
+    """
+    try:
+        user_app_id = int(request.args.get('user_app_id', ''))
+    except ValueError:
+        return jsonify({"error": "ID do usuário é obrigatório e deve ser um número inteiro"}), 400
+
+    job = get_pipeline_job(job_id)
+    if not job or job.pop('user_app_id') != user_app_id:
+        return jsonify({"error": "Job não encontrado"}), 404
+
+    if job['status'] == 'done':
+        job['result'] = get_pipeline_output_by_capture_id(job['capture_id'])
+
+    return jsonify(job), 200
 
 @pipeline_bp.route('/get-analysis', methods=['GET'])
 def get_analysis():
@@ -35,17 +174,47 @@ def get_analysis():
 
 @pipeline_bp.route('/user_photos', methods=['GET'])
 def user_photos():
+    """
+    Lista as capturas de um usuário, paginadas por cursor.
+
+    Query params:
+        user_app_id: ID do usuário (obrigatório).
+        after: ID da última captura já recebida (cursor); o header
+            `X-Next-After` da resposta traz o cursor da próxima página.
+        limit: Tamanho da página (padrão e máximo definidos em src/config.py).
+        fields: Lista separada por vírgulas com os campos desejados
+            (ex: `capture_id,capture_url,indice_cpted_geral`).
+    """
     user_app_id = request.args.get('user_app_id')
 
     if not user_app_id:
         return jsonify({"error": "ID do usuário é obrigatório"}), 400
 
     try:
-        photos = get_all_captures_by_user(int(user_app_id))
+        user_app_id = int(user_app_id)
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', config.USER_PHOTOS_DEFAULT_LIMIT))
     except ValueError:
-        return jsonify({"error": "ID do usuário inválido"}), 400
+        return jsonify({"error": "ID do usuário, after e limit devem ser números inteiros"}), 400
+
+    if limit < 1:
+        return jsonify({"error": "limit deve ser maior que zero"}), 400
+    limit = min(limit, config.USER_PHOTOS_MAX_LIMIT)
+
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or None
 
-    if not photos:
+    try:
+        # Busca um item a mais para saber se existe uma próxima página
+        photos = get_all_captures_by_user(user_app_id, after=after, limit=limit + 1, fields=fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not photos and not after:
         return jsonify({"error": "Nenhuma foto encontrada para este usuário"}), 404
 
-    return jsonify(photos), 200
+    headers = {}
+    if len(photos) > limit:
+        photos = photos[:limit]
+        headers["X-Next-After"] = str(photos[-1]['capture_id'])
+
+    return jsonify(photos), 200, headers
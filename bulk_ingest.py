@@ -0,0 +1,158 @@
+import os
+import csv
+import json
+import argparse
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Any, List, Iterator, Tuple
+
+import database_manager as db
+from src.shared.parsing import desachatar_analise_cpted, COLUNAS_ANALISE_ACHATADA
+
+# Chaves aceitas para a URL da imagem (a saída de run_pipeline_batch usa "image_url")
+CHAVES_URL = ("url", "image_url", "capture_url")
+# Chaves aceitas para a análise aninhada (formato de AnaliseCptedDoLocal)
+CHAVES_ANALISE = ("analise", "result")
+
+
+def ler_linhas(caminho: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lê um arquivo CSV (ex: os relatórios de tests/run_info_extraction.py) ou
+    JSONL. Uma linha de JSON inválido é devolvida como a exceção do parser.
+    """
+    if caminho.lower().endswith(".csv"):
+        # utf-8-sig: os relatórios são salvos com BOM
+        with open(caminho, newline="", encoding="utf-8-sig") as arquivo:
+            yield from csv.DictReader(arquivo)
+    else:
+        with open(caminho, encoding="utf-8") as arquivo:
+            for linha in arquivo:
+                if linha.strip():
+                    try:
+                        yield json.loads(linha)
+                    except json.JSONDecodeError as e:
+                        yield e
+
+
+def _numero(valor, nome: str) -> Any:
+    if valor in (None, ""):
+        return None
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"{nome} inválido: {valor!r}")
+
+
+def preparar_linha(linha: Dict[str, Any], numero: int, origem: str, user_app_id: int) -> Tuple[Dict[str, Any], Any]:
+    """
+    Separa uma linha de entrada em (captura, análise).
+
+    A análise pode vir aninhada em "analise"/"result", no próprio objeto
+    (JSONL no formato de AnaliseCptedDoLocal) ou nas colunas achatadas (CSV).
+    Linhas sem URL recebem uma URL sintética estável ("import://arquivo/linha"),
+    para que reimportar o mesmo arquivo seja reconhecido como duplicata.
+    Lança ValueError se a linha não for um objeto ou tiver valores malformados.
+    """
+    if isinstance(linha, Exception):
+        raise ValueError(f"JSON inválido: {linha}")
+    if not isinstance(linha, dict):
+        raise ValueError("A linha não é um objeto JSON.")
+    try:
+        dono = int(linha.get("user_app_id") or user_app_id)
+    except (TypeError, ValueError):
+        raise ValueError(f"user_app_id inválido: {linha.get('user_app_id')!r}")
+    url = next((linha[chave] for chave in CHAVES_URL if linha.get(chave)), None)
+    captura = {
+        "user_app_id": dono,
+        "url": url or f"import://{origem}/{numero}",
+        "date": linha.get("date") or datetime.now(),
+        "lat": _numero(linha.get("lat"), "lat"),
+        "long": _numero(linha.get("long"), "long"),
+    }
+
+    analise = next((linha[chave] for chave in CHAVES_ANALISE if isinstance(linha.get(chave), dict)), None)
+    if analise is None and "vigilancia" in linha:
+        analise = linha
+    if analise is None and any(linha.get(coluna) for coluna in COLUNAS_ANALISE_ACHATADA):
+        try:
+            analise = desachatar_analise_cpted(linha)
+        except Exception as e:
+            analise = e
+    return captura, analise
+
+
+def ingerir_arquivo(caminho: str, user_app_id: int, tamanho_lote: int = db.BULK_CHUNK_SIZE) -> Counter:
+    """
+    Ingere capturas e análises de um arquivo em lotes, reportando o que
+    falhou linha a linha.
+
+    Retorna:
+        Um Counter com o total de cada status (capturas e análises).
+    """
+    origem = os.path.basename(caminho)
+    totais: Counter = Counter()
+    lote: List[Tuple[int, Dict[str, Any], Any]] = []
+
+    def processar_lote():
+        relatorio_capturas = db.add_captures_bulk([captura for _, captura, _ in lote])
+        resultados = []
+        numeros = []
+        for (numero, _, analise), rel in zip(lote, relatorio_capturas):
+            totais[f"capture_{rel['status']}"] += 1
+            if rel["status"] not in ("inserted", "duplicate"):
+                print(f"Linha {numero}: captura não importada ({rel['status']}): {rel['error']}")
+                continue
+            if isinstance(analise, Exception):
+                totais["output_invalid"] += 1
+                print(f"Linha {numero}: análise inválida: {analise}")
+            elif analise is not None and rel["capture_id"] is not None:
+                resultados.append((rel["capture_id"], analise))
+                numeros.append(numero)
+        for numero, rel in zip(numeros, db.add_pipeline_outputs_bulk(resultados)):
+            totais[f"output_{rel['status']}"] += 1
+            if rel["status"] not in ("inserted", "duplicate"):
+                print(f"Linha {numero}: análise não importada ({rel['status']}): {rel['error']}")
+        lote.clear()
+
+    # Linha 1 é o cabeçalho no CSV; no JSONL a numeração começa em 1
+    primeira = 2 if caminho.lower().endswith(".csv") else 1
+    for numero, linha in enumerate(ler_linhas(caminho), primeira):
+        try:
+            captura, analise = preparar_linha(linha, numero, origem, user_app_id)
+        except ValueError as e:
+            totais["capture_invalid"] += 1
+            print(f"Linha {numero}: linha ignorada: {e}")
+            continue
+        lote.append((numero, captura, analise))
+        if len(lote) >= tamanho_lote:
+            processar_lote()
+    if lote:
+        processar_lote()
+
+    # Soma as análises novas aos agregados do dashboard de uma vez só
+    if totais["output_inserted"]:
+        db.refresh_cpted_summary()
+    return totais
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa capturas e análises CPTED em lote (CSV ou JSONL).")
+    parser.add_argument("arquivo", help="Arquivo .csv (colunas achatadas) ou .jsonl")
+    parser.add_argument("--user-app-id", type=int, required=True,
+                        help="Usuário dono das capturas quando a linha não informa user_app_id")
+    parser.add_argument("--batch-size", type=int, default=db.BULK_CHUNK_SIZE,
+                        help="Linhas por lote")
+    args = parser.parse_args()
+
+    inicio = datetime.now()
+    totais = ingerir_arquivo(args.arquivo, args.user_app_id, args.batch_size)
+    duracao = (datetime.now() - inicio).total_seconds()
+
+    print("\n--- RESUMO DA IMPORTAÇÃO ---")
+    for status, total in sorted(totais.items()):
+        print(f"{status}: {total}")
+    print(f"Tempo total: {duracao:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,17 @@ import os
 import psycopg2
 import psycopg2.extras # Essencial para retornar dicionários
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional, List
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterator
 from datetime import datetime
-from src.shared.parsing import achatar_analise_cpted
-from src.info_extraction.schemas import AnaliseCptedDoLocal
+from src import config
+from src.shared import metrics
+from src.shared.metrics import instrumented
+from src.shared.db_pool import ConnectionPool, PreparingConnection, execute_prepared, get_shared_pool
+from src.shared.parsing import (
+    achatar_analise_cpted, extrair_fatores_cpted, validar_analise_cpted,
+    COLUNAS_ANALISE_ACHATADA, COLUNAS_FATORES_CPTED,
+)
 from werkzeug.security import check_password_hash
 
 # Carrega as variáveis de ambiente do arquivo .env do repositório da API
@@ -15,7 +22,8 @@ def get_db_connection():
     """
     Cria e retorna uma nova conexão com o banco de dados.
     Lança uma exceção se a conexão falhar.
-    Nota: Para aplicações de alta performance, considere usar um "connection pool".
+    Nota: As funções deste módulo usam o pool compartilhado (`db_connection`);
+    esta função é a fábrica de conexões do pool.
     """
     try:
         conn = psycopg2.connect(
@@ -23,13 +31,207 @@ def get_db_connection():
             user=os.getenv("DB_USER"),
             password=os.getenv("DB_PASS"),
             host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT")
+            port=os.getenv("DB_PORT"),
+            # Guarda os comandos já preparados no servidor (ver execute_prepared)
+            connection_factory=PreparingConnection
         )
         return conn
     except psycopg2.OperationalError as e:
         print(f"ERRO CRÍTICO: Não foi possível conectar ao banco de dados. {e}")
         raise
 
+_DB_CHECKOUT_SECONDS = metrics.histogram(
+    "cpted_db_checkout_seconds", "Tempo para retirar uma conexão do pool, em segundos."
+)
+_DB_CHECKOUT_ERRORS = metrics.counter(
+    "cpted_db_checkout_errors_total", "Retiradas de conexão do pool que falharam (timeout ou banco fora do ar)."
+)
+
+def _observar_retirada(duracao_s: float, erro: bool) -> None:
+    if erro:
+        _DB_CHECKOUT_ERRORS.inc()
+    else:
+        _DB_CHECKOUT_SECONDS.observe(duracao_s)
+
+def _create_pool() -> ConnectionPool:
+    return ConnectionPool(
+        get_db_connection,
+        min_size=config.DB_POOL_MIN_SIZE,
+        max_size=config.DB_POOL_MAX_SIZE,
+        idle_timeout=config.DB_POOL_IDLE_TIMEOUT_S,
+        checkout_timeout=config.DB_POOL_CHECKOUT_TIMEOUT_S,
+        health_check_interval=config.DB_POOL_HEALTH_CHECK_INTERVAL_S,
+        on_checkout=_observar_retirada,
+    )
+
+def get_pool() -> ConnectionPool:
+    """Retorna o pool de conexões compartilhado pelo processo."""
+    return get_shared_pool(_create_pool)
+
+@contextmanager
+def db_connection():
+    """
+    Retira uma conexão do pool compartilhado e a devolve ao sair do bloco.
+    Se o bloco lançar uma exceção, a transação é revertida automaticamente.
+
+    Uso:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                ...
+    """
+    with get_pool().connection() as conn:
+        yield conn
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Retorna as estatísticas do pool de conexões (tamanho, em uso, esperas, etc.)."""
+    return get_pool().stats()
+
+# ==============================================================================
+# ESQUEMA AUXILIAR
+# ==============================================================================
+
+# Tabelas e índices criados por este módulo (além de user_app, user_platform,
+# capture e pipeline_output). Todos os comandos são idempotentes.
+_SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS pipeline_job (
+        id SERIAL PRIMARY KEY,
+        capture_id INTEGER NOT NULL REFERENCES capture(id) ON DELETE CASCADE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        pipeline_output_id INTEGER REFERENCES pipeline_output(id) ON DELETE SET NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pipeline_job_capture_id ON pipeline_job (capture_id);",
+    "CREATE INDEX IF NOT EXISTS idx_pipeline_job_status ON pipeline_job (status, id) WHERE status IN ('queued', 'running');",
+    # Chave enviada pelo cliente (header Idempotency-Key) para reenvios seguros
+    # A chave vale por usuário: a mesma chave de outro usuário não devolve o job dele
+    "ALTER TABLE pipeline_job ADD COLUMN IF NOT EXISTS idempotency_key TEXT;",
+    "ALTER TABLE pipeline_job ADD COLUMN IF NOT EXISTS user_app_id INTEGER REFERENCES user_app(id) ON DELETE CASCADE;",
+    """
+    UPDATE pipeline_job j SET user_app_id = c.user_app_id
+    FROM capture c
+    WHERE c.id = j.capture_id AND j.idempotency_key IS NOT NULL AND j.user_app_id IS NULL;
+    """,
+    "DROP INDEX IF EXISTS idx_pipeline_job_idempotency_key;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_pipeline_job_user_idempotency_key ON pipeline_job (user_app_id, idempotency_key) WHERE idempotency_key IS NOT NULL;",
+    # Modo do pipeline escolhido no envio (NULL = PIPELINE_MODE da configuração)
+    "ALTER TABLE pipeline_job ADD COLUMN IF NOT EXISTS pipeline_mode TEXT;",
+    # Jobs que falharam voltam à fila, mas só podem ser reivindicados a partir daqui
+    "ALTER TABLE pipeline_job ADD COLUMN IF NOT EXISTS available_at TIMESTAMP;",
+    """
+    CREATE TABLE IF NOT EXISTS capture_phash (
+        capture_id INTEGER PRIMARY KEY REFERENCES capture(id) ON DELETE CASCADE,
+        phash BIGINT NOT NULL,
+        duplicate_of INTEGER REFERENCES capture(id) ON DELETE SET NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_capture_phash_created_at ON capture_phash (created_at);",
+    # Paginação por cursor de /user_photos
+    "CREATE INDEX IF NOT EXISTS idx_capture_user_app_id_id ON capture (user_app_id, id);",
+    # Consultas por janela do mapa (/map/features); a expressão precisa ser
+    # idêntica à usada em iter_analyses_in_bbox para o índice ser usado.
+    'CREATE INDEX IF NOT EXISTS idx_capture_geo ON capture USING gist (point("long", lat));',
+    # Vocabulário normalizado dos fatores das colunas de lista (ver COLUNAS_FATORES_CPTED)
+    """
+    CREATE TABLE IF NOT EXISTS cpted_factor (
+        id SERIAL PRIMARY KEY,
+        field TEXT NOT NULL,
+        key TEXT NOT NULL,
+        label TEXT NOT NULL,
+        UNIQUE (field, key)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pipeline_output_factor (
+        pipeline_output_id INTEGER NOT NULL REFERENCES pipeline_output(id) ON DELETE CASCADE,
+        factor_id INTEGER NOT NULL REFERENCES cpted_factor(id),
+        PRIMARY KEY (pipeline_output_id, factor_id)
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pipeline_output_factor_factor ON pipeline_output_factor (factor_id, pipeline_output_id);",
+    "CREATE INDEX IF NOT EXISTS idx_pipeline_output_data_processamento ON pipeline_output (data_processamento);",
+    # Agregados do dashboard CPTED (ver refresh_cpted_summary)
+    """
+    CREATE TABLE IF NOT EXISTS cpted_summary (
+        indice_cpted_geral TEXT NOT NULL,
+        vigilancia_iluminacao TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        value TEXT NOT NULL,
+        total BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (indice_cpted_geral, vigilancia_iluminacao, dimension, value)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cpted_summary_state (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        refreshed_at TIMESTAMP
+    );
+    """,
+    "INSERT INTO cpted_summary_state (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;",
+    # Análises já somadas em cpted_summary. Os workers gravam em paralelo e os
+    # commits podem sair fora da ordem dos IDs, então não basta guardar o maior ID.
+    """
+    CREATE TABLE IF NOT EXISTS cpted_summary_output (
+        pipeline_output_id INTEGER PRIMARY KEY REFERENCES pipeline_output(id) ON DELETE CASCADE
+    );
+    """,
+    # Migração da versão que guardava só o último ID agregado
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_name = 'cpted_summary_state' AND column_name = 'last_output_id') THEN
+            INSERT INTO cpted_summary_output (pipeline_output_id)
+            SELECT po.id FROM pipeline_output po
+            WHERE po.id <= (SELECT last_output_id FROM cpted_summary_state WHERE id)
+            ON CONFLICT DO NOTHING;
+            ALTER TABLE cpted_summary_state DROP COLUMN last_output_id;
+        END IF;
+    END $$;
+    """,
+    # Grupos do mapa pré-agregados por zoom e célula da grade, somados junto
+    # com cpted_summary (ver refresh_cpted_summary e get_analysis_clusters_in_bbox)
+    """
+    CREATE TABLE IF NOT EXISTS map_cluster (
+        zoom SMALLINT NOT NULL,
+        cell_x INTEGER NOT NULL,
+        cell_y INTEGER NOT NULL,
+        indice_cpted_geral TEXT NOT NULL,
+        total BIGINT NOT NULL DEFAULT 0,
+        soma_lat DOUBLE PRECISION NOT NULL DEFAULT 0,
+        soma_lon DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (zoom, cell_x, cell_y, indice_cpted_geral)
+    );
+    """,
+    # Grade usada na última agregação; se a configuração mudar, tudo é recalculado
+    "ALTER TABLE cpted_summary_state ADD COLUMN IF NOT EXISTS map_cell_px INTEGER;",
+    "ALTER TABLE cpted_summary_state ADD COLUMN IF NOT EXISTS map_max_zoom INTEGER;",
+]
+
+def init_db_schema() -> bool:
+    """
+    Cria as tabelas e índices auxiliares usados pela API (fila de jobs, etc.).
+    Pode ser executada quantas vezes for necessário: `python database_manager.py`.
+
+    Retorna:
+        True se o esquema foi aplicado com sucesso, False caso contrário.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                for statement in _SCHEMA_STATEMENTS:
+                    cur.execute(statement)
+            conn.commit()
+            return True
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao aplicar o esquema auxiliar: {error}")
+        return False
+
 def add_user_app(name: str, email: str, cpf: str, hashed_password: str) -> Optional[int]:
     """
     Adiciona um novo usuário do aplicativo (quem tira a foto) ao banco de dados.
@@ -44,25 +246,20 @@ def add_user_app(name: str, email: str, cpf: str, hashed_password: str) -> Optio
         O ID do novo usuário ou None em caso de erro.
     """
     sql = "INSERT INTO user_app (name, email, cpf, password) VALUES (%s, %s, %s, %s) RETURNING id;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(sql, (name, email, cpf, hashed_password))
-            user_id = cur.fetchone()[0]
-            conn.commit()
-            return user_id
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (name, email, cpf, hashed_password))
+                user_id = cur.fetchone()[0]
+                conn.commit()
+                return user_id
     except psycopg2.errors.UniqueViolation:
         print(f"Erro: O email '{email}' ou CPF '{cpf}' já está cadastrado.")
         return None
     except (Exception, psycopg2.Error) as error:
+        # A transação já foi revertida pelo db_connection()
         print(f"Erro ao adicionar usuário: {error}")
-        if conn:
-            conn.rollback()
         return None
-    finally:
-        if conn:
-            conn.close()
 
 def add_user_platform(name: str, email: str, cpf: str, hashed_password: str) -> Optional[int]:
     """
@@ -85,41 +282,32 @@ def add_user_platform(name: str, email: str, cpf: str, hashed_password: str) ->
     # O SQL para inserir um novo usuário na tabela user_platform e retornar seu id.
     sql = "INSERT INTO user_platform (name, email, cpf, password) VALUES (%s, %s, %s, %s) RETURNING id;"
 
-    conn = None
     try:
-        # Pega uma nova conexão com o banco
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            # Executa o comando SQL, passando os dados de forma segura
-            cur.execute(sql, (name, email, cpf, hashed_password))
+        # Retira uma conexão do pool; ela é devolvida ao final do bloco
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                # Executa o comando SQL, passando os dados de forma segura
+                cur.execute(sql, (name, email, cpf, hashed_password))
 
-            # Pega o ID retornado pelo comando 'RETURNING id'
-            user_id = cur.fetchone()[0]
-            
-            # Se a execução foi bem-sucedida, salva a transação
-            conn.commit()
-            
-            print(f"Usuário da plataforma '{name}' inserido com sucesso. ID: {user_id}")
-            return user_id
+                # Pega o ID retornado pelo comando 'RETURNING id'
+                user_id = cur.fetchone()[0]
+                
+                # Se a execução foi bem-sucedida, salva a transação
+                conn.commit()
+                
+                print(f"Usuário da plataforma '{name}' inserido com sucesso. ID: {user_id}")
+                return user_id
             
     except psycopg2.errors.UniqueViolation:
-        # Erro específico para quando o email (que é UNIQUE) já existe
+        # Erro específico para quando o email (que é UNIQUE) já existe.
+        # A transação já foi revertida pelo db_connection()
         print(f"Erro: O email '{email}' ou CPF '{cpf}' já está cadastrado para um usuário da plataforma.")
-        if conn:
-            conn.rollback() # Reverte a transação
         return None
         
     except (Exception, psycopg2.Error) as error:
         # Captura outros possíveis erros de banco de dados
         print(f"Erro ao adicionar usuário da plataforma: {error}")
-        if conn:
-            conn.rollback() # Reverte a transação
         return None
-        
-    finally:
-        # Garante que a conexão seja sempre fechada
-        if conn:
-            conn.close()
 
 
 def find_user_by_email(email: str) -> Optional[Dict[str, Any]]:
@@ -129,27 +317,30 @@ def find_user_by_email(email: str) -> Optional[Dict[str, Any]]:
     Retorna:
         Um dicionário com os dados do usuário ou None se não for encontrado.
     """
-    sql = "SELECT * FROM user_app WHERE email = %s;"
-    conn = None
     try:
-        conn = get_db_connection()
-        # DictCursor faz com que o resultado seja um dicionário (chave: valor)
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, (email,))
-            user = cur.fetchone()
-            return dict(user) if user else None
+        with db_connection() as conn:
+            # DictCursor faz com que o resultado seja um dicionário (chave: valor)
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                execute_prepared(cur, "find_user_by_email", "SELECT * FROM user_app WHERE email = $1", (email,))
+                user = cur.fetchone()
+                return dict(user) if user else None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar usuário: {error}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
 
 # ==============================================================================
 # FUNÇÕES DO PIPELINE (CAPTURA E RESULTADO)
 # ==============================================================================
 
+# Ver get_pipeline_output_generation()
+_pipeline_output_generation = 0
+
+def _notify_pipeline_output_written() -> None:
+    global _pipeline_output_generation
+    _pipeline_output_generation += 1
+
+@instrumented("add_capture")
 def add_capture(user_app_id: int, url: str, date: datetime, lat: float, long: float) -> Optional[int]:
     """
     Adiciona uma nova captura (imagem de entrada do pipeline) ao banco de dados.
@@ -158,81 +349,133 @@ def add_capture(user_app_id: int, url: str, date: datetime, lat: float, long: fl
         O ID da nova captura ou None em caso de erro.
     """
     sql = "INSERT INTO capture (user_app_id, url, date, lat, long) VALUES (%s, %s, %s, %s, %s) RETURNING id;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(sql, (user_app_id, url, date, lat, long))
-            capture_id = cur.fetchone()[0]
-            conn.commit()
-            print(f"capture id:{capture_id}")
-            return capture_id
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (user_app_id, url, date, lat, long))
+                capture_id = cur.fetchone()[0]
+                conn.commit()
+                print(f"capture id:{capture_id}")
+                return capture_id
     except psycopg2.errors.UniqueViolation:
         print(f"Erro: A URL '{url}' já foi capturada anteriormente.")
         return None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao inserir captura: {error}")
-        if conn:
-            conn.rollback()
         return None
-    finally:
-        if conn:
-            conn.close()
 
 
-def add_pipeline_output(capture_id: int, dados: Dict) -> Optional[int]:
+def _gravar_fatores(cur, output_id: int, dados_achatados: Dict[str, Any]) -> None:
     """
-    Adiciona o resultado processado pelo pipeline para uma captura existente.
+    Grava os fatores de uma análise no vocabulário (cpted_factor) e os vincula
+    à linha de pipeline_output, dentro da transação do chamador.
+    """
+    _gravar_fatores_em_lote(cur, [(output_id, dados_achatados)])
 
-    Args:
-        capture_id: O ID da captura a que este resultado pertence.
-        dados: O objeto AnaliseCptedDoLocal contendo os dados da análise.
+
+def _gravar_fatores_em_lote(cur, analises: List[tuple]) -> None:
+    """Versão de `_gravar_fatores` para várias (output_id, dados_achatados) de uma vez."""
+    vocabulario = {}
+    vinculos = []
+    for output_id, dados_achatados in analises:
+        for campo, chave, rotulo in extrair_fatores_cpted(dados_achatados):
+            vocabulario.setdefault((campo, chave), rotulo)
+            vinculos.append((output_id, campo, chave))
+    if not vinculos:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO cpted_factor (field, key, label) VALUES %s ON CONFLICT (field, key) DO NOTHING;",
+        [(campo, chave, rotulo) for (campo, chave), rotulo in vocabulario.items()],
+        page_size=1000,
+    )
+    # Em um comando separado, para enxergar também os fatores inseridos por
+    # transações concorrentes que terminaram durante o INSERT acima
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO pipeline_output_factor (pipeline_output_id, factor_id)
+        SELECT v.output_id, f.id
+        FROM (VALUES %s) AS v(output_id, field, key)
+        JOIN cpted_factor f ON f.field = v.field AND f.key = v.key
+        ON CONFLICT DO NOTHING;
+        """,
+        vinculos,
+        page_size=1000,
+    )
+
+
+# INSERT da análise, montado uma vez a partir das colunas do esquema
+# (capture_id é $1; as colunas de COLUNAS_ANALISE_ACHATADA vêm em seguida)
+_SQL_INSERIR_ANALISE = "INSERT INTO pipeline_output (capture_id, {}) VALUES ({}) RETURNING id".format(
+    ", ".join(COLUNAS_ANALISE_ACHATADA),
+    ", ".join(f"${i}" for i in range(1, len(COLUNAS_ANALISE_ACHATADA) + 2)),
+)
+
+def _inserir_pipeline_output(cur, capture_id: int, dados: Any) -> int:
+    """
+    Insere a análise e seus fatores na transação do chamador. `dados` pode ser
+    um dicionário (validado aqui) ou um AnaliseCptedDoLocal já validado.
 
     Retorna:
-        O ID da nova linha em pipeline_output ou None em caso de erro.
+        O ID da nova linha em pipeline_output.
     """
-    # Achata o dicionário para que os valores sejam passados na ordem correta
-    dados = AnaliseCptedDoLocal(**dados)
+    dados = validar_analise_cpted(dados)
     dados_achatados = achatar_analise_cpted(dados)
 
-    # Constrói a query dinamicamente para evitar SQL Injection e facilitar a manutenção
-    colunas = ", ".join(dados_achatados.keys())
-    placeholders = ", ".join(["%s"] * len(dados_achatados))
+    # Valores na ordem de COLUNAS_ANALISE_ACHATADA
+    valores = (int(capture_id),) + tuple(dados_achatados[coluna] for coluna in COLUNAS_ANALISE_ACHATADA)
+
+    execute_prepared(cur, "insert_pipeline_output", _SQL_INSERIR_ANALISE, valores)
+    output_id = cur.fetchone()[0]
+    _gravar_fatores(cur, output_id, dados_achatados)
+    return output_id
 
-    sql = f"INSERT INTO pipeline_output (capture_id, {colunas}) VALUES (%s, {placeholders}) RETURNING id;"
-    
-    # Prepara a lista de valores na ordem correta
-    valores = [int(capture_id)] + list(dados_achatados.values())
 
-    conn = None
+@instrumented("add_pipeline_output")
+def add_pipeline_output(capture_id: int, dados: Any) -> Optional[int]:
+    """
+    Adiciona o resultado processado pelo pipeline para uma captura existente.
+
+    Args:
+        capture_id: O ID da captura a que este resultado pertence.
+        dados: A análise, como dicionário ou como objeto AnaliseCptedDoLocal
+            (neste caso a validação não é repetida).
+
+    Retorna:
+        O ID da nova linha em pipeline_output ou None em caso de erro.
+    """
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(sql, valores)
-            output_id = cur.fetchone()[0]
-            conn.commit()
-            return output_id
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                output_id = _inserir_pipeline_output(cur, capture_id, dados)
+                conn.commit()
+                _notify_pipeline_output_written()
+                return output_id
     except psycopg2.errors.UniqueViolation:
         print(f"Erro: Já existe um resultado de pipeline para a captura ID {capture_id}.")
         return None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao inserir resultado do pipeline: {error}")
-        if conn:
-            conn.rollback()
         return None
-    finally:
-        if conn:
-            conn.close()
 
 
-def get_all_analyses_for_map() -> List[Dict[str, Any]]:
+def get_all_analyses_for_map(after_id: int = 0) -> Optional[List[Dict[str, Any]]]:
     """
     Busca no banco de dados todas as análises que possuem coordenadas geográficas
     para a geração do mapa, incluindo a URL da imagem de captura.
+
+    Args:
+        after_id: Retorna só análises com pipeline_output.id maior que este
+            (permite atualizar o mapa de forma incremental).
+
+    Retorna:
+        Uma lista de dicionários (vazia se não houver análises) ou None em caso de erro.
     """
 
     sql = """
         SELECT
+            po.id AS pipeline_output_id,
             c.lat,
             c.long AS lon,
             c.url AS capture_url,
@@ -246,22 +489,164 @@ def get_all_analyses_for_map() -> List[Dict[str, Any]]:
         JOIN
             pipeline_output po ON c.id = po.capture_id
         WHERE
-            c.lat IS NOT NULL AND c.long IS NOT NULL;
+            c.lat IS NOT NULL AND c.long IS NOT NULL AND po.id > %s
+        ORDER BY
+            po.id;
     """
-    conn = None
     results = []
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql)
-            results = [dict(row) for row in cur.fetchall()]
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (after_id,))
+                results = [dict(row) for row in cur.fetchall()]
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar dados para o mapa: {error}")
-    finally:
-        if conn:
-            conn.close()
+        return None
     return results
 
+def get_pipeline_output_version() -> Optional[Dict[str, Any]]:
+    """
+    Identifica a versão atual das análises do mapa (as que têm coordenadas):
+    quantas são, o maior ID e a data de processamento mais recente. Usada para
+    invalidar o cache do mapa. A contagem muda mesmo quando uma análise é
+    gravada depois de outra com ID maior (workers concorrentes).
+
+    Retorna:
+        Um dicionário com total, max_id e data_processamento, ou None em caso de erro.
+    """
+    sql = """
+        SELECT count(*), COALESCE(max(po.id), 0), max(po.data_processamento)
+        FROM pipeline_output po
+        JOIN capture c ON c.id = po.capture_id
+        WHERE c.lat IS NOT NULL AND c.long IS NOT NULL;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                total, max_id, data = cur.fetchone()
+                return {"total": total, "max_id": max_id, "data_processamento": data}
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar a versão dos resultados do pipeline: {error}")
+        return None
+
+def get_pipeline_output_generation() -> int:
+    """
+    Contador, local ao processo, incrementado a cada resultado gravado por
+    este processo. Permite que caches locais (ex: o do mapa) percebam novas
+    análises sem consultar o banco.
+    """
+    return _pipeline_output_generation
+
+def iter_analyses_in_bbox(min_lon: float, min_lat: float, max_lon: float, max_lat: float,
+                          limit: int) -> Optional[Iterator[Dict[str, Any]]]:
+    """
+    Percorre as análises cujas capturas estão dentro de um retângulo geográfico
+    (a janela visível do mapa), trazendo só as colunas usadas pelo mapa.
+
+    Usa um cursor do lado do servidor: as linhas chegam do banco em blocos,
+    e a conexão volta ao pool quando o iterador termina (ou é abandonado).
+    A consulta é executada e o primeiro bloco lido antes do retorno, para que
+    falhas de conexão ou de SQL apareçam aqui, e não no meio da resposta.
+    Erros na leitura dos blocos seguintes são propagados pelo iterador.
+
+    Retorna:
+        Um iterador de dicionários com capture_id, lat, lon, titulo_analise,
+        indice_cpted_geral e data_processamento, ou None em caso de erro.
+    """
+    sql = """
+        SELECT
+            c.id AS capture_id,
+            c.lat,
+            c.long AS lon,
+            po.titulo_analise,
+            po.indice_cpted_geral,
+            po.data_processamento
+        FROM
+            capture c
+        JOIN
+            pipeline_output po ON c.id = po.capture_id
+        WHERE
+            point(c."long", c.lat) <@ box(point(%s, %s), point(%s, %s))
+        ORDER BY
+            po.id DESC
+        LIMIT %s;
+    """
+    def _linhas() -> Iterator[Optional[Dict[str, Any]]]:
+        with db_connection() as conn:
+            with conn.cursor(name="map_features", cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (min_lon, min_lat, max_lon, max_lat, limit))
+                bloco = cur.fetchmany(500)
+                yield None  # consulta executada, primeiro bloco em memória
+                while bloco:
+                    for row in bloco:
+                        yield dict(row)
+                    bloco = cur.fetchmany(500)
+
+    linhas = _linhas()
+    try:
+        next(linhas)
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar análises na janela do mapa: {error}")
+        return None
+    return linhas
+
+def map_cluster_cell_size(zoom: int) -> float:
+    """
+    Tamanho (em graus) da célula dos grupos do mapa em um nível de zoom:
+    MAP_CLUSTER_CELL_PX pixels de um tile de 256 px, que cobre 360 / 2^zoom graus.
+    """
+    return 360.0 / (2 ** zoom) * (config.MAP_CLUSTER_CELL_PX / 256.0)
+
+def get_analysis_clusters_in_bbox(min_lon: float, min_lat: float, max_lon: float, max_lat: float,
+                                  zoom: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Lê os grupos pré-agregados do mapa (tabela map_cluster) para um nível de
+    zoom: uma grade regular ancorada em (0, 0), para que os grupos fiquem
+    estáveis quando o usuário arrasta o mapa. Entram as células que tocam a
+    janela, das mais cheias para as mais vazias, até `limit` grupos.
+
+    Os agregados são atualizados por refresh_cpted_summary, chamada por quem
+    grava análises (worker e ingestão em lote).
+
+    Retorna:
+        Uma lista de dicionários com total, lat e lon (centroide do grupo) e
+        indice_dominante (o índice CPTED mais frequente no grupo), ou None em
+        caso de erro.
+    """
+    sql = """
+        SELECT
+            sum(total)::bigint AS total,
+            sum(soma_lat) / sum(total) AS lat,
+            sum(soma_lon) / sum(total) AS lon,
+            NULLIF((array_agg(indice_cpted_geral
+                              ORDER BY indice_cpted_geral = 'N/A', total DESC, indice_cpted_geral))[1],
+                   'N/A') AS indice_dominante
+        FROM
+            map_cluster
+        WHERE
+            zoom = %(zoom)s
+            AND cell_x BETWEEN floor(%(min_lon)s / %(celula)s) AND floor(%(max_lon)s / %(celula)s)
+            AND cell_y BETWEEN floor(%(min_lat)s / %(celula)s) AND floor(%(max_lat)s / %(celula)s)
+        GROUP BY
+            cell_x, cell_y
+        ORDER BY
+            sum(total) DESC
+        LIMIT %(limit)s;
+    """
+    parametros = {
+        "zoom": zoom, "celula": map_cluster_cell_size(zoom), "limit": limit,
+        "min_lon": min_lon, "min_lat": min_lat, "max_lon": max_lon, "max_lat": max_lat,
+    }
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, parametros)
+                return [dict(r) for r in cur.fetchall()]
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao agrupar análises na janela do mapa: {error}")
+        return None
+
 def get_full_analysis_by_url(url: str) -> Optional[Dict[str, Any]]:
     """
     Busca todos os dados relacionados a uma captura (usuário, captura e resultado)
@@ -288,62 +673,86 @@ def get_full_analysis_by_url(url: str) -> Optional[Dict[str, Any]]:
         JOIN
             user_app ua ON c.user_app_id = ua.id
         WHERE
-            c.url = %s;
+            c.url = $1
     """
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, (url,))
-            resultado = cur.fetchone()
-            return dict(resultado) if resultado else None
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                execute_prepared(cur, "get_full_analysis_by_url", sql, (url,))
+                resultado = cur.fetchone()
+                return dict(resultado) if resultado else None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar análise completa: {error}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def get_all_captures_by_user(user_id: int) -> List[Dict[str, Any]]:
+# Campos que podem ser pedidos em `get_all_captures_by_user(fields=...)`
+_CAMPOS_CAPTURA_USUARIO = {
+    "capture_id": "c.id",
+    "capture_url": "c.url",
+    "capture_date": "c.date",
+    "lat": "c.lat",
+    "long": 'c."long"',
+    "pipeline_output_id": "po.id",
+    "data_processamento": "po.data_processamento",
+    **{coluna: f"po.{coluna}" for coluna in COLUNAS_ANALISE_ACHATADA},
+}
+USER_CAPTURE_FIELDS = frozenset(_CAMPOS_CAPTURA_USUARIO)
+
+def get_all_captures_by_user(user_id: int, after: Optional[int] = None, limit: Optional[int] = None,
+                             fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
     """
-    Busca todas as capturas feitas por um usuário específico.
+    Busca as capturas feitas por um usuário específico, em ordem de ID.
 
     Args:
         user_id: O ID do usuário cujas capturas queremos buscar.
+        after: Cursor de paginação; retorna só capturas com ID maior que este.
+        limit: Número máximo de capturas retornadas (None = todas).
+        fields: Projeção opcional com nomes de USER_CAPTURE_FIELDS. Quando
+            informada, cada item traz só esses campos (mais o capture_id),
+            sem o objeto `pipeline_results` completo.
 
     Retorna:
         Uma lista de dicionários com os dados das capturas ou uma lista vazia se não houver capturas.
     """
-    sql = """
-        SELECT
-            c.id AS capture_id,
+    if fields:
+        desconhecidos = set(fields) - USER_CAPTURE_FIELDS
+        if desconhecidos:
+            raise ValueError(f"Campos desconhecidos: {', '.join(sorted(desconhecidos))}")
+        selecionados = ["capture_id"] + [f for f in dict.fromkeys(fields) if f != "capture_id"]
+        colunas = ",\n            ".join(f"{_CAMPOS_CAPTURA_USUARIO[f]} AS {f}" for f in selecionados)
+    else:
+        # pipeline_output tem no máximo uma linha por captura; a lista mantém
+        # o formato de resposta usado pelo aplicativo.
+        colunas = """c.id AS capture_id,
             c.url AS capture_url,
             c.date AS capture_date,
             c.lat,
             c."long",
-            (
-                SELECT COALESCE(json_agg(row_to_json(po)), '[]'::json)
-                FROM pipeline_output po
-                WHERE po.capture_id = c.id
-            ) AS pipeline_results
+            CASE WHEN po.id IS NULL THEN '[]'::json
+                 ELSE json_build_array(row_to_json(po)) END AS pipeline_results"""
+
+    sql = f"""
+        SELECT
+            {colunas}
         FROM
             capture c
+        LEFT JOIN
+            pipeline_output po ON po.capture_id = c.id
         WHERE
-            c.user_app_id = %s;
+            c.user_app_id = %s AND c.id > %s
+        ORDER BY
+            c.id
+        LIMIT %s;
     """
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, (user_id,))
-            resultados = cur.fetchall()
-            return [dict(r) for r in resultados] if resultados else []
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (user_id, after or 0, limit))
+                resultados = cur.fetchall()
+                return [dict(r) for r in resultados] if resultados else []
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar capturas do usuário {user_id}: {error}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 def get_all_users() -> List[Dict[str, Any]]:
     """
@@ -353,19 +762,15 @@ def get_all_users() -> List[Dict[str, Any]]:
         Uma lista de dicionários com os dados de cada usuário.
     """
     sql = "SELECT * FROM user_app;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql)
-            resultados = cur.fetchall()
-            return [dict(r) for r in resultados] if resultados else []
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql)
+                resultados = cur.fetchall()
+                return [dict(r) for r in resultados] if resultados else []
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar usuários: {error}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 def get_all_platform_users() -> List[Dict[str, Any]]:
     """
@@ -375,19 +780,15 @@ def get_all_platform_users() -> List[Dict[str, Any]]:
         Uma lista de dicionários com os dados de cada usuário da plataforma.
     """
     sql = "SELECT * FROM user_platform;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql)
-            resultados = cur.fetchall()
-            return [dict(r) for r in resultados] if resultados else []
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql)
+                resultados = cur.fetchall()
+                return [dict(r) for r in resultados] if resultados else []
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar usuários da plataforma: {error}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 def get_capture_by_id(capture_id: int) -> Optional[Dict[str, Any]]:
     """
@@ -400,19 +801,15 @@ def get_capture_by_id(capture_id: int) -> Optional[Dict[str, Any]]:
         Um dicionário com os dados da captura ou None se não for encontrada.
     """
     sql = "SELECT * FROM capture WHERE id = %s;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, (capture_id,))
-            resultado = cur.fetchone()
-            return dict(resultado) if resultado else None
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (capture_id,))
+                resultado = cur.fetchone()
+                return dict(resultado) if resultado else None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar captura ID {capture_id}: {error}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
 def get_pipeline_output_by_capture_id(capture_id: int) -> Optional[Dict[str, Any]]:
     """
@@ -424,20 +821,16 @@ def get_pipeline_output_by_capture_id(capture_id: int) -> Optional[Dict[str, Any
     Retorna:
         Um dicionário com os dados do resultado do pipeline ou None se não for encontrado.
     """
-    sql = "SELECT * FROM pipeline_output WHERE capture_id = %s;"
-    conn = None
+    sql = "SELECT * FROM pipeline_output WHERE capture_id = $1"
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, (capture_id,))
-            resultado = cur.fetchone()
-            return dict(resultado) if resultado else None
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                execute_prepared(cur, "get_pipeline_output_by_capture_id", sql, (capture_id,))
+                resultado = cur.fetchone()
+                return dict(resultado) if resultado else None
     except (Exception, psycopg2.Error) as error:
         print(f"Erro ao buscar resultado do pipeline para captura ID {capture_id}: {error}")
         return None
-    finally:
-        if conn:
-            conn.close()    
 
 def login_user_app(email: str, senha_digitada: str) -> bool:
     """
@@ -453,30 +846,947 @@ def login_user_app(email: str, senha_digitada: str) -> bool:
         bool: True se o login for bem-sucedido, False caso contrário.
     """
     sql = "SELECT password FROM user_app WHERE email = %s;"
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute(sql, (email,))
-            resultado = cur.fetchone()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (email,))
+                resultado = cur.fetchone()
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao tentar fazer login: {error}")
+        return False
+
+    # A conexão já voltou ao pool: a verificação do hash é lenta de propósito
+    # e não deve segurar uma conexão do banco.
+    if resultado is None:
+        print("Usuário não encontrado.")
+        return False
+
+    senha_hash = resultado[0]
+
+    # Faz a verificação usando Werkzeug
+    if check_password_hash(senha_hash, senha_digitada):
+        print("Login bem-sucedido!")
+        return True
+    else:
+        print("Senha incorreta.")
+        return False
+
+
+# ==============================================================================
+# FILA DE JOBS DO PIPELINE
+# ==============================================================================
+
+def create_pipeline_job(capture_id: int) -> Optional[int]:
+    """
+    Enfileira o processamento de uma captura.
+
+    Retorna:
+        O ID do novo job ou None em caso de erro.
+    """
+    sql = "INSERT INTO pipeline_job (capture_id) VALUES (%s) RETURNING id;"
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (capture_id,))
+                job_id = cur.fetchone()[0]
+                conn.commit()
+                return job_id
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao criar job para a captura ID {capture_id}: {error}")
+        return None
+
+def claim_pipeline_job(job_id: Optional[int] = None, stale_after_s: float = 600,
+                       max_attempts: int = 3) -> Optional[Dict[str, Any]]:
+    """
+    Marca um job como 'running' e o retorna junto com a URL da captura.
+
+    Sem `job_id`, reivindica o job mais antigo disponível: os que estão em
+    'queued' (e cuja espera para nova tentativa já passou) e os que ficaram em
+    'running' por mais de `stale_after_s` segundos (worker que morreu no meio
+    do processamento). O uso de
+    FOR UPDATE SKIP LOCKED permite vários workers em paralelo. Os jobs parados
+    em 'running' que já gastaram as `max_attempts` tentativas não voltam a
+    rodar: são marcados como 'failed' antes da reivindicação.
+
+    Retorna:
+        Um dicionário com os dados do job ou None se não houver job disponível.
+    """
+    sql_expirados = """
+        UPDATE pipeline_job
+        SET status = 'failed', updated_at = now(),
+            error = 'O worker parou durante a última tentativa (' || attempts || ' de ' || %s || ').'
+        WHERE status = 'running'
+          AND updated_at < now() - make_interval(secs => %s)
+          AND attempts >= %s
+        RETURNING id;
+    """
+    condicao = """
+        ((j.status = 'queued' AND (j.available_at IS NULL OR j.available_at <= now()))
+         OR (j.status = 'running' AND j.updated_at < now() - make_interval(secs => %s)))
+        AND j.attempts < %s
+    """
+    params: List[Any] = [stale_after_s, max_attempts]
+    if job_id is not None:
+        condicao += " AND j.id = %s"
+        params.append(job_id)
+
+    sql = f"""
+        WITH proximo AS (
+            SELECT j.id
+            FROM pipeline_job j
+            WHERE {condicao}
+            ORDER BY j.id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE pipeline_job j
+        SET status = 'running', attempts = j.attempts + 1, updated_at = now()
+        FROM proximo, capture c
+        WHERE j.id = proximo.id AND c.id = j.capture_id
+        RETURNING j.id, j.capture_id, j.attempts, j.pipeline_mode, c.url AS capture_url, c.lat, c."long";
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql_expirados, (max_attempts, stale_after_s, max_attempts))
+                for (expirado,) in cur.fetchall():
+                    print(f"[job {expirado}] Parado na última tentativa. Marcado como falho.")
+                cur.execute(sql, params)
+                job = cur.fetchone()
+                conn.commit()
+                return dict(job) if job else None
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao reivindicar job do pipeline: {error}")
+        return None
+
+_SQL_FINALIZAR_JOB = """
+    UPDATE pipeline_job
+    SET status = %s, pipeline_output_id = %s, error = %s, updated_at = now()
+    WHERE id = %s;
+"""
+
+def finish_pipeline_job(job_id: int, status: str, pipeline_output_id: Optional[int] = None,
+                        error: Optional[str] = None) -> bool:
+    """
+    Registra o resultado de um job ('done' ou 'failed').
+
+    Retorna:
+        True se o job foi atualizado, False caso contrário.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_SQL_FINALIZAR_JOB, (status, pipeline_output_id, error, job_id))
+                atualizado = cur.rowcount == 1
+                conn.commit()
+                return atualizado
+    except (Exception, psycopg2.Error) as error_db:
+        print(f"Erro ao finalizar job ID {job_id}: {error_db}")
+        return False
 
-            if resultado is None:
-                print("Usuário não encontrado.")
-                return False
+def fail_pipeline_job(job_id: int, error: str, max_attempts: int = 3,
+                      retry_backoff_s: float = 30) -> Optional[float]:
+    """
+    Registra a falha de um job. Enquanto houver tentativas (`max_attempts`),
+    ele volta para 'queued' e só pode ser reivindicado depois de uma espera
+    exponencial (`retry_backoff_s`, dobrando a cada tentativa); na última, o
+    job fica em 'failed' de vez.
 
-            senha_hash = resultado[0]
+    Retorna:
+        Os segundos até a nova tentativa, ou None se o job falhou de vez
+        (ou em caso de erro).
+    """
+    sql = """
+        UPDATE pipeline_job
+        SET status = CASE WHEN attempts < %(max)s THEN 'queued' ELSE 'failed' END,
+            available_at = CASE WHEN attempts < %(max)s
+                THEN now() + make_interval(secs => %(espera)s * power(2, GREATEST(attempts - 1, 0)))
+            END,
+            error = %(erro)s, updated_at = now()
+        WHERE id = %(id)s
+        RETURNING status, EXTRACT(EPOCH FROM available_at - now());
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, {"max": max_attempts, "espera": retry_backoff_s, "erro": error, "id": job_id})
+                linha = cur.fetchone()
+                conn.commit()
+                if linha is None or linha[0] != "queued":
+                    return None
+                return float(linha[1])
+    except (Exception, psycopg2.Error) as error_db:
+        print(f"Erro ao registrar a falha do job ID {job_id}: {error_db}")
+        return None
+
+def release_pipeline_job(job_id: int) -> bool:
+    """
+    Devolve à fila um job em 'running' que não chegou ao fim (ex: o cliente
+    de /send-photo/stream desconectou), sem gastar uma das tentativas.
 
-            # Faz a verificação usando Werkzeug
-            if check_password_hash(senha_hash, senha_digitada):
-                print("Login bem-sucedido!")
+    Retorna:
+        True se o job voltou para 'queued', False caso contrário.
+    """
+    sql = """
+        UPDATE pipeline_job
+        SET status = 'queued', attempts = GREATEST(attempts - 1, 0), updated_at = now()
+        WHERE id = %s AND status = 'running';
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (job_id,))
+                liberado = cur.rowcount == 1
+                conn.commit()
+                return liberado
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao devolver o job ID {job_id} à fila: {error}")
+        return False
+
+def get_pipeline_job(job_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Busca o estado de um job do pipeline.
+
+    Retorna:
+        Um dicionário com os dados do job ou None se não for encontrado.
+    """
+    sql = """
+        SELECT j.id AS job_id, j.capture_id, j.status, j.attempts, j.error, j.pipeline_mode,
+               j.pipeline_output_id, cp.duplicate_of AS duplicate_of_capture_id,
+               j.available_at AS retry_at, j.created_at, j.updated_at, c.user_app_id
+        FROM pipeline_job j
+        JOIN capture c ON c.id = j.capture_id
+        LEFT JOIN capture_phash cp ON cp.capture_id = j.capture_id
+        WHERE j.id = %s;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (job_id,))
+                resultado = cur.fetchone()
+                return dict(resultado) if resultado else None
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar job ID {job_id}: {error}")
+        return None
+
+def _job_por_chave(cur, conn, sql: str, user_app_id: int,
+                   idempotency_key: str) -> Optional[Dict[str, Any]]:
+    """Relê o job que venceu a disputa pela mesma chave de idempotência."""
+    cur.execute(sql, (user_app_id, idempotency_key))
+    existente = cur.fetchone()
+    conn.commit()
+    return {**existente, "created": False} if existente else None
+
+@instrumented("submit_capture")
+def submit_capture(user_app_id: int, url: str, date: datetime, lat: float, long: float,
+                   idempotency_key: Optional[str] = None,
+                   pipeline_mode: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Registra uma captura e enfileira seu processamento em uma única transação.
+
+    Reenvios não geram trabalho novo: se `idempotency_key` já foi usada pelo
+    mesmo usuário, ou se a URL já foi capturada por ele, retorna o job (ou a
+    análise) existente. Uma URL cujo último job falhou pode ser reenviada e
+    ganha um job novo. Uma URL já capturada por outro usuário não é
+    registrada nem revela a captura dele (status "conflict").
+    `pipeline_mode` ("two_stage" ou "fused") fica gravado no job criado; None
+    usa o PIPELINE_MODE configurado no worker.
+
+    Retorna:
+        Um dicionário com job_id, capture_id, status, pipeline_output_id e
+        created (True se a captura e o job foram criados agora), ou None em
+        caso de erro. Com status "conflict", job_id e capture_id são None.
+    """
+    sql_job_por_chave = """
+        SELECT id AS job_id, capture_id, status, pipeline_output_id
+        FROM pipeline_job WHERE user_app_id = %s AND idempotency_key = %s;
+    """
+    sql_captura = """
+        INSERT INTO capture (user_app_id, url, date, lat, long) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (url) DO NOTHING
+        RETURNING id;
+    """
+    sql_existente = """
+        SELECT c.id AS capture_id, j.id AS job_id, j.status,
+               COALESCE(j.pipeline_output_id, po.id) AS pipeline_output_id
+        FROM capture c
+        LEFT JOIN pipeline_output po ON po.capture_id = c.id
+        LEFT JOIN LATERAL (
+            SELECT id, status, pipeline_output_id FROM pipeline_job
+            WHERE capture_id = c.id ORDER BY id DESC LIMIT 1
+        ) j ON TRUE
+        WHERE c.url = %s AND c.user_app_id = %s;
+    """
+    sql_job = """
+        INSERT INTO pipeline_job (capture_id, user_app_id, idempotency_key, pipeline_mode)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_app_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+        RETURNING id;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                if idempotency_key:
+                    cur.execute(sql_job_por_chave, (user_app_id, idempotency_key))
+                    job = cur.fetchone()
+                    if job:
+                        conn.commit()
+                        return {**job, "created": False}
+
+                cur.execute(sql_captura, (user_app_id, url, date, lat, long))
+                nova = cur.fetchone()
+                if nova is None:
+                    # URL já capturada: devolve o que já existe para ela, se for do mesmo usuário
+                    cur.execute(sql_existente, (url, user_app_id))
+                    existente = cur.fetchone()
+                    if existente is None:
+                        conn.rollback()
+                        return {"job_id": None, "capture_id": None, "status": "conflict",
+                                "pipeline_output_id": None, "created": False}
+                    existente = dict(existente)
+                    sem_analise = existente["pipeline_output_id"] is None
+                    if sem_analise and existente["status"] in (None, "failed"):
+                        # Captura sem job, ou cujo último job falhou: enfileira agora
+                        cur.execute(sql_job, (existente["capture_id"], user_app_id,
+                                              idempotency_key, pipeline_mode))
+                        job = cur.fetchone()
+                        if job is None:
+                            conn.rollback()
+                            return _job_por_chave(cur, conn, sql_job_por_chave,
+                                                  user_app_id, idempotency_key)
+                        existente.update(job_id=job["id"], status="queued")
+                        conn.commit()
+                        return {**existente, "created": True}
+                    if existente["status"] is None:
+                        existente["status"] = "done"
+                    conn.commit()
+                    return {**existente, "created": False}
+
+                cur.execute(sql_job, (nova["id"], user_app_id, idempotency_key, pipeline_mode))
+                job = cur.fetchone()
+                if job is None:
+                    # A mesma chave foi usada por outra requisição concorrente
+                    # (com outra URL): descarta esta captura e devolve aquele job
+                    conn.rollback()
+                    return _job_por_chave(cur, conn, sql_job_por_chave,
+                                          user_app_id, idempotency_key)
+                conn.commit()
+                return {"job_id": job["id"], "capture_id": nova["id"], "status": "queued",
+                        "pipeline_output_id": None, "created": True}
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao registrar a captura '{url}': {error}")
+        return None
+
+@instrumented("complete_pipeline_job")
+def complete_pipeline_job(job_id: int, capture_id: int, dados: Any) -> Optional[int]:
+    """
+    Grava o resultado do pipeline e conclui o job na mesma transação: ou os
+    dois ficam registrados, ou nenhum.
+
+    Retorna:
+        O ID da nova linha em pipeline_output ou None em caso de erro.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                output_id = _inserir_pipeline_output(cur, capture_id, dados)
+                cur.execute(_SQL_FINALIZAR_JOB, ("done", output_id, None, job_id))
+                conn.commit()
+                _notify_pipeline_output_written()
+                return output_id
+    except psycopg2.errors.UniqueViolation:
+        print(f"Erro: Já existe um resultado de pipeline para a captura ID {capture_id}.")
+        return None
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao concluir o job ID {job_id}: {error}")
+        return None
+
+
+
+# ==============================================================================
+# DETECÇÃO DE FOTOS QUASE DUPLICADAS
+# ==============================================================================
+
+def add_capture_phash(capture_id: int, phash: int) -> bool:
+    """
+    Registra o hash perceptual (64 bits, com sinal) da imagem de uma captura.
+
+    Retorna:
+        True se o hash foi gravado, False em caso de erro.
+    """
+    sql = """
+        INSERT INTO capture_phash (capture_id, phash) VALUES (%s, %s)
+        ON CONFLICT (capture_id) DO UPDATE SET phash = EXCLUDED.phash;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (capture_id, phash))
+                conn.commit()
                 return True
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao gravar hash perceptual da captura ID {capture_id}: {error}")
+        return False
+
+def find_phash_candidates(capture_id: int, min_lat: float, max_lat: float, min_lon: float,
+                          max_lon: float, window_days: float) -> List[Dict[str, Any]]:
+    """
+    Busca capturas recentes, já analisadas, dentro de um retângulo geográfico,
+    que possam ser quase duplicatas da captura informada.
+
+    Retorna:
+        Uma lista de dicionários com capture_id, phash, lat e long dos candidatos.
+    """
+    sql = """
+        SELECT c.id AS capture_id, cp.phash, c.lat, c."long"
+        FROM capture_phash cp
+        JOIN capture c ON c.id = cp.capture_id
+        JOIN pipeline_output po ON po.capture_id = c.id
+        WHERE cp.capture_id <> %s
+          AND cp.created_at >= now() - make_interval(secs => %s)
+          AND c.lat BETWEEN %s AND %s
+          AND c."long" BETWEEN %s AND %s;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, (capture_id, window_days * 86400, min_lat, max_lat, min_lon, max_lon))
+                return [dict(r) for r in cur.fetchall()]
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar candidatos a duplicata da captura ID {capture_id}: {error}")
+        return []
+
+def link_capture_to_existing_output(capture_id: int, source_capture_id: int,
+                                    job_id: Optional[int] = None) -> Optional[int]:
+    """
+    Reaproveita a análise de uma captura já processada para uma captura
+    quase duplicada, sem chamar os modelos novamente. A análise é copiada
+    para a nova captura e o vínculo fica registrado em capture_phash.duplicate_of.
+    Se `job_id` for informado, o job é concluído na mesma transação.
+
+    Retorna:
+        O ID da nova linha em pipeline_output ou None em caso de erro.
+    """
+    colunas = ", ".join(COLUNAS_ANALISE_ACHATADA)
+    sql_copia = f"""
+        INSERT INTO pipeline_output (capture_id, {colunas})
+        SELECT %s, {colunas} FROM pipeline_output WHERE capture_id = %s
+        RETURNING id;
+    """
+    sql_fatores = """
+        INSERT INTO pipeline_output_factor (pipeline_output_id, factor_id)
+        SELECT %s, pof.factor_id
+        FROM pipeline_output_factor pof
+        JOIN pipeline_output po ON po.id = pof.pipeline_output_id
+        WHERE po.capture_id = %s;
+    """
+    sql_vinculo = "UPDATE capture_phash SET duplicate_of = %s WHERE capture_id = %s;"
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql_copia, (capture_id, source_capture_id))
+                resultado = cur.fetchone()
+                if resultado is None:
+                    conn.rollback()
+                    return None
+                cur.execute(sql_fatores, (resultado[0], source_capture_id))
+                cur.execute(sql_vinculo, (source_capture_id, capture_id))
+                if job_id is not None:
+                    cur.execute(_SQL_FINALIZAR_JOB, ("done", resultado[0], None, job_id))
+                conn.commit()
+                _notify_pipeline_output_written()
+                return resultado[0]
+    except psycopg2.errors.UniqueViolation:
+        print(f"Erro: Já existe um resultado de pipeline para a captura ID {capture_id}.")
+        return None
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao vincular a captura ID {capture_id} à captura ID {source_capture_id}: {error}")
+        return None
+
+
+
+# ==============================================================================
+# AGREGADOS DO DASHBOARD CPTED
+# ==============================================================================
+
+# Dimensões agregadas em cpted_summary. As de lista são contadas pelos
+# fatores normalizados (pipeline_output_factor), usando o rótulo do vocabulário.
+SUMMARY_DIMENSIONS = (
+    "total",
+    "indice_cpted_geral",
+    "vigilancia_iluminacao",
+    "manutencao_percepcao_cuidado",
+    "manutencao_sinais_desordem",
+    "recomendacoes",
+)
+
+# Marca as análises ainda não agregadas (anti-join com cpted_summary_output)
+# e soma só essas em cpted_summary e map_cluster (uma linha por zoom abaixo de
+# MAP_CLUSTER_MAX_ZOOM), no mesmo comando. Retorna quantas foram somadas.
+_SQL_AGREGAR_RESUMO = """
+    WITH marcadas AS (
+        INSERT INTO cpted_summary_output (pipeline_output_id)
+        SELECT po.id FROM pipeline_output po
+        WHERE NOT EXISTS (
+            SELECT 1 FROM cpted_summary_output cso WHERE cso.pipeline_output_id = po.id
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING pipeline_output_id
+    ),
+    novos AS (
+        SELECT
+            po.*,
+            COALESCE(po.indice_cpted_geral, 'N/A') AS chave_indice,
+            COALESCE(po.vigilancia_iluminacao, 'N/A') AS chave_iluminacao
+        FROM pipeline_output po
+        JOIN marcadas m ON m.pipeline_output_id = po.id
+    ),
+    linhas AS (
+        SELECT chave_indice, chave_iluminacao, 'total' AS dimension, '' AS value FROM novos
+        UNION ALL
+        SELECT chave_indice, chave_iluminacao, 'indice_cpted_geral', chave_indice FROM novos
+        UNION ALL
+        SELECT chave_indice, chave_iluminacao, 'vigilancia_iluminacao', chave_iluminacao FROM novos
+        UNION ALL
+        SELECT chave_indice, chave_iluminacao, 'manutencao_percepcao_cuidado',
+               COALESCE(manutencao_percepcao_cuidado, 'N/A') FROM novos
+        UNION ALL
+        SELECT n.chave_indice, n.chave_iluminacao, f.field, f.label
+        FROM novos n
+        JOIN pipeline_output_factor pof ON pof.pipeline_output_id = n.id
+        JOIN cpted_factor f ON f.id = pof.factor_id
+        WHERE f.field IN ('manutencao_sinais_desordem', 'recomendacoes')
+    ),
+    somados AS (
+        INSERT INTO cpted_summary (indice_cpted_geral, vigilancia_iluminacao, dimension, value, total)
+        SELECT chave_indice, chave_iluminacao, dimension, value, count(*)
+        FROM linhas
+        WHERE dimension = 'total' OR value <> ''
+        GROUP BY chave_indice, chave_iluminacao, dimension, value
+        ON CONFLICT (indice_cpted_geral, vigilancia_iluminacao, dimension, value)
+        DO UPDATE SET total = cpted_summary.total + EXCLUDED.total
+    ),
+    agrupados AS (
+        INSERT INTO map_cluster (zoom, cell_x, cell_y, indice_cpted_geral, total, soma_lat, soma_lon)
+        SELECT z.zoom,
+               floor(c."long" / (%(celula_zoom0)s / 2 ^ z.zoom)),
+               floor(c.lat / (%(celula_zoom0)s / 2 ^ z.zoom)),
+               n.chave_indice, count(*), sum(c.lat), sum(c."long")
+        FROM novos n
+        JOIN capture c ON c.id = n.capture_id
+        CROSS JOIN generate_series(0, %(zoom_max)s - 1) AS z(zoom)
+        WHERE c.lat IS NOT NULL AND c."long" IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (zoom, cell_x, cell_y, indice_cpted_geral)
+        DO UPDATE SET total = map_cluster.total + EXCLUDED.total,
+                      soma_lat = map_cluster.soma_lat + EXCLUDED.soma_lat,
+                      soma_lon = map_cluster.soma_lon + EXCLUDED.soma_lon
+    )
+    SELECT count(*) FROM marcadas;
+"""
+
+def refresh_cpted_summary(rebuild: bool = False) -> Optional[int]:
+    """
+    Atualiza os agregados do dashboard e os grupos do mapa (map_cluster)
+    somando só as linhas de pipeline_output que ainda não foram agregadas
+    (registradas em cpted_summary_output). Linhas gravadas fora da ordem dos
+    IDs por workers concorrentes entram na próxima atualização em que
+    estiverem visíveis.
+
+    Args:
+        rebuild: Se True, apaga os agregados e os recalcula do zero. Também
+            acontece quando MAP_CLUSTER_CELL_PX ou MAP_CLUSTER_MAX_ZOOM mudam.
+
+    Retorna:
+        O número de análises agregadas nesta chamada ou None em caso de erro.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                # Trava a linha de estado: só uma atualização por vez
+                cur.execute("SELECT map_cell_px, map_max_zoom FROM cpted_summary_state WHERE id FOR UPDATE;")
+                grade = (config.MAP_CLUSTER_CELL_PX, config.MAP_CLUSTER_MAX_ZOOM)
+                if tuple(cur.fetchone()) != grade:
+                    # Grade do mapa diferente da agregada (ou nunca agregada)
+                    rebuild = True
+                if rebuild:
+                    cur.execute("DELETE FROM cpted_summary;")
+                    cur.execute("DELETE FROM map_cluster;")
+                    cur.execute("DELETE FROM cpted_summary_output;")
+
+                cur.execute(_SQL_AGREGAR_RESUMO, {
+                    "celula_zoom0": map_cluster_cell_size(0),
+                    "zoom_max": config.MAP_CLUSTER_MAX_ZOOM,
+                })
+                novas = cur.fetchone()[0]
+                cur.execute(
+                    "UPDATE cpted_summary_state SET refreshed_at = now(), map_cell_px = %s, map_max_zoom = %s WHERE id;",
+                    grade,
+                )
+                conn.commit()
+                return novas
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao atualizar os agregados do dashboard: {error}")
+        return None
+
+def get_cpted_summary(indices: Optional[List[str]] = None,
+                      iluminacoes: Optional[List[str]] = None) -> Dict[str, Dict[str, int]]:
+    """
+    Lê os agregados do dashboard, opcionalmente filtrados por índice CPTED
+    geral e por nível de iluminação.
+
+    Retorna:
+        Um dicionário {dimensão: {valor: contagem}} para cada dimensão de
+        SUMMARY_DIMENSIONS (a dimensão "total" usa a chave "").
+    """
+    sql = """
+        SELECT dimension, value, sum(total) AS total
+        FROM cpted_summary
+        WHERE (%(indices)s::text[] IS NULL OR indice_cpted_geral = ANY(%(indices)s::text[]))
+          AND (%(iluminacoes)s::text[] IS NULL OR vigilancia_iluminacao = ANY(%(iluminacoes)s::text[]))
+        GROUP BY dimension, value;
+    """
+    resumo: Dict[str, Dict[str, int]] = {dimensao: {} for dimensao in SUMMARY_DIMENSIONS}
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, {
+                    "indices": list(indices) if indices is not None else None,
+                    "iluminacoes": list(iluminacoes) if iluminacoes is not None else None,
+                })
+                for dimensao, valor, total in cur.fetchall():
+                    resumo.setdefault(dimensao, {})[valor] = int(total)
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao ler os agregados do dashboard: {error}")
+    return resumo
+
+def get_latest_pipeline_outputs(limit: int = 100, indices: Optional[List[str]] = None,
+                                iluminacoes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Busca as análises mais recentes (opcionalmente filtradas), para exibição
+    de uma amostra dos dados brutos no dashboard.
+
+    Retorna:
+        Uma lista de dicionários com as linhas de pipeline_output.
+    """
+    sql = """
+        SELECT *
+        FROM pipeline_output
+        WHERE (%(indices)s::text[] IS NULL OR indice_cpted_geral = ANY(%(indices)s::text[]))
+          AND (%(iluminacoes)s::text[] IS NULL OR vigilancia_iluminacao = ANY(%(iluminacoes)s::text[]))
+        ORDER BY id DESC
+        LIMIT %(limit)s;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(sql, {
+                    "indices": list(indices) if indices is not None else None,
+                    "iluminacoes": list(iluminacoes) if iluminacoes is not None else None,
+                    "limit": limit,
+                })
+                return [dict(r) for r in cur.fetchall()]
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar as análises mais recentes: {error}")
+        return []
+
+
+# ==============================================================================
+# FATORES CPTED NORMALIZADOS
+# ==============================================================================
+
+def get_top_factors(field: str, top_n: int = 5,
+                    bbox: Optional[tuple] = None,
+                    start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Retorna os fatores mais frequentes de uma coluna de lista, contados no
+    banco, opcionalmente restritos a uma região e a uma janela de tempo.
+
+    Args:
+        field: Uma das colunas de COLUNAS_FATORES_CPTED (ex: 'recomendacoes').
+        top_n: Quantos fatores retornar.
+        bbox: (min_lon, min_lat, max_lon, max_lat) da região, ou None.
+        start, end: Janela de data_processamento (início inclusivo, fim exclusivo).
+
+    Retorna:
+        Uma lista de dicionários {factor_id, key, label, count}, do mais
+        frequente para o menos frequente.
+    """
+    if field not in COLUNAS_FATORES_CPTED:
+        raise ValueError(f"Coluna de fatores desconhecida: {field}")
+
+    juncoes = ""
+    filtros = ["f.field = %(field)s"]
+    params: Dict[str, Any] = {"field": field, "top_n": top_n}
+    if start is not None or end is not None or bbox is not None:
+        juncoes += " JOIN pipeline_output po ON po.id = pof.pipeline_output_id"
+    if start is not None:
+        filtros.append("po.data_processamento >= %(start)s")
+        params["start"] = start
+    if end is not None:
+        filtros.append("po.data_processamento < %(end)s")
+        params["end"] = end
+    if bbox is not None:
+        juncoes += " JOIN capture c ON c.id = po.capture_id"
+        # Mesma expressão do índice GiST idx_capture_geo
+        filtros.append('point(c."long", c.lat) <@ box(point(%(min_lon)s, %(min_lat)s), point(%(max_lon)s, %(max_lat)s))')
+        params.update(zip(("min_lon", "min_lat", "max_lon", "max_lat"), bbox))
+
+    sql = f"""
+        SELECT f.id AS factor_id, f.key, f.label, count(*) AS count
+        FROM pipeline_output_factor pof
+        JOIN cpted_factor f ON f.id = pof.factor_id
+        {juncoes}
+        WHERE {" AND ".join(filtros)}
+        GROUP BY f.id, f.key, f.label
+        ORDER BY count DESC, f.label
+        LIMIT %(top_n)s;
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(sql, params)
+                return [dict(r) for r in cur.fetchall()]
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao buscar os fatores mais comuns de '{field}': {error}")
+        return []
+
+def backfill_pipeline_output_factors(batch_size: int = 500) -> int:
+    """
+    Preenche pipeline_output_factor para as análises gravadas antes das
+    tabelas de fatores existirem, separando as colunas de lista já salvas.
+
+    Retorna:
+        O número de análises processadas.
+    """
+    colunas = ", ".join(COLUNAS_FATORES_CPTED)
+    sql = f"""
+        SELECT po.id, {colunas}
+        FROM pipeline_output po
+        WHERE po.id > %s
+          AND NOT EXISTS (SELECT 1 FROM pipeline_output_factor pof WHERE pof.pipeline_output_id = po.id)
+        ORDER BY po.id
+        LIMIT %s;
+    """
+    processadas = 0
+    ultimo_id = 0
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                while True:
+                    cur.execute(sql, (ultimo_id, batch_size))
+                    linhas = cur.fetchall()
+                    if not linhas:
+                        break
+                    for linha in linhas:
+                        _gravar_fatores(cur, linha["id"], linha)
+                    conn.commit()
+                    processadas += len(linhas)
+                    ultimo_id = linhas[-1]["id"]
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro ao preencher os fatores das análises existentes: {error}")
+    return processadas
+
+
+# ==============================================================================
+# INGESTÃO EM LOTE
+# ==============================================================================
+
+# Linhas por comando INSERT multi-linha (e por transação) na ingestão em lote
+BULK_CHUNK_SIZE = 1000
+
+def _em_blocos(itens: List[Any], tamanho: int) -> Iterator[List[Any]]:
+    for inicio in range(0, len(itens), tamanho):
+        yield itens[inicio:inicio + tamanho]
+
+def _reportar_falha_do_bloco(conn, cur, bloco: List[int], error: Exception,
+                             relatorio: List[Dict[str, Any]], inserir_bloco) -> None:
+    """
+    (Função auxiliar) Um bloco que falhou é refeito linha a linha, cada uma na
+    sua transação, para que só as linhas com problema sejam reportadas como erro.
+    """
+    if len(bloco) == 1:
+        relatorio[bloco[0]].update(status="error", error=str(error).strip())
+        return
+    for i in bloco:
+        inserir_bloco(conn, cur, [i])
+
+def add_captures_bulk(captures: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Insere várias capturas com INSERTs multi-linha, um bloco por transação.
+    Se um bloco falhar, ele é refeito linha a linha.
+
+    Args:
+        captures: Dicionários com user_app_id, url, date, lat e long.
+
+    Retorna:
+        Um relatório por linha de entrada, na mesma ordem, com as chaves
+        status ("inserted", "duplicate", "invalid" ou "error"), capture_id
+        (o ID novo ou o já existente, para duplicadas) e error.
+    """
+    relatorio: List[Dict[str, Any]] = [
+        {"status": "invalid", "capture_id": None, "error": None} for _ in captures
+    ]
+    pendentes = []
+    vistas = set()
+    for i, captura in enumerate(captures):
+        url = captura.get("url")
+        if not url:
+            relatorio[i]["error"] = "Captura sem URL."
+        elif url in vistas:
+            relatorio[i]["status"] = "duplicate"
+            relatorio[i]["error"] = "URL repetida no mesmo lote."
+        else:
+            vistas.add(url)
+            pendentes.append(i)
+
+    sql = """
+        INSERT INTO capture (user_app_id, url, date, lat, long) VALUES %s
+        ON CONFLICT (url) DO NOTHING
+        RETURNING id, url;
+    """
+    def inserir_bloco(conn, cur, bloco: List[int]) -> None:
+        valores = [
+            (captures[i].get("user_app_id"), captures[i]["url"], captures[i].get("date"),
+             captures[i].get("lat"), captures[i].get("long"))
+            for i in bloco
+        ]
+        try:
+            inseridas = dict(
+                (url, capture_id) for capture_id, url in
+                psycopg2.extras.execute_values(cur, sql, valores, page_size=BULK_CHUNK_SIZE, fetch=True)
+            )
+            # As que não voltaram no RETURNING já existiam (UNIQUE em url)
+            existentes = [captures[i]["url"] for i in bloco if captures[i]["url"] not in inseridas]
+            ids_existentes = {}
+            if existentes:
+                cur.execute("SELECT url, id FROM capture WHERE url = ANY(%s);", (existentes,))
+                ids_existentes = dict(cur.fetchall())
+            conn.commit()
+        except psycopg2.Error as error:
+            conn.rollback()
+            _reportar_falha_do_bloco(conn, cur, bloco, error, relatorio, inserir_bloco)
+            return
+        for i in bloco:
+            url = captures[i]["url"]
+            if url in inseridas:
+                relatorio[i].update(status="inserted", capture_id=inseridas[url])
             else:
-                print("Senha incorreta.")
-                return False
+                relatorio[i].update(status="duplicate", capture_id=ids_existentes.get(url),
+                                    error="A URL já foi capturada anteriormente.")
 
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                for bloco in _em_blocos(pendentes, BULK_CHUNK_SIZE):
+                    inserir_bloco(conn, cur, bloco)
     except (Exception, psycopg2.Error) as error:
-        print(f"Erro ao tentar fazer login: {error}")
-        return False
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        print(f"Erro na inserção de capturas em lote: {error}")
+        for linha in relatorio:
+            if linha["status"] == "invalid" and linha["error"] is None:
+                linha.update(status="error", error=str(error).strip())
+    return relatorio
+
+def add_pipeline_outputs_bulk(outputs: List[tuple]) -> List[Dict[str, Any]]:
+    """
+    Insere vários resultados do pipeline com INSERTs multi-linha, gravando
+    também os fatores normalizados de cada análise na mesma transação.
+    Se um bloco falhar, ele é refeito linha a linha.
+
+    Args:
+        outputs: Tuplas (capture_id, dados), onde dados é um dicionário no
+            formato de AnaliseCptedDoLocal ou o próprio objeto.
+
+    Retorna:
+        Um relatório por linha de entrada, na mesma ordem, com as chaves
+        status ("inserted", "duplicate", "invalid" ou "error"),
+        pipeline_output_id e error.
+    """
+    relatorio: List[Dict[str, Any]] = [
+        {"status": "invalid", "pipeline_output_id": None, "error": None} for _ in outputs
+    ]
+    pendentes = []
+    ids = {}
+    achatados = {}
+    vistas = set()
+    for i, (capture_id, dados) in enumerate(outputs):
+        try:
+            analise = validar_analise_cpted(dados)
+        except Exception as error:
+            relatorio[i]["error"] = f"Análise inválida: {error}"
+            continue
+        if capture_id is None:
+            relatorio[i]["error"] = "Resultado sem capture_id."
+            continue
+        try:
+            capture_id = int(capture_id)
+        except (TypeError, ValueError):
+            relatorio[i]["error"] = f"capture_id inválido: {capture_id!r}."
+            continue
+        if capture_id in vistas:
+            relatorio[i].update(status="duplicate", error="Captura repetida no mesmo lote.")
+        else:
+            vistas.add(capture_id)
+            ids[i] = capture_id
+            achatados[i] = achatar_analise_cpted(analise)
+            pendentes.append(i)
+
+    colunas = ", ".join(COLUNAS_ANALISE_ACHATADA)
+    sql = f"""
+        INSERT INTO pipeline_output (capture_id, {colunas}) VALUES %s
+        ON CONFLICT (capture_id) DO NOTHING
+        RETURNING id, capture_id;
+    """
+    houve_insercao = False
+
+    def inserir_bloco(conn, cur, bloco: List[int]) -> None:
+        nonlocal houve_insercao
+        valores = [
+            (ids[i],) + tuple(achatados[i][coluna] for coluna in COLUNAS_ANALISE_ACHATADA)
+            for i in bloco
+        ]
+        try:
+            inseridos = dict(
+                (capture_id, output_id) for output_id, capture_id in
+                psycopg2.extras.execute_values(cur, sql, valores, page_size=BULK_CHUNK_SIZE, fetch=True)
+            )
+            _gravar_fatores_em_lote(cur, [
+                (inseridos[ids[i]], achatados[i]) for i in bloco if ids[i] in inseridos
+            ])
+            conn.commit()
+        except psycopg2.Error as error:
+            conn.rollback()
+            _reportar_falha_do_bloco(conn, cur, bloco, error, relatorio, inserir_bloco)
+            return
+        houve_insercao = houve_insercao or bool(inseridos)
+        for i in bloco:
+            output_id = inseridos.get(ids[i])
+            if output_id is not None:
+                relatorio[i].update(status="inserted", pipeline_output_id=output_id)
+            else:
+                relatorio[i].update(status="duplicate",
+                                    error="Já existe um resultado de pipeline para esta captura.")
+
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                for bloco in _em_blocos(pendentes, BULK_CHUNK_SIZE):
+                    inserir_bloco(conn, cur, bloco)
+    except (Exception, psycopg2.Error) as error:
+        print(f"Erro na inserção de resultados em lote: {error}")
+        for linha in relatorio:
+            if linha["status"] == "invalid" and linha["error"] is None:
+                linha.update(status="error", error=str(error).strip())
+    if houve_insercao:
+        _notify_pipeline_output_written()
+    return relatorio
+
+if __name__ == "__main__":
+    # Aplica as tabelas/índices auxiliares no banco configurado no .env
+    if init_db_schema():
+        print("Esquema auxiliar aplicado com sucesso.")
+        preenchidas = backfill_pipeline_output_factors()
+        if preenchidas:
+            # Os agregados do dashboard passam a contar pelos fatores normalizados
+            refresh_cpted_summary(rebuild=True)
+            print(f"Fatores preenchidos para {preenchidas} análise(s) existente(s).")
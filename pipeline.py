@@ -1,72 +1,387 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Tuple
 
 # Importa os criadores de cliente
-from src.shared.clients import get_kluster_client, get_genai_client
+from src.shared.clients import (
+    get_kluster_client, get_genai_client, get_kluster_async_client, get_genai_async_client
+)
 # Importa o serviço que gera descrição da imagem
-from src.image_to_text.service import generate_description_from_image
+from src.image_to_text.service import (
+    generate_description_from_image, generate_description_from_image_async, stream_description_from_image,
+    generate_descriptions_from_images
+)
 # Importa o agente que extrai informações da descrição
-from src.info_extraction.agent import extrair_dados_cpted
+from src.info_extraction.agent import (
+    extrair_dados_cpted, extrair_dados_cpted_async,
+    extrair_dados_cpted_da_imagem, extrair_dados_cpted_da_imagem_async
+)
+from src import config
 
-def run_full_pipeline(image_url: str) -> dict | None:
+# Pergunta que guia o modelo de visão
+CPTED_QUESTION = (
+    "Act as an expert in CPTED (Crime Prevention Through Environmental Design). "
+    "Analyze the following image of a location and extract the main insights. "
+    "Base your analysis on the theoretical concepts of surveillance, access "
+    "control/territoriality, maintenance, and support for legitimate activities."
+)
+
+
+class PipelineError(Exception):
+    """Falha em uma das etapas do pipeline; a mensagem identifica a etapa."""
+
+
+def _resolver_modo(mode: str | None) -> str:
+    """
+    (Função auxiliar) O modo pedido ou, sem ele, o PIPELINE_MODE configurado.
+    Lança ValueError se o modo não for um de PIPELINE_MODES.
+    """
+    modo = mode or config.PIPELINE_MODE
+    if modo not in config.PIPELINE_MODES:
+        raise ValueError(f"Modo de pipeline desconhecido: '{modo}'. Use um de {', '.join(config.PIPELINE_MODES)}.")
+    return modo
+
+
+def _inicializar_clientes(modo: str, assincronos: bool = False):
+    """
+    (Função auxiliar) Clientes usados pelo modo, como (kluster, genai), ou
+    None se faltar algum. O modo "fused" não usa o modelo de visão do Kluster.
+    """
+    if assincronos:
+        kluster_client = get_kluster_async_client() if modo == "two_stage" else None
+        genai_client = get_genai_async_client()
+    else:
+        kluster_client = get_kluster_client() if modo == "two_stage" else None
+        genai_client = get_genai_client()
+    if not genai_client or (modo == "two_stage" and not kluster_client):
+        return None
+    return kluster_client, genai_client
+
+
+def _executar_etapas(image_url: str, kluster_client, genai_client, verbose: bool = False,
+                     lat: float | None = None, lon: float | None = None, mode: str = "two_stage") -> dict:
+    """
+    (Função auxiliar) Executa as etapas do pipeline para uma imagem, com
+    clientes já inicializados. Lança PipelineError se uma etapa falhar.
+    """
+    if mode == "fused":
+        if verbose:
+            print("\n[ETAPA ÚNICA] Extraindo dados estruturados direto da imagem...")
+        analise_cpted_obj = extrair_dados_cpted_da_imagem(image_url, genai_client, lat, lon)
+        if not analise_cpted_obj:
+            raise PipelineError("Falha ao extrair dados estruturados da imagem.")
+        if verbose:
+            print("Dados estruturados extraídos com sucesso!")
+        return analise_cpted_obj.model_dump()
+
+    # --- ETAPA 1: Imagem para Texto ---
+    if verbose:
+        print("\n[ETAPA 1/2] Gerando descrição da imagem...")
+
+    description = generate_description_from_image(
+        client=kluster_client,
+        image_url=image_url,
+        question=CPTED_QUESTION,
+        lat=lat,
+        lon=lon,
+    )
+
+    if not description:
+        raise PipelineError("Falha ao gerar a descrição da imagem.")
+
+    if verbose:
+        print("Descrição da imagem gerada com sucesso.")
+        # print(f"Descrição parcial: '{description[:100]}...'") # Descomente para depurar
+
+    # --- ETAPA 2: Extração de Informação ---
+    if verbose:
+        print("\n[ETAPA 2/2] Extraindo dados estruturados da descrição...")
+
+    # A função `extrair_dados_cpted` já retorna um objeto Pydantic
+    analise_cpted_obj = extrair_dados_cpted(description, genai_client)
+
+    if not analise_cpted_obj:
+        raise PipelineError("Falha ao extrair dados estruturados.")
+
+    if verbose:
+        print("Dados estruturados extraídos com sucesso!")
+
+    # Retorna o objeto Pydantic como um dicionário Python
+    return analise_cpted_obj.model_dump()
+
+
+def run_full_pipeline(image_url: str, lat: float | None = None, lon: float | None = None,
+                      mode: str | None = None) -> dict | None:
     """
     Executa o pipeline completo: de URL de imagem a dados estruturados CPTED.
 
     Args:
         image_url: A URL da imagem a ser analisada.
+        lat, lon: As coordenadas da captura (opcionais), comparadas com o GPS
+            da foto quando o pré-processamento de imagens está ativo.
+        mode: "two_stage" (descrição + extração) ou "fused" (uma só chamada
+            com a imagem). Sem ele, usa PIPELINE_MODE.
 
     Returns:
         Um dicionário com os dados extraídos ou None em caso de falha.
     """
-    print("--- INICIANDO PIPELINE DE ANÁLISE CPTED ---")
+    try:
+        modo = _resolver_modo(mode)
+    except ValueError as e:
+        print(f"ERRO: {e}")
+        return None
+    print(f"--- INICIANDO PIPELINE DE ANÁLISE CPTED (modo {modo}) ---")
 
     # --- Inicialização dos Clientes ---
     print("Inicializando clientes de API...")
-    kluster_client = get_kluster_client()
-    genai_client = get_genai_client()
-
-    if not all([kluster_client, genai_client]):
+    clientes = _inicializar_clientes(modo)
+    if clientes is None:
         print("ERRO: Falha ao inicializar um ou mais clientes de API. Verifique suas chaves no arquivo .env")
         return None
+    kluster_client, genai_client = clientes
     print("Clientes inicializados com sucesso.")
 
-    # --- ETAPA 1: Imagem para Texto ---
-    print("\n[ETAPA 1/2] Gerando descrição da imagem...")
-    
-    # Pergunta que guia o modelo de visão
-    cpted_question = (
-        "Act as an expert in CPTED (Crime Prevention Through Environmental Design). "
-        "Analyze the following image of a location and extract the main insights. "
-        "Base your analysis on the theoretical concepts of surveillance, access "
-        "control/territoriality, maintenance, and support for legitimate activities."
-    )
+    try:
+        return _executar_etapas(image_url, kluster_client, genai_client, verbose=True, lat=lat, lon=lon, mode=modo)
+    except PipelineError as e:
+        print(f"ERRO: {e} Pipeline interrompido.")
+        return None
 
-    description = generate_description_from_image(
+
+async def run_full_pipeline_async(image_url: str, lat: float | None = None, lon: float | None = None,
+                                  mode: str | None = None) -> dict | None:
+    """
+    Versão assíncrona de `run_full_pipeline`, usada pelo worker assíncrono:
+    enquanto uma imagem espera os modelos, o event loop atende as outras.
+
+    Args:
+        image_url: A URL da imagem a ser analisada.
+        lat, lon: As coordenadas da captura (opcionais).
+        mode: "two_stage" ou "fused" (padrão: PIPELINE_MODE).
+
+    Returns:
+        Um dicionário com os dados extraídos ou None em caso de falha.
+    """
+    try:
+        modo = _resolver_modo(mode)
+    except ValueError as e:
+        print(f"ERRO: {e}")
+        return None
+    clientes = _inicializar_clientes(modo, assincronos=True)
+    if clientes is None:
+        print("ERRO: Falha ao inicializar um ou mais clientes de API. Verifique suas chaves no arquivo .env")
+        return None
+    kluster_client, genai_client = clientes
+
+    if modo == "fused":
+        analise_cpted_obj = await extrair_dados_cpted_da_imagem_async(image_url, genai_client, lat, lon)
+        if not analise_cpted_obj:
+            print(f"ERRO: Falha ao extrair dados estruturados da imagem {image_url}.")
+            return None
+        return analise_cpted_obj.model_dump()
+
+    description = await generate_description_from_image_async(
         client=kluster_client,
         image_url=image_url,
-        question=cpted_question
+        question=CPTED_QUESTION,
+        lat=lat,
+        lon=lon,
     )
-
     if not description:
-        print("ERRO: Falha ao gerar a descrição da imagem. Pipeline interrompido.")
+        print(f"ERRO: Falha ao gerar a descrição da imagem {image_url}.")
         return None
-    
-    print("Descrição da imagem gerada com sucesso.")
-    # print(f"Descrição parcial: '{description[:100]}...'") # Descomente para depurar
 
-    # --- ETAPA 2: Extração de Informação ---
-    print("\n[ETAPA 2/2] Extraindo dados estruturados da descrição...")
+    analise_cpted_obj = await extrair_dados_cpted_async(description, genai_client)
+    if not analise_cpted_obj:
+        print(f"ERRO: Falha ao extrair dados estruturados da imagem {image_url}.")
+        return None
 
-    # A função `extrair_dados_cpted` já retorna um objeto Pydantic
-    analise_cpted_obj = extrair_dados_cpted(description, genai_client)
+    return analise_cpted_obj.model_dump()
+
+
+def run_full_pipeline_stream(image_url: str, lat: float | None = None, lon: float | None = None,
+                             mode: str | None = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Executa o pipeline emitindo eventos à medida que cada etapa avança,
+    para quem quer mostrar o progresso ao usuário (ver /send-photo/stream).
+
+    Yields:
+        Tuplas (evento, dados):
+        - ("description.delta", {"text": ...}): trecho da descrição recém-gerado.
+        - ("description", {"text": ...}): a descrição completa.
+        - ("analysis", {...}): os dados estruturados validados (último evento em caso de sucesso).
+        - ("error", {"stage": ..., "message": ...}): falha; nenhum evento vem depois.
+        No modo "fused" não há descrição: só "analysis" ou "error".
+    """
+    try:
+        modo = _resolver_modo(mode)
+    except ValueError as e:
+        yield "error", {"stage": "mode", "message": str(e)}
+        return
+    clientes = _inicializar_clientes(modo)
+    if clientes is None:
+        yield "error", {"stage": "clients", "message": "Falha ao inicializar um ou mais clientes de API."}
+        return
+    kluster_client, genai_client = clientes
 
+    if modo == "fused":
+        analise_cpted_obj = extrair_dados_cpted_da_imagem(image_url, genai_client, lat, lon)
+        if not analise_cpted_obj:
+            yield "error", {"stage": "analysis", "message": "Falha ao extrair dados estruturados da imagem."}
+            return
+        yield "analysis", analise_cpted_obj.model_dump()
+        return
+
+    trechos = stream_description_from_image(
+        client=kluster_client,
+        image_url=image_url,
+        question=CPTED_QUESTION,
+        lat=lat,
+        lon=lon,
+    )
+    while True:
+        try:
+            trecho = next(trechos)
+        except StopIteration as fim:
+            description = fim.value
+            break
+        yield "description.delta", {"text": trecho}
+
+    if not description:
+        yield "error", {"stage": "description", "message": "Falha ao gerar a descrição da imagem."}
+        return
+    yield "description", {"text": description}
+
+    analise_cpted_obj = extrair_dados_cpted(description, genai_client)
     if not analise_cpted_obj:
-        print("ERRO: Falha ao extrair dados estruturados. Pipeline interrompido.")
-        return None
+        yield "error", {"stage": "analysis", "message": "Falha ao extrair dados estruturados."}
+        return
+    yield "analysis", analise_cpted_obj.model_dump()
 
-    print("Dados estruturados extraídos com sucesso!")
 
-    # Retorna o objeto Pydantic como um dicionário Python
-    return analise_cpted_obj.model_dump()
+def run_pipeline_batch(image_urls: List[str], max_concurrency: int = 4,
+                       images_per_request: int | None = None, mode: str | None = None) -> Dict[str, Any]:
+    """
+    Executa o pipeline para várias imagens em paralelo, com concorrência limitada.
+
+    Cada imagem percorre as duas etapas em sequência, mas as esperas de rede
+    de imagens diferentes se sobrepõem: enquanto uma aguarda o modelo de visão,
+    outra pode estar na extração estruturada. Os clientes de API são criados
+    uma única vez e compartilhados entre as threads.
+
+    Com `images_per_request` > 1, as imagens são descritas em grupos, várias
+    por requisição ao modelo de visão (ver `generate_descriptions_from_images`),
+    e a extração de cada uma segue em paralelo assim que seu grupo termina.
+
+    Args:
+        image_urls: As URLs das imagens a serem analisadas.
+        max_concurrency: Número máximo de tarefas (imagens ou grupos) ao mesmo tempo.
+        images_per_request: Imagens por requisição ao modelo de visão
+            (padrão: KUSTER_IMAGES_PER_REQUEST; 1 descreve uma por vez).
+        mode: "two_stage" ou "fused" (padrão: PIPELINE_MODE). No modo
+            "fused" cada imagem é uma chamada e `images_per_request` é ignorado.
+
+    Returns:
+        Um dicionário com:
+        - "results": uma entrada por URL, na mesma ordem da entrada, com
+          "image_url", "ok", "result" (dados extraídos ou None),
+          "error" (mensagem ou None) e "duration_s".
+        - "stats": totais, duração e vazão (imagens por segundo).
+    """
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency deve ser maior ou igual a 1.")
+    images_per_request = config.KUSTER_IMAGES_PER_REQUEST if images_per_request is None else images_per_request
+    if images_per_request < 1:
+        raise ValueError("images_per_request deve ser maior ou igual a 1.")
+    modo = _resolver_modo(mode)
+    if modo == "fused":
+        images_per_request = 1
+
+    clientes = _inicializar_clientes(modo)
+    if clientes is None:
+        print("ERRO: Falha ao inicializar um ou mais clientes de API. Verifique suas chaves no arquivo .env")
+        return {"results": [], "stats": None}
+    kluster_client, genai_client = clientes
+
+    total = len(image_urls)
+    resultados: List[Dict[str, Any]] = [None] * total
+
+    def _processar(indice: int, image_url: str):
+        inicio_item = time.perf_counter()
+        try:
+            item = {"image_url": image_url, "ok": True,
+                    "result": _executar_etapas(image_url, kluster_client, genai_client, mode=modo), "error": None}
+        except Exception as e:
+            item = {"image_url": image_url, "ok": False, "result": None, "error": str(e)}
+        item["duration_s"] = round(time.perf_counter() - inicio_item, 3)
+        return indice, item
+
+    def _descrever_grupo(indices: List[int]):
+        inicio_item = time.perf_counter()
+        descricoes = generate_descriptions_from_images(
+            kluster_client, [image_urls[i] for i in indices], CPTED_QUESTION, images_per_request
+        )
+        return [(i, descricao, inicio_item) for i, descricao in zip(indices, descricoes)]
+
+    def _extrair(indice: int, description: str | None, inicio_item: float):
+        image_url = image_urls[indice]
+        try:
+            if not description:
+                raise PipelineError("Falha ao gerar a descrição da imagem.")
+            analise_cpted_obj = extrair_dados_cpted(description, genai_client)
+            if not analise_cpted_obj:
+                raise PipelineError("Falha ao extrair dados estruturados.")
+            item = {"image_url": image_url, "ok": True, "result": analise_cpted_obj.model_dump(), "error": None}
+        except Exception as e:
+            item = {"image_url": image_url, "ok": False, "result": None, "error": str(e)}
+        item["duration_s"] = round(time.perf_counter() - inicio_item, 3)
+        return indice, item
+
+    print(f"--- INICIANDO PIPELINE EM LOTE: {total} imagens, modo {modo}, concorrência {max_concurrency}, "
+          f"{images_per_request} imagem(ns) por requisição de visão ---")
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        if images_per_request == 1:
+            futuros = [executor.submit(_processar, i, url) for i, url in enumerate(image_urls)]
+        else:
+            grupos = [list(range(i, min(i + images_per_request, total))) for i in range(0, total, images_per_request)]
+            futuros = []
+            por_grupo = {executor.submit(_descrever_grupo, g): g for g in grupos}
+            for futuro_grupo in as_completed(por_grupo):
+                try:
+                    descritas = futuro_grupo.result()
+                except Exception as e:
+                    # Só as imagens deste grupo falham; o resto do lote continua
+                    print(f"ERRO ao descrever um grupo de imagens: {e}")
+                    for indice in por_grupo[futuro_grupo]:
+                        resultados[indice] = {"image_url": image_urls[indice], "ok": False, "result": None,
+                                              "error": f"Falha ao descrever o grupo de imagens: {e}",
+                                              "duration_s": round(time.perf_counter() - inicio, 3)}
+                    continue
+                for indice, descricao, inicio_item in descritas:
+                    futuros.append(executor.submit(_extrair, indice, descricao, inicio_item))
+        for concluidos, futuro in enumerate(as_completed(futuros), 1):
+            indice, item = futuro.result()
+            resultados[indice] = item
+            situacao = "ok" if item["ok"] else f"falhou: {item['error']}"
+            print(f"[{concluidos}/{total}] {item['image_url']} ({item['duration_s']}s) {situacao}")
+    duracao = time.perf_counter() - inicio
+
+    sucessos = sum(1 for item in resultados if item["ok"])
+    stats = {
+        "total": total,
+        "succeeded": sucessos,
+        "failed": total - sucessos,
+        "mode": modo,
+        "max_concurrency": max_concurrency,
+        "images_per_request": images_per_request,
+        "duration_s": round(duracao, 3),
+        "throughput_per_s": round(total / duracao, 3) if duracao > 0 else None,
+    }
+    print(f"Lote concluído: {sucessos}/{total} com sucesso em {stats['duration_s']}s "
+          f"({stats['throughput_per_s']} imagens/s).")
+    return {"results": resultados, "stats": stats}
 
 
 if __name__ == "__main__":
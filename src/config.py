@@ -5,9 +5,146 @@ load_dotenv()
 
 # --- Configs do Serviço Image-to-Text (Kluster) ---
 KUSTER_API_KEY = os.getenv("KUSTER_API_KEY")
-KUSTER_BASE_URL = "https://api.kluster.ai/v1"
+KUSTER_BASE_URL = os.getenv("KUSTER_BASE_URL", "https://api.kluster.ai/v1")
 KUSTER_MODEL_NAME = "Qwen/Qwen2.5-VL-7B-Instruct"
+# Imagens enviadas juntas em uma requisição por `generate_descriptions_from_images`
+# (usado por run_pipeline_batch); 1 (padrão) desliga o envio em lote.
+KUSTER_IMAGES_PER_REQUEST = int(os.getenv("KUSTER_IMAGES_PER_REQUEST", "1"))
 
 # --- Configs do Serviço Info-Extraction (Google GenAI) ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-GOOGLE_MODEL_NAME = "gemini-1.5-flash"
\ No newline at end of file
+GOOGLE_MODEL_NAME = "gemini-1.5-flash"
+# Vazio usa o endpoint padrão do SDK (útil para apontar para um servidor local de testes)
+GOOGLE_BASE_URL = os.getenv("GOOGLE_BASE_URL") or None
+
+# --- Configs do Modo do Pipeline ---
+# "two_stage": o modelo de visão (Kluster) descreve a imagem e o GenAI extrai
+# o AnaliseCptedDoLocal da descrição (duas chamadas em sequência).
+# "fused": o GenAI recebe a imagem e devolve o AnaliseCptedDoLocal direto,
+# em uma só chamada. Cada envio pode escolher o modo (campo "pipeline_mode").
+PIPELINE_MODES = ("two_stage", "fused")
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "two_stage")
+
+# --- Configs do Pool de Conexões (PostgreSQL) ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_IDLE_TIMEOUT_S = float(os.getenv("DB_POOL_IDLE_TIMEOUT_S", "300"))
+DB_POOL_CHECKOUT_TIMEOUT_S = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT_S", "10"))
+DB_POOL_HEALTH_CHECK_INTERVAL_S = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL_S", "30"))
+
+# --- Configs da Fila de Jobs do Pipeline ---
+# "thread": o próprio processo da API processa os jobs em threads de background.
+# "external": a API só enfileira; um worker separado (`python -m src.jobs.worker`)
+# processa os jobs. Em ambientes serverless (ex: Vercel) nada mantém as threads
+# vivas depois da resposta, então lá o modo é sempre "external".
+SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+JOB_WORKER_MODE = os.getenv("JOB_WORKER_MODE", "external" if SERVERLESS else "thread")
+if SERVERLESS and JOB_WORKER_MODE == "thread":
+    print("Aviso: JOB_WORKER_MODE=thread não é suportado em ambiente serverless; usando 'external'.")
+    JOB_WORKER_MODE = "external"
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "2"))
+JOB_POLL_INTERVAL_S = float(os.getenv("JOB_POLL_INTERVAL_S", "2"))
+JOB_STALE_AFTER_S = float(os.getenv("JOB_STALE_AFTER_S", "600"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Espera antes de tentar de novo um job que falhou (dobra a cada tentativa)
+JOB_RETRY_BACKOFF_S = float(os.getenv("JOB_RETRY_BACKOFF_S", "30"))
+# Jobs processados ao mesmo tempo pelo worker assíncrono (`python -m src.jobs.worker --async`)
+JOB_WORKER_ASYNC_CONCURRENCY = int(os.getenv("JOB_WORKER_ASYNC_CONCURRENCY", "100"))
+
+# --- Configs dos Clientes HTTP das APIs de Modelos ---
+# Os clientes são criados uma vez por processo e reutilizam conexões (keep-alive).
+# *_TIMEOUT_S limita cada tentativa; *_DEADLINE_S limita a chamada inteira,
+# somando as novas tentativas (*_MAX_RETRIES) e as esperas entre elas.
+KUSTER_TIMEOUT_S = float(os.getenv("KUSTER_TIMEOUT_S", "60"))
+KUSTER_DEADLINE_S = float(os.getenv("KUSTER_DEADLINE_S", "120"))
+KUSTER_MAX_RETRIES = int(os.getenv("KUSTER_MAX_RETRIES", "2"))
+GOOGLE_TIMEOUT_S = float(os.getenv("GOOGLE_TIMEOUT_S", "60"))
+GOOGLE_DEADLINE_S = float(os.getenv("GOOGLE_DEADLINE_S", "120"))
+GOOGLE_MAX_RETRIES = int(os.getenv("GOOGLE_MAX_RETRIES", "2"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY_S = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_S", "30"))
+
+# --- Configs de Resiliência das Chamadas aos Modelos ---
+# Espera antes da n-ésima nova tentativa: aleatória entre 0 e
+# min(RETRY_BACKOFF_MAX_S, RETRY_BACKOFF_BASE_S * 2^n), ou o Retry-After do provedor.
+RETRY_BACKOFF_BASE_S = float(os.getenv("RETRY_BACKOFF_BASE_S", "0.5"))
+RETRY_BACKOFF_MAX_S = float(os.getenv("RETRY_BACKOFF_MAX_S", "8"))
+# Falhas transitórias seguidas que abrem o circuito de um provedor e por
+# quanto tempo ele recusa chamadas antes de deixar passar uma chamada de teste
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT_S = float(os.getenv("CIRCUIT_RESET_TIMEOUT_S", "30"))
+
+# --- Configs dos Limites de Uso das APIs de Modelos ---
+# Requisições e tokens por minuto e chamadas simultâneas por provedor, em cada
+# processo (0 = sem limite). Acima do limite as chamadas esperam na fila.
+# Com vários processos, divida a cota do provedor entre eles.
+KUSTER_RPM = float(os.getenv("KUSTER_RPM", "0"))
+KUSTER_TPM = float(os.getenv("KUSTER_TPM", "0"))
+KUSTER_MAX_IN_FLIGHT = int(os.getenv("KUSTER_MAX_IN_FLIGHT", "16"))
+GOOGLE_RPM = float(os.getenv("GOOGLE_RPM", "0"))
+GOOGLE_TPM = float(os.getenv("GOOGLE_TPM", "0"))
+GOOGLE_MAX_IN_FLIGHT = int(os.getenv("GOOGLE_MAX_IN_FLIGHT", "16"))
+# Tokens reservados por chamada antes de saber o uso real (corrigido depois
+# com o `usage` da resposta): imagem + pergunta + descrição no Kluster e
+# a resposta estruturada no GenAI (o prompt é estimado pelo tamanho do texto).
+KUSTER_ESTIMATED_TOKENS_PER_CALL = int(os.getenv("KUSTER_ESTIMATED_TOKENS_PER_CALL", "1500"))
+GOOGLE_ESTIMATED_OUTPUT_TOKENS = int(os.getenv("GOOGLE_ESTIMATED_OUTPUT_TOKENS", "800"))
+# Tokens de entrada de uma imagem no GenAI (modo "fused")
+GOOGLE_ESTIMATED_IMAGE_TOKENS = int(os.getenv("GOOGLE_ESTIMATED_IMAGE_TOKENS", "1000"))
+
+# --- Configs do Cache de Resultados dos Modelos ---
+# CACHE_BACKEND: "memory" (por processo), "sqlite" (em disco) ou "none".
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL_S = float(os.getenv("CACHE_TTL_S", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", ".cache/resultados_modelos.sqlite3")
+# IMAGE_CACHE_KEY_MODE: "url" usa a URL da imagem na chave; "content" baixa a
+# imagem e usa o hash dos bytes (detecta a mesma foto enviada em URLs diferentes).
+IMAGE_CACHE_KEY_MODE = os.getenv("IMAGE_CACHE_KEY_MODE", "url")
+
+# --- Configs de Download de Imagens ---
+IMAGE_DOWNLOAD_TIMEOUT_S = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT_S", "20"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+# O servidor só baixa imagens destes esquemas e hosts (ou subdomínios deles),
+# inclusive nos redirecionamentos; as URLs vêm dos clientes da API.
+IMAGE_ALLOWED_SCHEMES = [s.strip().lower() for s in os.getenv("IMAGE_ALLOWED_SCHEMES", "https").split(",") if s.strip()]
+IMAGE_ALLOWED_HOSTS = [h.strip().lower() for h in os.getenv("IMAGE_ALLOWED_HOSTS", "imgur.com").split(",") if h.strip()]
+IMAGE_MAX_REDIRECTS = int(os.getenv("IMAGE_MAX_REDIRECTS", "3"))
+# Imagens baixadas ficam em memória por pouco tempo, para que as etapas de um
+# mesmo job (deduplicação, pré-processamento, hash) não as baixem de novo.
+IMAGE_DOWNLOAD_CACHE_TTL_S = float(os.getenv("IMAGE_DOWNLOAD_CACHE_TTL_S", "300"))
+IMAGE_DOWNLOAD_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_DOWNLOAD_CACHE_MAX_ENTRIES", "16"))
+
+# --- Configs do Pré-processamento de Imagens (requer Pillow) ---
+# Com IMAGE_PREPROCESS_ENABLED, a imagem é baixada uma vez, reduzida para no
+# máximo IMAGE_PREPROCESS_MAX_DIM pixels no maior lado, regravada como JPEG
+# sem EXIF e enviada ao modelo de visão como data URI (em vez da URL original).
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "false").lower() == "true"
+IMAGE_PREPROCESS_MAX_DIM = int(os.getenv("IMAGE_PREPROCESS_MAX_DIM", "1024"))
+IMAGE_PREPROCESS_JPEG_QUALITY = int(os.getenv("IMAGE_PREPROCESS_JPEG_QUALITY", "80"))
+# Imagens já processadas guardadas em memória (por hash do conteúdo original)
+IMAGE_PREPROCESS_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_PREPROCESS_CACHE_MAX_ENTRIES", "256"))
+# Distância máxima entre o GPS do EXIF e o lat/long da captura antes de avisar
+IMAGE_GPS_MAX_MISMATCH_M = float(os.getenv("IMAGE_GPS_MAX_MISMATCH_M", "500"))
+
+# --- Configs da Detecção de Fotos Quase Duplicadas (requer Pillow) ---
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "false").lower() == "true"
+NEAR_DUPLICATE_RADIUS_M = float(os.getenv("NEAR_DUPLICATE_RADIUS_M", "50"))
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+NEAR_DUPLICATE_WINDOW_DAYS = float(os.getenv("NEAR_DUPLICATE_WINDOW_DAYS", "30"))
+
+# --- Configs da Paginação de /user_photos ---
+USER_PHOTOS_DEFAULT_LIMIT = int(os.getenv("USER_PHOTOS_DEFAULT_LIMIT", "50"))
+USER_PHOTOS_MAX_LIMIT = int(os.getenv("USER_PHOTOS_MAX_LIMIT", "200"))
+
+# --- Configs do Mapa ---
+# Número máximo de pontos devolvidos por /map/features em uma única janela
+MAP_FEATURES_MAX = int(os.getenv("MAP_FEATURES_MAX", "5000"))
+# Abaixo deste zoom, /map/features devolve grupos em vez de pontos individuais
+MAP_CLUSTER_MAX_ZOOM = int(os.getenv("MAP_CLUSTER_MAX_ZOOM", "15"))
+# Tamanho da célula de agrupamento, em pixels de tela
+MAP_CLUSTER_CELL_PX = int(os.getenv("MAP_CLUSTER_CELL_PX", "64"))
+# Por quanto tempo a versão dos dados do mapa (última análise) é reaproveitada
+# antes de consultar o banco de novo
+MAP_VERSION_TTL_S = float(os.getenv("MAP_VERSION_TTL_S", "5"))
@@ -0,0 +1,93 @@
+import io
+import math
+from typing import Dict, Any, Optional
+
+import database_manager as db
+from src import config
+from src.shared.images import baixar_imagem, distancia_metros
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow é opcional: sem ele a detecção fica desativada
+    Image = None
+
+
+def calcular_phash(dados: bytes) -> int:
+    """
+    Calcula o hash perceptual (dHash de 64 bits) de uma imagem.
+
+    A imagem é reduzida para 9x8 pixels em tons de cinza e cada bit indica
+    se um pixel é mais claro que o vizinho da direita. Fotos parecidas
+    (recortes, compressão, pequenas mudanças de ângulo ou luz) geram hashes
+    com poucos bits diferentes.
+    """
+    if Image is None:
+        raise RuntimeError("Pillow não está instalado; o hash perceptual não está disponível.")
+    with Image.open(io.BytesIO(dados)) as imagem:
+        pixels = list(imagem.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    phash = 0
+    for linha in range(8):
+        for coluna in range(8):
+            esquerda = pixels[linha * 9 + coluna]
+            direita = pixels[linha * 9 + coluna + 1]
+            phash = (phash << 1) | (1 if esquerda > direita else 0)
+    return phash
+
+
+def distancia_hamming(a: int, b: int) -> int:
+    """Número de bits diferentes entre dois hashes de 64 bits."""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def _para_bigint(phash: int) -> int:
+    """Converte o hash sem sinal para o intervalo do BIGINT do Postgres."""
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+
+def encontrar_duplicata(capture_id: int, image_url: str, lat: Optional[float],
+                        lon: Optional[float]) -> Optional[Dict[str, Any]]:
+    """
+    Registra o hash perceptual da captura e procura, entre as capturas
+    recentes já analisadas num raio de NEAR_DUPLICATE_RADIUS_M metros, a
+    foto mais parecida com até NEAR_DUPLICATE_MAX_DISTANCE bits de diferença.
+
+    Args:
+        capture_id: O ID da captura recém-criada.
+        image_url: A URL da imagem da captura.
+        lat, lon: As coordenadas da captura.
+
+    Returns:
+        Um dicionário com "capture_id", "hamming" e "distance_m" da captura
+        original, ou None se não houver quase duplicata (ou em caso de erro).
+    """
+    if Image is None or lat is None or lon is None:
+        return None
+
+    try:
+        phash = calcular_phash(baixar_imagem(image_url))
+    except Exception as e:
+        print(f"Aviso: não foi possível calcular o hash perceptual da captura ID {capture_id}. {e}")
+        return None
+
+    db.add_capture_phash(capture_id, _para_bigint(phash))
+
+    lat, lon = float(lat), float(lon)
+    raio = config.NEAR_DUPLICATE_RADIUS_M
+    delta_lat = raio / 111320.0
+    delta_lon = raio / (111320.0 * max(math.cos(math.radians(lat)), 1e-6))
+    candidatos = db.find_phash_candidates(
+        capture_id, lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon,
+        config.NEAR_DUPLICATE_WINDOW_DAYS,
+    )
+
+    melhor = None
+    for candidato in candidatos:
+        hamming = distancia_hamming(phash, candidato["phash"])
+        if hamming > config.NEAR_DUPLICATE_MAX_DISTANCE:
+            continue
+        distancia = distancia_metros(lat, lon, float(candidato["lat"]), float(candidato["long"]))
+        if distancia > raio:
+            continue
+        if melhor is None or (hamming, distancia) < (melhor["hamming"], melhor["distance_m"]):
+            melhor = {"capture_id": candidato["capture_id"], "hamming": hamming, "distance_m": round(distancia, 1)}
+    return melhor
@@ -0,0 +1,169 @@
+import io
+import base64
+from typing import Any, Dict, Optional, Tuple
+
+from src import config
+from src.shared import metrics
+from src.shared.cache import MemoryCache
+from src.shared.images import baixar_imagem, hash_conteudo, distancia_metros, tipo_mime
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele as imagens vão pela URL original
+    Image = None
+
+# Tag do EXIF que aponta para o bloco de GPS
+_TAG_GPS_INFO = 0x8825
+
+_BYTES = metrics.counter(
+    "cpted_image_preprocess_bytes_total",
+    "Bytes das imagens antes (original) e depois (processed) do pré-processamento.",
+)
+_VERIFICACOES_GPS = metrics.counter(
+    "cpted_image_gps_checks_total",
+    "Comparações do GPS do EXIF com o lat/long da captura, por resultado.",
+)
+
+_processadas: Optional[MemoryCache] = None
+
+
+def _cache_processadas() -> MemoryCache:
+    """(Função auxiliar) Cache em memória das imagens já processadas."""
+    global _processadas
+    if _processadas is None:
+        _processadas = MemoryCache(config.CACHE_TTL_S, config.IMAGE_PREPROCESS_CACHE_MAX_ENTRIES)
+    return _processadas
+
+
+def _graus(valor, referencia: str) -> float:
+    """(Função auxiliar) Converte (graus, minutos, segundos) do EXIF em graus decimais."""
+    graus, minutos, segundos = (float(v) for v in valor)
+    decimal = graus + minutos / 60 + segundos / 3600
+    return -decimal if referencia in ("S", "W") else decimal
+
+
+def extrair_gps(imagem) -> Optional[Tuple[float, float]]:
+    """
+    Lê as coordenadas (lat, long) do EXIF de uma imagem do Pillow.
+    Retorna None se a foto não tiver GPS ou se ele estiver incompleto.
+    """
+    try:
+        gps = imagem.getexif().get_ifd(_TAG_GPS_INFO)
+        if not all(tag in gps for tag in (1, 2, 3, 4)):
+            return None
+        return _graus(gps[2], gps[1]), _graus(gps[4], gps[3])
+    except Exception:
+        return None
+
+
+def _processar(dados: bytes) -> Dict[str, Any]:
+    """
+    (Função auxiliar) Lê o GPS, aplica a rotação do EXIF, reduz a imagem e a
+    regrava como JPEG. A imagem regravada não leva o EXIF (nem o GPS).
+    """
+    with Image.open(io.BytesIO(dados)) as imagem:
+        gps = extrair_gps(imagem)
+        imagem = ImageOps.exif_transpose(imagem)
+        if imagem.mode != "RGB":
+            imagem = imagem.convert("RGB")
+        imagem.thumbnail((config.IMAGE_PREPROCESS_MAX_DIM, config.IMAGE_PREPROCESS_MAX_DIM), Image.LANCZOS)
+        saida = io.BytesIO()
+        imagem.save(saida, format="JPEG", quality=config.IMAGE_PREPROCESS_JPEG_QUALITY, optimize=True)
+    processada = saida.getvalue()
+    return {
+        "data_uri": "data:image/jpeg;base64," + base64.b64encode(processada).decode("ascii"),
+        "gps": gps,
+        "original_bytes": len(dados),
+        "processed_bytes": len(processada),
+    }
+
+
+def verificar_gps(gps: Optional[Tuple[float, float]], lat: Optional[float], lon: Optional[float]) -> Optional[float]:
+    """
+    Compara o GPS do EXIF com as coordenadas informadas na captura.
+
+    Returns:
+        A distância em metros entre os dois pontos, ou None se faltar algum deles.
+        Distâncias acima de IMAGE_GPS_MAX_MISMATCH_M geram um aviso.
+    """
+    if gps is None or lat is None or lon is None:
+        _VERIFICACOES_GPS.inc(result="missing")
+        return None
+    distancia = distancia_metros(gps[0], gps[1], float(lat), float(lon))
+    if distancia > config.IMAGE_GPS_MAX_MISMATCH_M:
+        _VERIFICACOES_GPS.inc(result="mismatch")
+        print(f"Aviso: o GPS da foto ({gps[0]:.5f}, {gps[1]:.5f}) está a {distancia:.0f} m "
+              f"do local informado na captura ({float(lat):.5f}, {float(lon):.5f}).")
+    else:
+        _VERIFICACOES_GPS.inc(result="match")
+    return distancia
+
+
+def preparar_imagem(image_url: str, lat: Optional[float] = None, lon: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Baixa a imagem uma vez e a prepara para o modelo de visão: reduzida para
+    IMAGE_PREPROCESS_MAX_DIM, regravada como JPEG (IMAGE_PREPROCESS_JPEG_QUALITY)
+    sem EXIF e codificada como data URI. O GPS do EXIF é lido antes de ser
+    removido e comparado com `lat`/`lon` da captura, quando informados.
+
+    O resultado fica em cache pelo hash do conteúdo original, então a mesma
+    foto não é processada de novo (mas ainda é baixada para calcular o hash).
+
+    Returns:
+        Um dicionário com "data_uri", "content_hash" (sha256 da imagem
+        original), "gps", "gps_distance_m", "original_bytes" e "processed_bytes".
+
+    Raises:
+        RuntimeError: se o Pillow não estiver instalado.
+        Exception: se o download ou a leitura da imagem falhar.
+    """
+    if Image is None:
+        raise RuntimeError("Pillow não está instalado; o pré-processamento de imagens não está disponível.")
+    return _preparar_dados(baixar_imagem(image_url), lat, lon)
+
+
+def _preparar_dados(dados: bytes, lat: Optional[float], lon: Optional[float]) -> Dict[str, Any]:
+    """(Função auxiliar) `preparar_imagem` para uma imagem já baixada."""
+    content_hash = hash_conteudo(dados)
+    cache = _cache_processadas()
+    chave = f"{content_hash}:{config.IMAGE_PREPROCESS_MAX_DIM}:{config.IMAGE_PREPROCESS_JPEG_QUALITY}"
+    preparada = cache.get(chave)
+    if preparada is None:
+        preparada = _processar(dados)
+        cache.set(chave, preparada)
+        _BYTES.inc(preparada["original_bytes"], kind="original")
+        _BYTES.inc(preparada["processed_bytes"], kind="processed")
+
+    return {
+        **preparada,
+        "content_hash": content_hash,
+        "gps_distance_m": verificar_gps(preparada["gps"], lat, lon),
+    }
+
+
+def carregar_imagem(image_url: str, lat: Optional[float] = None, lon: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Bytes da imagem para enviar ao modelo junto com o pedido (modo "fused"):
+    a versão pré-processada quando IMAGE_PREPROCESS_ENABLED (e o Pillow
+    estiver disponível) ou a imagem original.
+
+    Returns:
+        Um dicionário com "data", "mime_type" e "content_hash" (sha256 da
+        imagem original, usado nas chaves de cache).
+
+    Raises:
+        Exception: se o download da imagem falhar.
+    """
+    dados = baixar_imagem(image_url)
+    if config.IMAGE_PREPROCESS_ENABLED and Image is not None:
+        try:
+            preparada = _preparar_dados(dados, lat, lon)
+            cabecalho, conteudo = preparada["data_uri"].split(",", 1)
+            return {
+                "data": base64.b64decode(conteudo),
+                "mime_type": cabecalho[len("data:"):].split(";")[0],
+                "content_hash": preparada["content_hash"],
+            }
+        except Exception as e:
+            print(f"Aviso: não foi possível pré-processar a imagem; enviando a original. {e}")
+    return {"data": dados, "mime_type": tipo_mime(dados), "content_hash": hash_conteudo(dados)}
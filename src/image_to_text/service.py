@@ -1,5 +1,15 @@
-from openai import OpenAI
+import re
+import time
+import asyncio
+from typing import Dict, Generator, List
+from openai import OpenAI, AsyncOpenAI
 from src import config
+from src.shared.cache import get_cache, make_cache_key
+from src.shared.images import baixar_imagem, hash_conteudo
+from src.image_to_text.preprocessing import preparar_imagem
+from src.shared import metrics
+from src.shared.metrics import instrumented
+from src.shared.resilience import call_with_resilience, call_with_resilience_async, stream_with_resilience
 
 def _build_image_message(image_url: str, question: str) -> list:
   """
@@ -16,7 +26,85 @@ def _build_image_message(image_url: str, question: str) -> list:
     }
   ]
 
-def generate_description_from_image(client: OpenAI, image_url: str, question: str) -> str | None:
+# Instrução adicionada à pergunta quando várias imagens vão na mesma requisição
+BATCH_INSTRUCTIONS = (
+  "You will receive {n} images, each one preceded by a label 'IMAGE k' (k from 1 to {n}). "
+  "Answer the request above separately for each image, in order. Start each answer with a "
+  "line containing only '### IMAGE k' and do not refer to the other images inside an answer."
+)
+_MARCADOR_IMAGEM = re.compile(r"^[ \t]*#{1,6}[ \t]*IMAGE[ \t]+(\d+)[ \t]*:?[ \t]*$", re.IGNORECASE | re.MULTILINE)
+
+_FALLBACKS_LOTE = metrics.counter(
+  "cpted_vision_batch_fallbacks_total",
+  "Imagens de uma requisição em lote cuja resposta não pôde ser separada e foram reenviadas sozinhas.",
+)
+
+def _build_batch_message(image_urls: List[str], question: str) -> list:
+  """
+  (Função auxiliar) Constrói uma mensagem com várias imagens, cada uma
+  precedida pelo rótulo 'IMAGE k', para serem descritas em uma só chamada.
+  """
+  content = [{"type": "text", "text": f"{question}\n\n{BATCH_INSTRUCTIONS.format(n=len(image_urls))}"}]
+  for k, image_url in enumerate(image_urls, 1):
+    content.append({"type": "text", "text": f"IMAGE {k}"})
+    content.append({"type": "image_url", "image_url": {"url": image_url}})
+  return [{"role": "user", "content": content}]
+
+def _split_batch_response(text: str, n: int) -> Dict[int, str]:
+  """
+  (Função auxiliar) Separa a resposta de uma chamada em lote pelos marcadores
+  '### IMAGE k'. Retorna {k: descrição} só para as imagens com resposta não vazia
+  (marcadores repetidos ou fora de 1..n descartam a imagem).
+  """
+  marcadores = list(_MARCADOR_IMAGEM.finditer(text or ""))
+  partes: Dict[int, str] = {}
+  repetidos = set()
+  for i, marcador in enumerate(marcadores):
+    k = int(marcador.group(1))
+    fim = marcadores[i + 1].start() if i + 1 < len(marcadores) else len(text)
+    trecho = text[marcador.end():fim].strip()
+    if not 1 <= k <= n:
+      continue
+    if k in partes:
+      repetidos.add(k)
+    partes[k] = trecho
+  return {k: v for k, v in partes.items() if v and k not in repetidos}
+
+def _image_cache_key(image_url: str, question: str) -> str:
+  """
+  (Função auxiliar) Chave de cache da descrição: imagem + modelo + pergunta.
+  A imagem é identificada pela URL ou, com IMAGE_CACHE_KEY_MODE="content",
+  pelo hash dos seus bytes.
+  """
+  identificador = f"url:{image_url}"
+  if config.IMAGE_CACHE_KEY_MODE == "content" and not image_url.startswith("data:"):
+    try:
+      identificador = f"sha256:{hash_conteudo(baixar_imagem(image_url))}"
+    except Exception as e:
+      print(f"Aviso: não foi possível baixar a imagem para calcular o hash; usando a URL. {e}")
+  return make_cache_key("image_to_text", identificador, config.KUSTER_MODEL_NAME, question)
+
+def _preparar_envio(image_url: str, question: str, lat: float | None = None, lon: float | None = None):
+  """
+  (Função auxiliar) Retorna a imagem a enviar ao modelo e a chave de cache.
+  Com IMAGE_PREPROCESS_ENABLED, a imagem vai reduzida e sem EXIF como data URI
+  e a chave usa o hash do conteúdo, calculado no mesmo download. Se o
+  pré-processamento falhar, a URL original é enviada.
+  """
+  if config.IMAGE_PREPROCESS_ENABLED and not image_url.startswith("data:"):
+    try:
+      preparada = preparar_imagem(image_url, lat, lon)
+      cache_key = make_cache_key(
+        "image_to_text", f"sha256:{preparada['content_hash']}", config.KUSTER_MODEL_NAME, question
+      )
+      return preparada["data_uri"], cache_key
+    except Exception as e:
+      print(f"Aviso: não foi possível pré-processar a imagem; enviando a URL original. {e}")
+  return image_url, _image_cache_key(image_url, question)
+
+@instrumented("generate_description_from_image")
+def generate_description_from_image(client: OpenAI, image_url: str, question: str,
+                                    lat: float | None = None, lon: float | None = None) -> str | None:
   """
   Envia uma imagem e uma pergunta para a API da Kluster e retorna a descrição gerada.
 
@@ -24,22 +112,243 @@ def generate_description_from_image(client: OpenAI, image_url: str, question: st
       client (OpenAI): O cliente da API já inicializado.
       image_url (str): A URL da imagem a ser analisada.
       question (str): A pergunta ou instrução para o modelo.
+      lat, lon: As coordenadas da captura, comparadas com o GPS do EXIF
+          quando a imagem é pré-processada (IMAGE_PREPROCESS_ENABLED).
 
   Returns:
       A descrição em texto gerada pelo modelo, ou None em caso de erro.
+      Descrições já geradas para a mesma imagem/modelo/pergunta vêm do cache.
+  """
+  if not client:
+      print("Erro: Cliente da API não foi inicializado.")
+      return None
+
+  image_url, cache_key = _preparar_envio(image_url, question, lat, lon)
+  return _descrever_imagem(client, image_url, cache_key, question)
+
+def _descrever_imagem(client: OpenAI, image_url: str, cache_key: str, question: str) -> str | None:
+  """
+  (Função auxiliar) Chama o modelo de visão para uma imagem já preparada
+  (ver `_preparar_envio`), consultando e preenchendo o cache em `cache_key`.
+  """
+  cache = get_cache()
+  messages = _build_image_message(image_url, question)
+
+  try:
+    cached = cache.get(cache_key)
+    if cached is not None:
+      return cached
+
+    # Prazo por tentativa, novas tentativas com backoff, circuit breaker e limites de uso
+    completion = call_with_resilience(
+      "kluster",
+      lambda timeout_s: client.chat.completions.create(
+        model=config.KUSTER_MODEL_NAME,
+        messages=messages,
+        timeout=timeout_s,
+      ),
+      timeout_s=config.KUSTER_TIMEOUT_S,
+      deadline_s=config.KUSTER_DEADLINE_S,
+      max_retries=config.KUSTER_MAX_RETRIES,
+      estimated_tokens=config.KUSTER_ESTIMATED_TOKENS_PER_CALL,
+      usage=lambda c: c.usage.total_tokens if c.usage else None,
+    )
+    description = completion.choices[0].message.content
+    if description:
+      cache.set(cache_key, description)
+    return description
+  except Exception as e:
+    print(f"Ocorreu um erro ao chamar a API de imagem para texto: {e}")
+    return None
+
+@instrumented("generate_descriptions_from_images")
+def generate_descriptions_from_images(client: OpenAI, image_urls: List[str], question: str,
+                                      max_images_per_request: int | None = None) -> List[str | None]:
+  """
+  Descreve várias imagens com menos requisições: até `max_images_per_request`
+  imagens (padrão: KUSTER_IMAGES_PER_REQUEST) vão juntas em uma chamada, cada
+  uma com seu índice, e a resposta é separada de volta por imagem.
+
+  Imagens já descritas vêm do cache. As descrições geradas em lote são
+  gravadas numa chave própria (o prompt é outro), que a chamada individual
+  não lê; o lote aproveita também as descrições individuais. Se a resposta do
+  lote não trouxer a descrição de alguma imagem, ela é reenviada sozinha.
+
+  Returns:
+      Uma descrição (ou None em caso de erro) por URL, na mesma ordem da entrada.
+  """
+  if not client:
+      print("Erro: Cliente da API não foi inicializado.")
+      return [None] * len(image_urls)
+
+  tamanho_lote = max(1, max_images_per_request or config.KUSTER_IMAGES_PER_REQUEST)
+  cache = get_cache()
+  # Cada imagem é baixada (e pré-processada) uma só vez, inclusive para o reenvio sozinha
+  envios, chaves = [], []
+  for image_url in image_urls:
+    envio, chave = _preparar_envio(image_url, question)
+    envios.append(envio)
+    chaves.append(chave)
+  chaves_lote = [make_cache_key("image_to_text_batch", chave) for chave in chaves]
+  try:
+    descricoes: List[str | None] = [
+      cache.get(chave) or cache.get(chave_lote) for chave, chave_lote in zip(chaves, chaves_lote)
+    ]
+  except Exception as e:
+    print(f"Aviso: não foi possível consultar o cache de descrições; descrevendo todas as imagens. {e}")
+    descricoes = [None] * len(image_urls)
+  pendentes = [i for i, descricao in enumerate(descricoes) if descricao is None]
+
+  for inicio in range(0, len(pendentes), tamanho_lote):
+    lote = pendentes[inicio:inicio + tamanho_lote]
+    if len(lote) == 1:
+      descricoes[lote[0]] = _descrever_imagem(client, envios[lote[0]], chaves[lote[0]], question)
+      continue
+
+    messages = _build_batch_message([envios[i] for i in lote], question)
+    partes: Dict[int, str] = {}
+    try:
+      completion = call_with_resilience(
+        "kluster",
+        lambda timeout_s: client.chat.completions.create(
+          model=config.KUSTER_MODEL_NAME,
+          messages=messages,
+          timeout=timeout_s,
+        ),
+        timeout_s=config.KUSTER_TIMEOUT_S,
+        deadline_s=config.KUSTER_DEADLINE_S,
+        max_retries=config.KUSTER_MAX_RETRIES,
+        estimated_tokens=config.KUSTER_ESTIMATED_TOKENS_PER_CALL * len(lote),
+        usage=lambda c: c.usage.total_tokens if c.usage else None,
+      )
+      partes = _split_batch_response(completion.choices[0].message.content, len(lote))
+    except Exception as e:
+      # A chamada falhou (não só a separação): reenviar as imagens uma a uma
+      # só multiplicaria as requisições a um provedor com problemas
+      print(f"Ocorreu um erro ao chamar a API de imagem para texto em lote: {e}")
+      continue
+
+    for k, i in enumerate(lote, 1):
+      if k in partes:
+        descricoes[i] = partes[k]
+        cache.set(chaves_lote[i], partes[k])
+        continue
+      # Resposta do lote sem esta imagem: reenvia sozinha
+      _FALLBACKS_LOTE.inc()
+      descricoes[i] = _descrever_imagem(client, envios[i], chaves[i], question)
+
+  return descricoes
+
+@instrumented("generate_description_from_image")
+async def generate_description_from_image_async(client: AsyncOpenAI, image_url: str, question: str,
+                                                lat: float | None = None, lon: float | None = None) -> str | None:
+  """
+  Versão assíncrona de `generate_description_from_image`, para o worker
+  assíncrono: usa o cliente AsyncOpenAI e não bloqueia o event loop.
   """
   if not client:
       print("Erro: Cliente da API não foi inicializado.")
       return None
 
+  cache = get_cache()
+  # O pré-processamento e IMAGE_CACHE_KEY_MODE="content" exigem baixar a imagem
+  image_url, cache_key = await asyncio.to_thread(_preparar_envio, image_url, question, lat, lon)
   messages = _build_image_message(image_url, question)
-  
+
   try:
-    completion = client.chat.completions.create(
-      model=config.KUSTER_MODEL_NAME,
-      messages=messages
+    cached = cache.get(cache_key)
+    if cached is not None:
+      return cached
+
+    completion = await call_with_resilience_async(
+      "kluster",
+      lambda timeout_s: client.chat.completions.create(
+        model=config.KUSTER_MODEL_NAME,
+        messages=messages,
+        timeout=timeout_s,
+      ),
+      timeout_s=config.KUSTER_TIMEOUT_S,
+      deadline_s=config.KUSTER_DEADLINE_S,
+      max_retries=config.KUSTER_MAX_RETRIES,
+      estimated_tokens=config.KUSTER_ESTIMATED_TOKENS_PER_CALL,
+      usage=lambda c: c.usage.total_tokens if c.usage else None,
     )
-    return completion.choices[0].message.content
+    description = completion.choices[0].message.content
+    if description:
+      cache.set(cache_key, description)
+    return description
   except Exception as e:
     print(f"Ocorreu um erro ao chamar a API de imagem para texto: {e}")
-    return None
\ No newline at end of file
+    return None
+
+def stream_description_from_image(client: OpenAI, image_url: str, question: str,
+                                  lat: float | None = None, lon: float | None = None) -> Generator[str, None, str | None]:
+  """
+  Versão de `generate_description_from_image` que devolve a descrição aos
+  poucos, à medida que o modelo gera os tokens (ver /send-photo/stream).
+
+  Yields:
+      Os trechos de texto recebidos do modelo.
+
+  Returns:
+      (valor de retorno do gerador) A descrição completa, ou None em caso de
+      erro. Uma descrição interrompida no meio não é cacheada nem devolvida.
+  """
+  if not client:
+      print("Erro: Cliente da API não foi inicializado.")
+      return None
+
+  cache = get_cache()
+  image_url, cache_key = _preparar_envio(image_url, question, lat, lon)
+  messages = _build_image_message(image_url, question)
+  inicio = time.perf_counter()
+  trechos = []
+  concluida = False
+  try:
+    cached = cache.get(cache_key)
+    if cached is not None:
+      trechos.append(cached)
+      concluida = True
+      yield cached
+      return cached
+
+    # Só a abertura do stream passa pelas novas tentativas: depois do
+    # primeiro trecho a descrição já começou a chegar ao cliente. A vaga no
+    # limitador fica ocupada até o stream terminar ou ser abandonado.
+    with stream_with_resilience(
+      "kluster",
+      lambda timeout_s: client.chat.completions.create(
+        model=config.KUSTER_MODEL_NAME,
+        messages=messages,
+        stream=True,
+        timeout=timeout_s,
+      ),
+      timeout_s=config.KUSTER_TIMEOUT_S,
+      deadline_s=config.KUSTER_DEADLINE_S,
+      max_retries=config.KUSTER_MAX_RETRIES,
+      estimated_tokens=config.KUSTER_ESTIMATED_TOKENS_PER_CALL,
+    ) as stream:
+      with stream:
+        for chunk in stream:
+          if not chunk.choices:
+            continue
+          escolha = chunk.choices[0]
+          if escolha.delta and escolha.delta.content:
+            trechos.append(escolha.delta.content)
+            yield escolha.delta.content
+          if escolha.finish_reason:
+            concluida = True
+  except Exception as e:
+    print(f"Ocorreu um erro ao chamar a API de imagem para texto: {e}")
+  finally:
+    # Mesmas métricas da etapa não transmitida (acertos no cache incluídos)
+    metrics.STAGE_DURATION.observe(time.perf_counter() - inicio, stage="generate_description_from_image")
+    metrics.STAGE_CALLS.inc(stage="generate_description_from_image")
+    if not (concluida and trechos):
+      metrics.STAGE_ERRORS.inc(stage="generate_description_from_image")
+
+  if not (concluida and trechos):
+    return None
+  description = "".join(trechos)
+  cache.set(cache_key, description)
+  return description
@@ -1,22 +1,107 @@
+import json
+import asyncio
 from .schemas import AnaliseCptedDoLocal
-from .prompts import construct_prompt_cpted
+from .prompts import construct_prompt_cpted, PROMPT_CPTED_IMAGEM
 from src import config
+from src.shared.cache import get_cache, make_cache_key, hash_text
+from src.shared.metrics import instrumented
+from src.image_to_text.preprocessing import carregar_imagem
+from src.shared.resilience import call_with_resilience, call_with_resilience_async
 
-def _get_model_structured_response(prompt: str, client, schema: dict):
-    """Função de baixo nível para chamar a API. O '_' indica uso interno."""
-    response = client.models.generate_content(
-        model=config.GOOGLE_MODEL_NAME, 
-        contents=prompt,
-        config={
-            "response_mime_type": "application/json",
-            "response_schema": schema,
-        },
+_schema_version = None
+
+def _get_schema_version() -> str:
+    """
+    Versão do contrato de extração: hash do schema Pydantic e do template do
+    prompt. Qualquer mudança em um dos dois invalida o cache automaticamente.
+    """
+    global _schema_version
+    if _schema_version is None:
+        _schema_version = make_cache_key(
+            AnaliseCptedDoLocal.model_json_schema(), construct_prompt_cpted("")
+        )
+    return _schema_version
+
+def _config_geracao(schema: dict, timeout_s: float) -> dict:
+    """(Função auxiliar) Configuração da chamada: resposta JSON no schema e timeout."""
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": schema,
+        # O SDK do GenAI recebe o timeout em milissegundos
+        "http_options": {"timeout": int(timeout_s * 1000)},
+    }
+
+def _politica_genai(prompt: str, imagem: dict | None = None) -> dict:
+    """(Função auxiliar) Prazo, novas tentativas e limites de uso das chamadas ao GenAI."""
+    return {
+        "timeout_s": config.GOOGLE_TIMEOUT_S,
+        "deadline_s": config.GOOGLE_DEADLINE_S,
+        "max_retries": config.GOOGLE_MAX_RETRIES,
+        # ~4 caracteres por token no prompt, mais a imagem e a resposta esperada
+        "estimated_tokens": len(prompt) // 4 + config.GOOGLE_ESTIMATED_OUTPUT_TOKENS
+                            + (config.GOOGLE_ESTIMATED_IMAGE_TOKENS if imagem else 0),
+        "usage": lambda r: r.usage_metadata.total_token_count if r.usage_metadata else None,
+    }
+
+def _conteudo(prompt: str, imagem: dict | None):
+    """(Função auxiliar) O prompt, precedido da imagem (ver `carregar_imagem`) quando houver."""
+    if imagem is None:
+        return prompt
+    return [{"inline_data": {"data": imagem["data"], "mime_type": imagem["mime_type"]}}, prompt]
+
+def _get_model_structured_response(prompt: str, client, schema: dict, imagem: dict | None = None):
+    """
+    Função de baixo nível para chamar a API. O '_' indica uso interno.
+    A chamada passa pelo prazo, novas tentativas, circuit breaker e limites
+    de uso de src.shared.resilience.
+    """
+    response = call_with_resilience(
+        "genai",
+        lambda timeout_s: client.models.generate_content(
+            model=config.GOOGLE_MODEL_NAME,
+            contents=_conteudo(prompt, imagem),
+            config=_config_geracao(schema, timeout_s),
+        ),
+        **_politica_genai(prompt, imagem),
     )
     # O SDK mais recente retorna o dicionário diretamente em .text, que é um JSON string
-    import json
     return json.loads(response.text)
 
+async def _get_model_structured_response_async(prompt: str, client, schema: dict, imagem: dict | None = None):
+    """Versão assíncrona de `_get_model_structured_response` (`client` é o `genai.Client.aio`)."""
+    response = await call_with_resilience_async(
+        "genai",
+        lambda timeout_s: client.models.generate_content(
+            model=config.GOOGLE_MODEL_NAME,
+            contents=_conteudo(prompt, imagem),
+            config=_config_geracao(schema, timeout_s),
+        ),
+        **_politica_genai(prompt, imagem),
+    )
+    return json.loads(response.text)
+
+def _chave_cache(descricao: str) -> str:
+    return make_cache_key(
+        "info_extraction", hash_text(descricao), config.GOOGLE_MODEL_NAME, _get_schema_version()
+    )
+
+def _chave_cache_imagem(content_hash: str) -> str:
+    return make_cache_key(
+        "info_extraction_image", content_hash, config.GOOGLE_MODEL_NAME,
+        _get_schema_version(), hash_text(PROMPT_CPTED_IMAGEM)
+    )
 
+def _ler_cache(cache, cache_key: str) -> AnaliseCptedDoLocal | None:
+    try:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return AnaliseCptedDoLocal.model_validate(cached)
+    except Exception as e:
+        print(f"Aviso: resultado em cache inválido ou indisponível, refazendo a extração. {e}")
+    return None
+
+
+@instrumented("extrair_dados_cpted")
 def extrair_dados_cpted(descricao: str, client) -> AnaliseCptedDoLocal | None:
     """
     Orquestra o processo de extração de dados estruturados de uma descrição.
@@ -27,11 +112,18 @@ def extrair_dados_cpted(descricao: str, client) -> AnaliseCptedDoLocal | None:
 
     Returns:
         Um objeto AnaliseCptedDoLocal validado ou None em caso de erro.
+        Descrições já processadas com o mesmo modelo/schema vêm do cache.
     """
     if not client:
         print("Erro: Cliente GenAI não inicializado.")
         return None
-        
+
+    cache = get_cache()
+    cache_key = _chave_cache(descricao)
+    cached = _ler_cache(cache, cache_key)
+    if cached is not None:
+        return cached
+
     try:
         # 1. Construir o prompt
         prompt = construct_prompt_cpted(descricao)
@@ -44,8 +136,114 @@ def extrair_dados_cpted(descricao: str, client) -> AnaliseCptedDoLocal | None:
         
         # 4. Validar e retornar o objeto Pydantic
         analise_validada = AnaliseCptedDoLocal.model_validate(resposta_bruta)
+        cache.set(cache_key, analise_validada.model_dump(mode="json"))
         return analise_validada
 
     except Exception as e:
         print(f"Falha ao extrair dados da descrição: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+@instrumented("extrair_dados_cpted")
+async def extrair_dados_cpted_async(descricao: str, client) -> AnaliseCptedDoLocal | None:
+    """
+    Versão assíncrona de `extrair_dados_cpted`, para o worker assíncrono.
+    `client` é a interface assíncrona do GenAI (ver `get_genai_async_client`).
+    """
+    if not client:
+        print("Erro: Cliente GenAI não inicializado.")
+        return None
+
+    cache = get_cache()
+    cache_key = _chave_cache(descricao)
+    cached = _ler_cache(cache, cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        prompt = construct_prompt_cpted(descricao)
+        schema_dict = AnaliseCptedDoLocal.model_json_schema()
+        resposta_bruta = await _get_model_structured_response_async(prompt, client, schema_dict)
+        analise_validada = AnaliseCptedDoLocal.model_validate(resposta_bruta)
+        cache.set(cache_key, analise_validada.model_dump(mode="json"))
+        return analise_validada
+
+    except Exception as e:
+        print(f"Falha ao extrair dados da descrição: {e}")
+        return None
+
+
+@instrumented("extrair_dados_cpted_da_imagem")
+def extrair_dados_cpted_da_imagem(image_url: str, client, lat: float | None = None,
+                                  lon: float | None = None) -> AnaliseCptedDoLocal | None:
+    """
+    Modo "fused" do pipeline: envia a imagem ao GenAI e recebe o
+    AnaliseCptedDoLocal em uma única chamada, sem a descrição intermediária.
+
+    Args:
+        image_url (str): A URL da imagem do local.
+        client: O cliente GenAI configurado.
+        lat, lon: As coordenadas da captura (usadas quando a imagem é pré-processada).
+
+    Returns:
+        Um objeto AnaliseCptedDoLocal validado ou None em caso de erro.
+        Imagens já analisadas (mesmo conteúdo, modelo e schema) vêm do cache.
+    """
+    if not client:
+        print("Erro: Cliente GenAI não inicializado.")
+        return None
+
+    try:
+        imagem = carregar_imagem(image_url, lat, lon)
+    except Exception as e:
+        print(f"Falha ao baixar a imagem para a extração: {e}")
+        return None
+
+    cache = get_cache()
+    cache_key = _chave_cache_imagem(imagem["content_hash"])
+    cached = _ler_cache(cache, cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        schema_dict = AnaliseCptedDoLocal.model_json_schema()
+        resposta_bruta = _get_model_structured_response(PROMPT_CPTED_IMAGEM, client, schema_dict, imagem)
+        analise_validada = AnaliseCptedDoLocal.model_validate(resposta_bruta)
+        cache.set(cache_key, analise_validada.model_dump(mode="json"))
+        return analise_validada
+
+    except Exception as e:
+        print(f"Falha ao extrair dados da imagem: {e}")
+        return None
+
+
+@instrumented("extrair_dados_cpted_da_imagem")
+async def extrair_dados_cpted_da_imagem_async(image_url: str, client, lat: float | None = None,
+                                              lon: float | None = None) -> AnaliseCptedDoLocal | None:
+    """Versão assíncrona de `extrair_dados_cpted_da_imagem`, para o worker assíncrono."""
+    if not client:
+        print("Erro: Cliente GenAI não inicializado.")
+        return None
+
+    try:
+        imagem = await asyncio.to_thread(carregar_imagem, image_url, lat, lon)
+    except Exception as e:
+        print(f"Falha ao baixar a imagem para a extração: {e}")
+        return None
+
+    cache = get_cache()
+    cache_key = _chave_cache_imagem(imagem["content_hash"])
+    cached = _ler_cache(cache, cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        schema_dict = AnaliseCptedDoLocal.model_json_schema()
+        resposta_bruta = await _get_model_structured_response_async(PROMPT_CPTED_IMAGEM, client, schema_dict, imagem)
+        analise_validada = AnaliseCptedDoLocal.model_validate(resposta_bruta)
+        cache.set(cache_key, analise_validada.model_dump(mode="json"))
+        return analise_validada
+
+    except Exception as e:
+        print(f"Falha ao extrair dados da imagem: {e}")
+        return None
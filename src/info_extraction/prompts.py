@@ -6,4 +6,12 @@ construct_prompt_cpted = (
 
     Descrição do Local:
     {descricao}
-    """)
\ No newline at end of file
+    """)
+
+# Prompt do modo "fused": a imagem vai na mesma chamada, no lugar da descrição
+PROMPT_CPTED_IMAGEM = """
+    Aja como um especialista em CPTED (Crime Prevention Through Environmental Design). Analise a imagem do local
+    enviada junto com este pedido e preencha o schema JSON com base nos princípios de CPTED. Fundamente sua análise
+    nos conceitos teóricos de vigilância, controle de acesso/territorialidade, manutenção (janelas quebradas) e
+    suporte a atividades, considerando apenas o que é visível na imagem.
+    """
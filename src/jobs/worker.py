@@ -0,0 +1,377 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(__file__, "../../../")))
+
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+import database_manager as db
+from src import config
+from src.shared import metrics
+
+# Fila em memória usada no modo "thread"
+_fila_local: "queue.Queue[int]" = queue.Queue()
+_threads: list = []
+_threads_lock = threading.Lock()
+
+_JOBS_EM_ANDAMENTO = metrics.gauge("cpted_pipeline_jobs_in_flight", "Jobs do pipeline sendo processados neste processo.")
+_JOBS_FINALIZADOS = metrics.counter("cpted_pipeline_jobs_total", "Jobs do pipeline finalizados, por resultado.")
+_DURACAO_JOB = metrics.histogram("cpted_pipeline_job_duration_seconds", "Duração do processamento de um job, em segundos.")
+_JOBS_EM_ANDAMENTO.set(0)
+
+
+def process_job(job: Dict[str, Any]) -> bool:
+    """
+    Processa um job registrando as métricas de jobs em andamento, duração e
+    resultado. Ver `_processar_job`.
+    """
+    _JOBS_EM_ANDAMENTO.inc()
+    inicio = time.perf_counter()
+    sucesso = False
+    try:
+        sucesso = _processar_job(job)
+        return sucesso
+    finally:
+        _JOBS_EM_ANDAMENTO.dec()
+        _DURACAO_JOB.observe(time.perf_counter() - inicio)
+        _JOBS_FINALIZADOS.inc(status="done" if sucesso else "failed")
+
+
+def _processar_job(job: Dict[str, Any]) -> bool:
+    """
+    Executa o pipeline para um job já reivindicado e grava o resultado.
+
+    Args:
+        job: O dicionário retornado por `db.claim_pipeline_job`.
+
+    Returns:
+        True se o job terminou com sucesso, False caso contrário.
+    """
+    # Importado aqui para que a API não carregue os SDKs dos modelos
+    # quando os jobs são processados por um worker externo.
+    from pipeline import run_full_pipeline
+
+    job_id = job["id"]
+    print(f"[job {job_id}] Processando captura ID {job['capture_id']} (tentativa {job['attempts']})...")
+
+    if _reaproveitar_duplicata(job):
+        return True
+
+    try:
+        resultado = run_full_pipeline(job["capture_url"], job.get("lat"), job.get("long"),
+                                      job.get("pipeline_mode"))
+    except Exception as e:
+        resultado = None
+        print(f"[job {job_id}] Erro inesperado no pipeline: {e}")
+
+    return _gravar_resultado(job, resultado)
+
+
+def process_job_stream(job: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Versão de `process_job` para /send-photo/stream: processa o job na própria
+    requisição, emitindo os eventos de `run_full_pipeline_stream` e, quando o
+    resultado é gravado, ("output", {"capture_id", "result"}).
+
+    Se quem consome os eventos parar antes do fim (ex: o cliente desconectou),
+    o job volta para a fila e é concluído por um worker.
+    """
+    from pipeline import run_full_pipeline_stream
+
+    job_id = job["id"]
+    _JOBS_EM_ANDAMENTO.inc()
+    inicio = time.perf_counter()
+    sucesso = False
+    terminou = False
+    try:
+        if _reaproveitar_duplicata(job):
+            sucesso = terminou = True
+            yield "output", {"capture_id": job["capture_id"],
+                             "result": db.get_pipeline_output_by_capture_id(job["capture_id"])}
+            return
+
+        resultado = None
+        try:
+            eventos = run_full_pipeline_stream(job["capture_url"], job.get("lat"), job.get("long"),
+                                               job.get("pipeline_mode"))
+            for evento, dados in eventos:
+                if evento == "analysis":
+                    resultado = dados
+                yield evento, dados
+        except Exception as e:
+            print(f"[job {job_id}] Erro inesperado no pipeline: {e}")
+            yield "error", {"stage": "pipeline", "message": "Erro inesperado no pipeline."}
+
+        sucesso = _gravar_resultado(job, resultado)
+        terminou = True
+        if sucesso:
+            yield "output", {"capture_id": job["capture_id"],
+                             "result": db.get_pipeline_output_by_capture_id(job["capture_id"])}
+        elif resultado:
+            yield "error", {"stage": "output", "message": "Falha ao gravar o resultado do pipeline."}
+    finally:
+        _JOBS_EM_ANDAMENTO.dec()
+        if terminou:
+            _DURACAO_JOB.observe(time.perf_counter() - inicio)
+            _JOBS_FINALIZADOS.inc(status="done" if sucesso else "failed")
+        else:
+            print(f"[job {job_id}] Transmissão interrompida; job devolvido à fila.")
+            if db.release_pipeline_job(job_id):
+                enqueue_job(job_id)
+
+
+def _reaproveitar_duplicata(job: Dict[str, Any]) -> bool:
+    """
+    Fotos quase idênticas de um local próximo reaproveitam a análise existente.
+    Retorna True se o job foi concluído assim.
+    """
+    if not config.NEAR_DUPLICATE_ENABLED:
+        return False
+    from src.deduplication.service import encontrar_duplicata
+    job_id = job["id"]
+    duplicata = encontrar_duplicata(job["capture_id"], job["capture_url"], job.get("lat"), job.get("long"))
+    if not duplicata:
+        return False
+    output_id = db.link_capture_to_existing_output(job["capture_id"], duplicata["capture_id"], job_id=job_id)
+    if output_id is None:
+        return False
+    db.refresh_cpted_summary()
+    print(f"[job {job_id}] Quase duplicata da captura ID {duplicata['capture_id']} "
+          f"({duplicata['hamming']} bits, {duplicata['distance_m']} m). Análise reaproveitada.")
+    return True
+
+
+def _gravar_resultado(job: Dict[str, Any], resultado: Optional[dict]) -> bool:
+    """Grava o resultado do pipeline e conclui o job (ou o marca como falho)."""
+    job_id = job["id"]
+    if not resultado:
+        _registrar_falha(job_id, "O pipeline não produziu um resultado.")
+        return False
+
+    # Resultado e conclusão do job são gravados juntos
+    output_id = db.complete_pipeline_job(job_id, job["capture_id"], resultado)
+    if output_id is None:
+        _registrar_falha(job_id, "Falha ao gravar o resultado do pipeline.")
+        return False
+
+    # Soma a nova análise aos agregados do dashboard
+    db.refresh_cpted_summary()
+    print(f"[job {job_id}] Concluído. pipeline_output ID {output_id}.")
+    return True
+
+
+def _registrar_falha(job_id: int, erro: str) -> None:
+    """
+    Marca a falha do job. Enquanto houver tentativas (JOB_MAX_ATTEMPTS) ele
+    volta para a fila após JOB_RETRY_BACKOFF_S segundos (dobrando a cada
+    tentativa); workers externos o reivindicam sozinhos, e no modo "thread"
+    ele é reagendado aqui.
+    """
+    espera = db.fail_pipeline_job(job_id, erro, max_attempts=config.JOB_MAX_ATTEMPTS,
+                                  retry_backoff_s=config.JOB_RETRY_BACKOFF_S)
+    if espera is None:
+        print(f"[job {job_id}] Falhou: {erro}")
+        return
+    print(f"[job {job_id}] Falhou: {erro} Nova tentativa em {espera:.0f}s.")
+    if config.JOB_WORKER_MODE == "thread":
+        # Uma pequena folga garante que a espera já passou no relógio do banco
+        timer = threading.Timer(espera + 1, enqueue_job, args=(job_id,))
+        timer.daemon = True
+        timer.start()
+
+
+def _espera_provedores(poll_interval: float) -> float:
+    """
+    Enquanto o circuito de algum provedor de modelo estiver aberto, não
+    reivindica novos jobs: eles ficam pendentes no banco em vez de falhar na
+    hora e gastar tentativas. Retorna quanto esperar (0 se estão disponíveis).
+    """
+    from src.shared.resilience import open_circuits, get_breaker
+
+    abertos = open_circuits()
+    if not abertos:
+        return 0.0
+    espera = max(poll_interval, min(get_breaker(nome).retry_after_s() for nome in abertos))
+    print(f"Provedores indisponíveis ({', '.join(abertos)}); aguardando {espera:.0f}s antes do próximo job.")
+    return espera
+
+
+def _aguardar_provedores(poll_interval: float) -> None:
+    espera = _espera_provedores(poll_interval)
+    while espera:
+        time.sleep(espera)
+        espera = _espera_provedores(poll_interval)
+
+
+def _loop_thread_local() -> None:
+    while True:
+        job_id = _fila_local.get()
+        try:
+            _aguardar_provedores(config.JOB_POLL_INTERVAL_S)
+            job = db.claim_pipeline_job(
+                job_id,
+                stale_after_s=config.JOB_STALE_AFTER_S,
+                max_attempts=config.JOB_MAX_ATTEMPTS,
+            )
+            # None: outro worker já pegou o job (ou ele não existe mais)
+            if job:
+                process_job(job)
+        except Exception as e:
+            print(f"[job {job_id}] Erro no worker local: {e}")
+        finally:
+            _fila_local.task_done()
+
+
+def _garantir_threads_locais() -> None:
+    if _threads:
+        return
+    with _threads_lock:
+        if _threads:
+            return
+        for i in range(config.JOB_WORKER_THREADS):
+            t = threading.Thread(target=_loop_thread_local, name=f"pipeline-worker-{i}", daemon=True)
+            t.start()
+            _threads.append(t)
+
+
+def enqueue_job(job_id: int) -> None:
+    """
+    Agenda a execução de um job já gravado no banco.
+
+    No modo "thread" o job é processado em background por este processo;
+    no modo "external" ele fica no banco até um worker externo reivindicá-lo.
+    """
+    if config.JOB_WORKER_MODE != "thread":
+        return
+    _garantir_threads_locais()
+    _fila_local.put(job_id)
+
+
+def run_worker(poll_interval: Optional[float] = None, until_empty: bool = False) -> None:
+    """
+    Loop do worker externo: reivindica jobs pendentes no banco e os processa.
+    Vários workers podem rodar em paralelo (ex: um por container).
+    Com `until_empty`, retorna quando não houver mais jobs pendentes.
+    """
+    poll_interval = config.JOB_POLL_INTERVAL_S if poll_interval is None else poll_interval
+    print("--- WORKER DO PIPELINE INICIADO ---")
+    db.init_db_schema()
+    while True:
+        _aguardar_provedores(poll_interval)
+        job = db.claim_pipeline_job(
+            stale_after_s=config.JOB_STALE_AFTER_S,
+            max_attempts=config.JOB_MAX_ATTEMPTS,
+        )
+        if not job:
+            if until_empty:
+                return
+            time.sleep(poll_interval)
+            continue
+        process_job(job)
+
+
+async def process_job_async(job: Dict[str, Any]) -> bool:
+    """Versão assíncrona de `process_job`, com as mesmas métricas."""
+    _JOBS_EM_ANDAMENTO.inc()
+    inicio = time.perf_counter()
+    sucesso = False
+    try:
+        sucesso = await _processar_job_async(job)
+        return sucesso
+    finally:
+        _JOBS_EM_ANDAMENTO.dec()
+        _DURACAO_JOB.observe(time.perf_counter() - inicio)
+        _JOBS_FINALIZADOS.inc(status="done" if sucesso else "failed")
+
+
+async def _processar_job_async(job: Dict[str, Any]) -> bool:
+    """
+    Versão assíncrona de `_processar_job`: as chamadas aos modelos rodam no
+    event loop e as operações no banco (curtas) em threads auxiliares.
+    """
+    from pipeline import run_full_pipeline_async
+
+    job_id = job["id"]
+    print(f"[job {job_id}] Processando captura ID {job['capture_id']} (tentativa {job['attempts']})...")
+
+    if await asyncio.to_thread(_reaproveitar_duplicata, job):
+        return True
+
+    try:
+        resultado = await run_full_pipeline_async(job["capture_url"], job.get("lat"), job.get("long"),
+                                                  job.get("pipeline_mode"))
+    except Exception as e:
+        resultado = None
+        print(f"[job {job_id}] Erro inesperado no pipeline: {e}")
+
+    return await asyncio.to_thread(_gravar_resultado, job, resultado)
+
+
+async def run_async_worker(concurrency: Optional[int] = None, poll_interval: Optional[float] = None,
+                           until_empty: bool = False) -> None:
+    """
+    Worker externo assíncrono: processa até `concurrency` jobs ao mesmo tempo
+    em um único event loop. Como quase todo o tempo de um job é espera pelos
+    modelos, um processo atende centenas de jobs simultâneos em vez de um por
+    thread. Os limites por provedor (src.shared.rate_limit) continuam valendo.
+    """
+    concurrency = config.JOB_WORKER_ASYNC_CONCURRENCY if concurrency is None else concurrency
+    poll_interval = config.JOB_POLL_INTERVAL_S if poll_interval is None else poll_interval
+    print(f"--- WORKER ASSÍNCRONO DO PIPELINE INICIADO (até {concurrency} jobs simultâneos) ---")
+    await asyncio.to_thread(db.init_db_schema)
+    try:
+        await _laco_async(concurrency, poll_interval, until_empty)
+    finally:
+        # Os clientes assíncronos pertencem a este loop: fecha as conexões junto com ele
+        from src.shared.clients import close_async_clients
+        await close_async_clients()
+
+
+async def _laco_async(concurrency: int, poll_interval: float, until_empty: bool) -> None:
+    tarefas: set = set()
+    while True:
+        espera = _espera_provedores(poll_interval)
+        if espera:
+            await asyncio.sleep(espera)
+            continue
+        if len(tarefas) >= concurrency:
+            await asyncio.wait(tarefas, return_when=asyncio.FIRST_COMPLETED)
+            continue
+
+        job = await asyncio.to_thread(
+            db.claim_pipeline_job,
+            stale_after_s=config.JOB_STALE_AFTER_S,
+            max_attempts=config.JOB_MAX_ATTEMPTS,
+        )
+        if job:
+            tarefa = asyncio.create_task(process_job_async(job))
+            tarefas.add(tarefa)
+            tarefa.add_done_callback(tarefas.discard)
+            continue
+
+        if until_empty and not tarefas:
+            return
+        # Sem jobs pendentes: espera o intervalo ou o fim de algum job
+        if tarefas:
+            await asyncio.wait(tarefas, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker externo do pipeline CPTED.")
+    parser.add_argument("--async", dest="assincrono", action="store_true",
+                        help="Processa vários jobs ao mesmo tempo em um event loop")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Jobs simultâneos no modo --async (padrão: JOB_WORKER_ASYNC_CONCURRENCY)")
+    parser.add_argument("--until-empty", action="store_true", help="Encerra quando não houver jobs pendentes")
+    args = parser.parse_args()
+
+    if args.assincrono:
+        asyncio.run(run_async_worker(args.concurrency, until_empty=args.until_empty))
+    else:
+        run_worker(until_empty=args.until_empty)
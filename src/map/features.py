@@ -0,0 +1,129 @@
+import json
+import math
+from typing import Optional, Iterator, Tuple
+
+import database_manager as db
+from src import config
+
+
+def cor_indice(indice_str: Optional[str]) -> str:
+    """Cor do marcador de acordo com o índice CPTED geral."""
+    if not isinstance(indice_str, str): return 'gray'
+    lower_indice = indice_str.lower()
+    if any(keyword in lower_indice for keyword in ['baixo', 'fraco', 'inexistente']): return 'red'
+    if 'moderado' in lower_indice or 'médio' in lower_indice: return 'orange'
+    if 'forte' in lower_indice or 'alto' in lower_indice: return 'green'
+    return 'gray'
+
+
+def parse_bbox(texto: Optional[str]) -> Tuple[float, float, float, float]:
+    """
+    Converte o parâmetro `bbox=minLon,minLat,maxLon,maxLat` (ordem do GeoJSON)
+    em uma tupla de floats. Lança ValueError se o valor for inválido.
+    """
+    if not texto:
+        raise ValueError("O parâmetro bbox é obrigatório (minLon,minLat,maxLon,maxLat).")
+    partes = texto.split(",")
+    if len(partes) != 4:
+        raise ValueError("bbox deve ter 4 valores: minLon,minLat,maxLon,maxLat.")
+    min_lon, min_lat, max_lon, max_lat = (float(p) for p in partes)
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("bbox fora dos limites ou com mínimo maior que o máximo.")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def _feature_ponto(row: dict) -> dict:
+    indice = row.get('indice_cpted_geral')
+    data = row.get('data_processamento')
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [round(float(row['lon']), 6), round(float(row['lat']), 6)]},
+        "properties": {
+            "cluster": False,
+            "capture_id": row['capture_id'],
+            "titulo": row.get('titulo_analise'),
+            "indice": indice,
+            "cor": cor_indice(indice),
+            "data": data.isoformat() if data else None,
+        },
+    }
+
+
+def validar_janela(bbox: Tuple[float, float, float, float], zoom: Optional[int]) -> None:
+    """
+    Recusa janelas grandes demais para o zoom pedido: abaixo de
+    MAP_CLUSTER_MAX_ZOOM, a janela não pode cobrir mais que MAP_FEATURES_MAX
+    células da grade de grupos (uma tela comum cobre algumas centenas).
+    Lança ValueError nesse caso.
+    """
+    if zoom is None or zoom >= config.MAP_CLUSTER_MAX_ZOOM:
+        return
+    min_lon, min_lat, max_lon, max_lat = bbox
+    celula = db.map_cluster_cell_size(zoom)
+    colunas = math.floor(max_lon / celula) - math.floor(min_lon / celula) + 1
+    linhas = math.floor(max_lat / celula) - math.floor(min_lat / celula) + 1
+    if colunas * linhas > config.MAP_FEATURES_MAX:
+        raise ValueError(f"janela grande demais para o zoom {zoom}; use um zoom menor ou reduza o bbox.")
+
+
+def _feature_cluster(grupo: dict) -> dict:
+    indice = grupo.get('indice_dominante')
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [round(float(grupo['lon']), 6), round(float(grupo['lat']), 6)]},
+        "properties": {
+            "cluster": True,
+            "count": grupo['total'],
+            "indice_dominante": indice,
+            "cor": cor_indice(indice),
+        },
+    }
+
+
+def gerar_geojson_features(bbox: Tuple[float, float, float, float],
+                           zoom: Optional[int] = None) -> Optional[Iterator[str]]:
+    """
+    Prepara, em partes, uma FeatureCollection GeoJSON com as análises dentro
+    da janela `bbox`. As partes podem ser enviadas ao cliente à medida que as
+    linhas chegam do banco, sem montar a resposta inteira em memória.
+
+    A consulta roda antes de a primeira parte ser gerada: se o banco falhar,
+    a função retorna None e a rota ainda pode responder com erro. Falhas
+    depois disso interrompem o envio, em vez de fechar a coleção como válida.
+
+    Abaixo de MAP_CLUSTER_MAX_ZOOM, a resposta traz os grupos pré-agregados
+    no banco (propriedade `cluster: true`, com contagem e índice dominante);
+    a partir dele, cada análise vira um ponto individual. Nos dois casos, no
+    máximo MAP_FEATURES_MAX features.
+
+    Args:
+        bbox: (minLon, minLat, maxLon, maxLat) da janela visível.
+        zoom: Nível de zoom do mapa no cliente. Sem zoom, devolve pontos.
+
+    Retorna:
+        Um iterador das partes do GeoJSON ou None se a consulta falhar.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if zoom is not None and zoom < config.MAP_CLUSTER_MAX_ZOOM:
+        grupos = db.get_analysis_clusters_in_bbox(
+            min_lon, min_lat, max_lon, max_lat, zoom, config.MAP_FEATURES_MAX
+        )
+        if grupos is None:
+            return None
+        features = (_feature_cluster(grupo) for grupo in grupos)
+    else:
+        linhas = db.iter_analyses_in_bbox(min_lon, min_lat, max_lon, max_lat, config.MAP_FEATURES_MAX)
+        if linhas is None:
+            return None
+        features = (_feature_ponto(row) for row in linhas)
+    return _partes_geojson(features)
+
+
+def _partes_geojson(features: Iterator[dict]) -> Iterator[str]:
+    yield '{"type":"FeatureCollection","features":['
+    primeira = True
+    for feature in features:
+        parte = json.dumps(feature, ensure_ascii=False, separators=(",", ":"))
+        yield parte if primeira else "," + parte
+        primeira = False
+    yield ']}'
@@ -2,10 +2,29 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(__file__, "../../../")))
 
-import pandas as pd
-import folium
-from typing import Optional, Dict, Any
+import time
+import threading
+from typing import Optional, Dict, Any, List
 import database_manager as db
+from src import config
+from src.map.features import cor_indice
+from src.shared.metrics import instrumented
+
+# --- CACHE DO MAPA ---
+# O HTML só é refeito quando a versão das análises muda; nesse caso apenas as
+# linhas com ID maior que o último carregado são buscadas no banco, e tudo é
+# recarregado se a contagem não bater (linha gravada fora da ordem dos IDs).
+_cache_mapa: Dict[str, Any] = {
+    "versao": None,          # última versão conhecida do banco
+    "verificado_em": 0.0,    # quando a versão foi consultada (time.monotonic)
+    "geracao": None,         # db.get_pipeline_output_generation() na consulta
+    "versao_linhas": None,   # versão a que `linhas` e `html` correspondem
+    "max_id": 0,
+    "linhas": [],
+    "html": {},              # zoom_start -> HTML
+}
+_cache_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
 
 # --- NOVA FUNÇÃO AUXILIAR ---
 def converter_url_imgur(url: Optional[str]) -> Optional[str]:
@@ -28,29 +47,104 @@ def converter_url_imgur(url: Optional[str]) -> Optional[str]:
     return url # Retorna a URL original se não corresponder aos padrões conhecidos
 
 
+def obter_versao_mapa() -> Optional[tuple]:
+    """
+    Retorna a versão atual dos dados do mapa: (número de análises, maior ID,
+    data de processamento mais recente). A consulta ao banco é reaproveitada por até
+    MAP_VERSION_TTL_S segundos, a menos que este processo tenha gravado uma
+    nova análise nesse meio tempo. Retorna None se o banco não responder.
+    """
+    agora = time.monotonic()
+    geracao = db.get_pipeline_output_generation()
+    with _cache_lock:
+        if (_cache_mapa["versao"] is not None and _cache_mapa["geracao"] == geracao
+                and agora - _cache_mapa["verificado_em"] < config.MAP_VERSION_TTL_S):
+            return _cache_mapa["versao"]
+
+    versao_db = db.get_pipeline_output_version()
+    if versao_db is None:
+        return None
+    data = versao_db["data_processamento"]
+    versao = (versao_db["total"], versao_db["max_id"], data.isoformat() if data else None)
+    with _cache_lock:
+        _cache_mapa.update(versao=versao, verificado_em=agora, geracao=geracao)
+    return versao
+
+
+def etag_do_mapa(versao: tuple, zoom_start: int = 12) -> str:
+    """ETag do HTML do mapa para uma versão dos dados e um zoom inicial."""
+    total, max_id, data = versao
+    return f"mapa-{total}-{max_id}-{data}-z{zoom_start}"
+
+
+def _atualizar_linhas(versao: tuple) -> bool:
+    """
+    (Função auxiliar) Traz do banco só as análises novas desde o último
+    carregamento; recarrega tudo se o total não bater com a versão (linhas
+    apagadas ou gravadas com ID menor que o último carregado).
+    Retorna False, sem mexer no cache, se o banco não responder.
+    """
+    total, max_id_banco, _ = versao
+    linhas, max_id = _cache_mapa["linhas"], _cache_mapa["max_id"]
+    if max_id_banco < max_id:
+        linhas, max_id = [], 0
+
+    novas = db.get_all_analyses_for_map(after_id=max_id)
+    if novas is None:
+        return False
+    linhas = linhas + novas
+    if len(linhas) != total:
+        linhas = db.get_all_analyses_for_map()
+        if linhas is None:
+            return False
+    max_id = max((linha["pipeline_output_id"] for linha in linhas), default=0)
+    _cache_mapa.update(linhas=linhas, max_id=max_id, versao_linhas=versao, html={})
+    return True
+
+
+@instrumented("map_generation")
 def gerar_mapa_de_marcadores_html(zoom_start: int = 12) -> Optional[str]:
     """
-    Gera um mapa Folium com marcadores, com popups responsivos que não saem da tela.
+    Retorna o mapa Folium com marcadores, reaproveitando o HTML em cache
+    enquanto não houver novas análises no banco.
     """
-    print("Buscando dados de análise do banco de dados...")
-    dados_do_banco = db.get_all_analyses_for_map()
+    versao = obter_versao_mapa()
+    if versao is None:
+        # Sem como saber se o cache está atualizado: gera o mapa do zero
+        return _construir_mapa_html(db.get_all_analyses_for_map() or [], zoom_start)
+
+    with _rebuild_lock:
+        if _cache_mapa["versao_linhas"] == versao and zoom_start in _cache_mapa["html"]:
+            return _cache_mapa["html"][zoom_start]
+
+        if _cache_mapa["versao_linhas"] != versao:
+            print("Buscando novas análises no banco de dados...")
+            if not _atualizar_linhas(versao):
+                return None
+
+        html = _construir_mapa_html(_cache_mapa["linhas"], zoom_start)
+        _cache_mapa["html"][zoom_start] = html
+        return html
 
+
+@instrumented("map_render")
+def _construir_mapa_html(dados_do_banco: List[Dict[str, Any]], zoom_start: int) -> Optional[str]:
+    """
+    Gera um mapa Folium com marcadores, com popups responsivos que não saem da tela.
+    """
     if not dados_do_banco:
         print("Nenhum dado com coordenadas encontrado no banco de dados para gerar o mapa.")
         return None
 
+    # Importados só aqui: pandas e folium levam centenas de ms para carregar e
+    # as demais rotas da API não precisam deles
+    import pandas as pd
+    import folium
+
     df = pd.DataFrame(dados_do_banco)
     df['lat'] = pd.to_numeric(df['lat'])
     df['lon'] = pd.to_numeric(df['lon'])
 
-    def cor_icone(indice_str: Optional[str]) -> str:
-        if not isinstance(indice_str, str): return 'gray'
-        lower_indice = indice_str.lower()
-        if any(keyword in lower_indice for keyword in ['baixo', 'fraco', 'inexistente']): return 'red'
-        if 'moderado' in lower_indice or 'médio' in lower_indice: return 'orange'
-        if 'forte' in lower_indice or 'alto' in lower_indice: return 'green'
-        return 'gray'
-
     centro = [df.iloc[0]['lat'], df.iloc[0]['lon']]
     m = folium.Map(location=centro, zoom_start=zoom_start, tiles="cartodbpositron")
 
@@ -89,7 +183,7 @@ def gerar_mapa_de_marcadores_html(zoom_start: int = 12) -> Optional[str]:
             [row['lat'], row['lon']],
             popup=folium.Popup(popup_html, max_width=300),
             tooltip=row.get('titulo_analise', ''),
-            icon=folium.Icon(color=cor_icone(indice_atual), icon='shield-alt', prefix='fa')
+            icon=folium.Icon(color=cor_indice(indice_atual), icon='shield-alt', prefix='fa')
         ).add_to(m)
 
     print("Geração do mapa de marcadores concluída.")
@@ -1,7 +1,12 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(__file__, "../../../")))
+
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from collections import Counter
+
+import database_manager as db
 
 # Configuração da página do dashboard
 st.set_page_config(
@@ -15,54 +20,69 @@ st.title("🛡️ Dashboard de Análise de Segurança CPTED")
 st.markdown("Este dashboard apresenta uma análise visual dos dados de segurança de locais, com base nos princípios do CPTED.")
 
 # --- Carregamento dos Dados ---
-@st.cache_data
-def carregar_dados(caminho_arquivo):
-    """Função para carregar os dados do arquivo CSV."""
-    try:
-        df = pd.read_csv(caminho_arquivo)
-        return df
-    except FileNotFoundError:
-        st.error(f"Erro: O arquivo '{caminho_arquivo}' não foi encontrado. Por favor, verifique se ele está no mesmo diretório que o script.")
-        return None
-
-# Carrega o DataFrame
-df = carregar_dados('../data/reports/relatorio_cpted_multiplas_analises1.csv')
-
-if df is not None:
+# Os números vêm dos agregados pré-calculados no banco (tabela cpted_summary),
+# atualizados só com as análises novas. Nada é recarregado por completo.
+@st.cache_data(ttl=60)
+def carregar_resumo(indices=None, iluminacoes=None):
+    """Atualiza os agregados com as análises novas e lê o resumo filtrado."""
+    db.refresh_cpted_summary()
+    return db.get_cpted_summary(indices, iluminacoes)
+
+@st.cache_data(ttl=60)
+def carregar_amostra(indices, iluminacoes, limite=100):
+    """Carrega as análises mais recentes para a tabela de dados brutos."""
+    return pd.DataFrame(db.get_latest_pipeline_outputs(limite, indices, iluminacoes))
+
+def contagens_para_df(contagens, coluna, top_n=None):
+    """Converte um dicionário {valor: contagem} em DataFrame ordenado."""
+    df_contagem = pd.DataFrame(list(contagens.items()), columns=[coluna, 'count'])
+    df_contagem = df_contagem.sort_values('count', ascending=False)
+    return df_contagem.head(top_n) if top_n else df_contagem
+
+def mais_comum(contagens):
+    """Retorna o valor com maior contagem (equivalente ao mode())."""
+    return max(contagens, key=contagens.get) if contagens else "N/A"
+
+# Resumo sem filtros (usado para montar as opções dos filtros)
+resumo_geral = carregar_resumo()
+
+if not resumo_geral['total']:
+    st.error("Nenhuma análise encontrada no banco de dados.")
+else:
     # --- Barra Lateral de Filtros ---
     st.sidebar.header("Filtros do Relatório")
-    
+    opcoes_indice = sorted(resumo_geral['indice_cpted_geral'])
+    opcoes_iluminacao = sorted(resumo_geral['vigilancia_iluminacao'])
+
     # Filtro por Índice CPTED Geral
     indice_selecionado = st.sidebar.multiselect(
         "Filtrar por Índice CPTED Geral:",
-        options=df['indice_cpted_geral'].unique(),
-        default=df['indice_cpted_geral'].unique()
+        options=opcoes_indice,
+        default=opcoes_indice
     )
 
     # Filtro por Nível de Iluminação
     iluminacao_selecionada = st.sidebar.multiselect(
         "Filtrar por Nível de Iluminação:",
-        options=df['vigilancia_iluminacao'].unique(),
-        default=df['vigilancia_iluminacao'].unique()
+        options=opcoes_iluminacao,
+        default=opcoes_iluminacao
     )
 
-    # Aplicando os filtros ao DataFrame
-    df_filtrado = df[
-        df['indice_cpted_geral'].isin(indice_selecionado) &
-        df['vigilancia_iluminacao'].isin(iluminacao_selecionada)
-    ]
+    # Aplicando os filtros no banco
+    resumo = carregar_resumo(tuple(indice_selecionado), tuple(iluminacao_selecionada))
+    total_filtrado = resumo['total'].get('', 0)
 
     # --- Corpo Principal do Dashboard ---
 
-    if df_filtrado.empty:
+    if total_filtrado == 0:
         st.warning("Nenhum dado encontrado para os filtros selecionados. Por favor, ajuste os filtros na barra lateral.")
     else:
         # Linha de KPIs (Key Performance Indicators)
         st.markdown("### Visão Geral")
         col1, col2, col3 = st.columns(3)
-        col1.metric("Total de Análises", f"{len(df_filtrado)}")
-        col2.metric("Índice de Risco Mais Comum", df_filtrado['indice_cpted_geral'].mode()[0])
-        col3.metric("Percepção de Cuidado Mais Comum", df_filtrado['manutencao_percepcao_cuidado'].mode()[0])
+        col1.metric("Total de Análises", f"{total_filtrado}")
+        col2.metric("Índice de Risco Mais Comum", mais_comum(resumo['indice_cpted_geral']))
+        col3.metric("Percepção de Cuidado Mais Comum", mais_comum(resumo['manutencao_percepcao_cuidado']))
 
         st.markdown("---")
 
@@ -72,7 +92,7 @@ if df is not None:
         with col_graf_1:
             st.subheader("Distribuição do Índice CPTED Geral")
             fig_indice = px.bar(
-                df_filtrado['indice_cpted_geral'].value_counts().reset_index(),
+                contagens_para_df(resumo['indice_cpted_geral'], 'indice_cpted_geral'),
                 x='indice_cpted_geral',
                 y='count',
                 title="Contagem por Nível de Risco",
@@ -87,8 +107,9 @@ if df is not None:
         with col_graf_2:
             st.subheader("Qualidade da Iluminação nos Locais")
             fig_iluminacao = px.pie(
-                df_filtrado,
+                contagens_para_df(resumo['vigilancia_iluminacao'], 'vigilancia_iluminacao'),
                 names='vigilancia_iluminacao',
+                values='count',
                 title="Proporção por Nível de Iluminação",
                 hole=0.3,
                 color_discrete_sequence=px.colors.sequential.Oranges_r
@@ -100,25 +121,11 @@ if df is not None:
         # --- Análise de Fatores e Recomendações ---
         st.subheader("Fatores Mais Comuns (Riscos e Recomendações)")
 
-        def extrair_e_contar_fatores(series, top_n=5):
-            """Função para separar strings, contar e retornar os mais comuns."""
-            series = series.dropna()
-            if series.empty:
-                return pd.DataFrame(columns=['Fator', 'Contagem'])
-            
-            todos_os_fatores = series.str.split('; ').explode().str.strip()
-            contagem = Counter(todos_os_fatores)
-            
-            contagem.pop('', None)
-            
-            df_contagem = pd.DataFrame(contagem.items(), columns=['Fator', 'Contagem']).sort_values('Contagem', ascending=False)
-            return df_contagem.head(top_n)
-
         col_risco, col_rec = st.columns(2)
 
         with col_risco:
             st.markdown("##### Top 5 Fatores de Risco (Sinais de Desordem)")
-            df_riscos = extrair_e_contar_fatores(df_filtrado['manutencao_sinais_desordem'])
+            df_riscos = contagens_para_df(resumo['manutencao_sinais_desordem'], 'Fator', top_n=5).rename(columns={'count': 'Contagem'})
             if not df_riscos.empty:
                 fig_riscos = px.bar(
                     df_riscos.sort_values('Contagem', ascending=True),
@@ -133,7 +140,7 @@ if df is not None:
 
         with col_rec:
             st.markdown("##### Top 5 Recomendações")
-            df_recomendacoes = extrair_e_contar_fatores(df_filtrado['recomendacoes'])
+            df_recomendacoes = contagens_para_df(resumo['recomendacoes'], 'Fator', top_n=5).rename(columns={'count': 'Contagem'})
             if not df_recomendacoes.empty:
                 fig_recomendacoes = px.bar(
                     df_recomendacoes.sort_values('Contagem', ascending=True),
@@ -148,5 +155,5 @@ if df is not None:
                 st.info("Nenhuma recomendação a ser exibida para a seleção atual.")
 
         # --- Visualização dos Dados Brutos ---
-        with st.expander("Visualizar Tabela de Dados Completa"):
-            st.dataframe(df_filtrado)
\ No newline at end of file
+        with st.expander("Visualizar Análises Mais Recentes"):
+            st.dataframe(carregar_amostra(tuple(indice_selecionado), tuple(iluminacao_selecionada)))
\ No newline at end of file
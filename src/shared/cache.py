@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from src import config
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Gera uma chave estável (sha256) a partir de partes JSON-serializáveis.
+    Ex: make_cache_key("image_to_text", url, modelo, prompt)
+    """
+    bruto = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(bruto.encode("utf-8")).hexdigest()
+
+
+def hash_text(texto: str) -> str:
+    """Retorna o sha256 (hex) de um texto."""
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+
+class CacheBackend:
+    """Interface dos backends de cache. Os valores devem ser JSON-serializáveis."""
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """Backend que não guarda nada (cache desativado)."""
+
+    def get(self, key: str) -> Optional[Any]:
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """Cache em memória, por processo, com TTL e remoção LRU."""
+
+    def __init__(self, ttl_s: float, max_entries: int):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache em disco (SQLite) com TTL e remoção LRU. Sobrevive a reinícios
+    e pode ser compartilhado por vários processos na mesma máquina.
+    """
+
+    def __init__(self, path: str, ttl_s: float, max_entries: int):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        diretorio = os.path.dirname(path)
+        if diretorio:
+            os.makedirs(diretorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache (last_access)")
+
+    def get(self, key: str) -> Optional[Any]:
+        agora = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < agora:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (agora, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        agora = time.time()
+        valor = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, valor, agora + self.ttl_s, agora),
+            )
+            excesso = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+            if excesso > 0:
+                # Remove primeiro os expirados e depois os menos usados recentemente
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN ("
+                    " SELECT key FROM cache ORDER BY expires_at < ? DESC, last_access ASC LIMIT ?)",
+                    (agora, excesso),
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+
+
+_cache: Optional[CacheBackend] = None
+_cache_lock = threading.Lock()
+
+
+def _create_cache() -> CacheBackend:
+    backend = config.CACHE_BACKEND.lower()
+    if backend == "memory":
+        return MemoryCache(config.CACHE_TTL_S, config.CACHE_MAX_ENTRIES)
+    if backend == "sqlite":
+        return SQLiteCache(config.CACHE_SQLITE_PATH, config.CACHE_TTL_S, config.CACHE_MAX_ENTRIES)
+    if backend != "none":
+        print(f"Aviso: CACHE_BACKEND '{config.CACHE_BACKEND}' desconhecido. Cache desativado.")
+    return NullCache()
+
+
+def get_cache() -> CacheBackend:
+    """Retorna o cache de resultados do processo, conforme CACHE_BACKEND."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = _create_cache()
+    return _cache
+
+
+def set_cache(backend: Optional[CacheBackend]) -> None:
+    """Substitui o cache do processo (None volta à configuração padrão)."""
+    global _cache
+    with _cache_lock:
+        _cache = backend
@@ -1,19 +1,153 @@
-from openai import OpenAI
+import os
+import asyncio
+import weakref
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from google import genai
+from google.genai import types
 from src import config
 
+# Clientes compartilhados pelo processo. Cada cliente mantém seu próprio pool
+# de conexões HTTP; reutilizá-los evita um novo handshake TLS a cada foto.
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+# Clientes assíncronos por event loop. A chave é o próprio loop (referência
+# fraca); como as conexões abertas também apontam para o loop, os de loops já
+# fechados são descartados explicitamente a cada consulta.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY_S,
+    )
+
+
+def _get_or_create(name: str, factory):
+    """
+    (Função auxiliar) Retorna o cliente `name`, criando-o na primeira chamada.
+    Após um fork os clientes são recriados, pois conexões abertas não
+    podem ser compartilhadas entre processos.
+    """
+    global _clients_pid
+    pid = os.getpid()
+    client = _clients.get(name) if _clients_pid == pid else None
+    if client is not None:
+        return client
+    with _clients_lock:
+        if _clients_pid != pid:
+            _clients.clear()
+            _async_clients.clear()
+            _clients_pid = pid
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def _get_or_create_async(name: str, factory):
+    """
+    (Função auxiliar) Como `_get_or_create`, mas um cliente por event loop:
+    conexões assíncronas pertencem ao loop em que foram abertas.
+    """
+    global _clients_pid
+    loop = asyncio.get_running_loop()
+    pid = os.getpid()
+    with _clients_lock:
+        if _clients_pid != pid:
+            _clients.clear()
+            _async_clients.clear()
+            _clients_pid = pid
+        for fechado in [antigo for antigo in _async_clients if antigo.is_closed()]:
+            del _async_clients[fechado]
+        do_loop = _async_clients.setdefault(loop, {})
+        if name not in do_loop:
+            do_loop[name] = factory()
+        return do_loop[name]
+
+
 def get_kluster_client():
-    """Retorna um cliente configurado para a API da Kluster."""
+    """Retorna o cliente (compartilhado) configurado para a API da Kluster."""
     if not config.KUSTER_API_KEY:
         print("Aviso: KUSTER_API_KEY não foi configurada.")
         return None
-    return OpenAI(api_key=config.KUSTER_API_KEY, base_url=config.KUSTER_BASE_URL)
+    return _get_or_create("kluster", lambda: OpenAI(
+        api_key=config.KUSTER_API_KEY,
+        base_url=config.KUSTER_BASE_URL,
+        timeout=config.KUSTER_TIMEOUT_S,
+        # As novas tentativas ficam a cargo de src.shared.resilience
+        max_retries=0,
+        http_client=DefaultHttpxClient(limits=_http_limits(), timeout=config.KUSTER_TIMEOUT_S),
+    ))
+
+def get_kluster_async_client():
+    """
+    Retorna o cliente assíncrono da API da Kluster para o event loop atual.
+    Conexões assíncronas pertencem a um event loop, então cada loop tem o seu.
+    """
+    if not config.KUSTER_API_KEY:
+        print("Aviso: KUSTER_API_KEY não foi configurada.")
+        return None
+    return _get_or_create_async("kluster", lambda: AsyncOpenAI(
+        api_key=config.KUSTER_API_KEY,
+        base_url=config.KUSTER_BASE_URL,
+        timeout=config.KUSTER_TIMEOUT_S,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(limits=_http_limits(), timeout=config.KUSTER_TIMEOUT_S),
+    ))
 
 def get_genai_client():
-    """Retorna um cliente configurado para a API do Google GenAI."""
+    """Retorna o cliente (compartilhado) configurado para a API do Google GenAI."""
     if not config.GOOGLE_API_KEY:
         print("Aviso: GOOGLE_API_KEY não foi configurada.")
         return None
-    # O SDK do google.generativeai configura a chave globalmente
-    client = genai.Client(api_key=config.GOOGLE_API_KEY)
-    return client
\ No newline at end of file
+    return _get_or_create("genai", _criar_genai)
+
+def _criar_genai():
+    return genai.Client(
+        api_key=config.GOOGLE_API_KEY,
+        http_options=types.HttpOptions(
+            base_url=config.GOOGLE_BASE_URL,
+            # O SDK do GenAI recebe o timeout em milissegundos
+            timeout=int(config.GOOGLE_TIMEOUT_S * 1000),
+            client_args={"limits": _http_limits()},
+            async_client_args={"limits": _http_limits()},
+        ),
+    )
+
+def get_genai_async_client():
+    """
+    Retorna a interface assíncrona (`client.aio`) do Google GenAI para o event
+    loop atual. Como no Kluster, cada loop tem o seu cliente.
+    """
+    if not config.GOOGLE_API_KEY:
+        print("Aviso: GOOGLE_API_KEY não foi configurada.")
+        return None
+    return _get_or_create_async("genai", _criar_genai).aio
+
+async def close_async_clients() -> None:
+    """Fecha os clientes assíncronos do event loop atual (ex: ao encerrar o worker)."""
+    with _clients_lock:
+        do_loop = _async_clients.pop(asyncio.get_running_loop(), {})
+    for name, client in do_loop.items():
+        try:
+            if name == "genai":
+                # O SDK do GenAI (1.21) não expõe um aclose(); fecha o pool httpx do loop
+                http = getattr(getattr(client, "_api_client", None), "_async_httpx_client", None)
+                if http is not None:
+                    await http.aclose()
+            else:
+                await client.close()
+        except Exception as e:
+            print(f"Aviso: não foi possível fechar o cliente assíncrono '{name}'. {e}")
+
+def reset_clients() -> None:
+    """Descarta os clientes compartilhados (ex: após trocar as chaves em testes)."""
+    global _clients_pid
+    with _clients_lock:
+        _clients.clear()
+        _async_clients.clear()
+        _clients_pid = None
@@ -0,0 +1,342 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+
+class PoolExhaustedError(psycopg2.OperationalError):
+    """Lançada quando nenhuma conexão fica livre dentro do tempo de espera."""
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Conexão que lembra quais comandos já foram preparados no servidor
+    (PREPARE), para que cada um seja preparado uma única vez por sessão.
+    Use com `psycopg2.connect(..., connection_factory=PreparingConnection)`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        # Preparados cujo plano ficou inválido (ex: ALTER TABLE) e que
+        # precisam de DEALLOCATE antes de serem preparados de novo
+        self.invalidated = set()
+
+
+def execute_prepared(cur, name: str, sql: str, params: tuple = ()) -> None:
+    """
+    Executa `sql` (com parâmetros $1, $2, ...) como um comando preparado no
+    servidor. Na primeira chamada em cada conexão o comando é preparado com
+    o nome `name`; nas seguintes só o EXECUTE é enviado, sem novo parse/plano.
+    Conexões que não são PreparingConnection executam o comando normalmente.
+    """
+    conn = cur.connection
+    if not isinstance(conn, PreparingConnection):
+        cur.execute(re.sub(r"\$(\d+)", r"%(p\1)s", sql), {f"p{i}": v for i, v in enumerate(params, 1)})
+        return
+
+    transacao_livre = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        _executar_preparado(cur, conn, name, sql, params)
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type": a tabela mudou desde o
+        # PREPARE. Sem trabalho anterior na transação, dá para refazer aqui.
+        conn.prepared.discard(name)
+        conn.invalidated.add(name)
+        if not transacao_livre:
+            raise
+        conn.rollback()
+        _executar_preparado(cur, conn, name, sql, params)
+
+
+def _executar_preparado(cur, conn: PreparingConnection, name: str, sql: str, params: tuple) -> None:
+    if name not in conn.prepared:
+        if name in conn.invalidated:
+            cur.execute(f"DEALLOCATE {name}")
+            conn.invalidated.discard(name)
+        cur.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+class ConnectionPool:
+    """
+    Pool de conexões PostgreSQL thread-safe e compartilhado pelo processo.
+
+    - Mantém entre `min_size` e `max_size` conexões abertas.
+    - Conexões ociosas há mais de `idle_timeout` segundos são fechadas
+      (respeitando o mínimo).
+    - Conexões ociosas há mais de `health_check_interval` segundos passam
+      por um `SELECT 1` antes de serem entregues; conexões quebradas são
+      descartadas e substituídas.
+    - Quando o pool está cheio, a retirada espera até `checkout_timeout`
+      segundos antes de lançar PoolExhaustedError.
+    - `on_checkout(duracao_s, erro)`, se informado, é chamado a cada retirada
+      (ex: para registrar métricas de espera).
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        min_size: int = 1,
+        max_size: int = 10,
+        idle_timeout: float = 300.0,
+        checkout_timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+        on_checkout: Optional[Callable[[float, bool], None]] = None,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Configuração inválida do pool: exige 0 <= min_size <= max_size e max_size >= 1.")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._on_checkout = on_checkout
+
+        self._cond = threading.Condition()
+        # Pilha (LIFO) de (conexão, instante em que foi devolvida)
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "checkout_waits": 0,
+            "checkout_timeouts": 0,
+            "health_check_failures": 0,
+        }
+
+        for _ in range(min_size):
+            try:
+                conn = self._new_connection()
+            except psycopg2.Error as e:
+                print(f"Aviso: não foi possível pré-abrir conexões do pool. {e}")
+                break
+            self._idle.append((conn, time.monotonic()))
+
+    # --------------------------------------------------------------------------
+    # Ciclo de vida das conexões
+    # --------------------------------------------------------------------------
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _close_connection(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["connections_closed"] += 1
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _reap_idle(self) -> list:
+        """Remove (sob o lock) as conexões que passaram do idle_timeout."""
+        expired = []
+        now = time.monotonic()
+        # As mais antigas ficam no início da fila
+        while self._idle and len(self._idle) + self._in_use > self.min_size:
+            conn, idle_since = self._idle[0]
+            if now - idle_since < self.idle_timeout:
+                break
+            self._idle.popleft()
+            expired.append(conn)
+        return expired
+
+    # --------------------------------------------------------------------------
+    # API pública
+    # --------------------------------------------------------------------------
+
+    def getconn(self):
+        """Retira uma conexão do pool, criando uma nova se houver espaço."""
+        if self._on_checkout is None:
+            return self._getconn()
+        inicio = time.monotonic()
+        try:
+            conn = self._getconn()
+        except BaseException:
+            self._on_checkout(time.monotonic() - inicio, True)
+            raise
+        self._on_checkout(time.monotonic() - inicio, False)
+        return conn
+
+    def _getconn(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        waited = False
+        # Acumula as conexões expiradas de todas as voltas da espera; são
+        # fechadas fora do lock, inclusive se o checkout falhar
+        expired = []
+        try:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.OperationalError("O pool de conexões foi fechado.")
+                    expired.extend(self._reap_idle())
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        create = False
+                        break
+                    if self._in_use < self.max_size:
+                        conn, idle_since = None, 0.0
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["checkout_timeouts"] += 1
+                        raise PoolExhaustedError(
+                            f"Nenhuma conexão livre no pool após {self.checkout_timeout}s "
+                            f"(max_size={self.max_size})."
+                        )
+                    if not waited:
+                        self._stats["checkout_waits"] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                self._in_use += 1
+                self._stats["checkouts"] += 1
+        finally:
+            for old in expired:
+                self._close_connection(old)
+
+        try:
+            if not create and not self._is_healthy(conn, idle_since):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._close_connection(conn)
+                create = True
+            if create:
+                conn = self._new_connection()
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """Devolve uma conexão ao pool (ou a descarta, se estiver quebrada)."""
+        if not discard and not conn.closed:
+            try:
+                # Nunca devolve uma conexão com transação aberta
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            keep = not discard and not conn.closed and not self._closed
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+        if not keep:
+            self._close_connection(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager que retira uma conexão e a devolve ao final.
+        Em caso de exceção, a transação é revertida antes da devolução.
+        """
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except BaseException:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self) -> Dict[str, Any]:
+        """Retorna um retrato do uso do pool, útil para dimensioná-lo."""
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": len(self._idle) + self._in_use,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                **self._stats,
+            }
+
+    def closeall(self) -> None:
+        """Fecha todas as conexões ociosas e impede novas retiradas."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_connection(conn)
+
+
+# ==============================================================================
+# POOL COMPARTILHADO PELO PROCESSO
+# ==============================================================================
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_shared_pool(factory: Callable[[], ConnectionPool]) -> ConnectionPool:
+    """
+    Retorna o pool do processo, criando-o na primeira chamada.
+    Após um fork (ex: workers do gunicorn) um novo pool é criado, pois
+    conexões não podem ser compartilhadas entre processos.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = factory()
+            _pool_pid = pid
+        return _pool
+
+
+def close_shared_pool() -> None:
+    """Fecha o pool do processo (se existir)."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
@@ -0,0 +1,102 @@
+import math
+import hashlib
+from typing import Optional
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+from src import config
+from src.shared.cache import MemoryCache
+
+# Raio médio da Terra, usado no cálculo de distância (haversine)
+_RAIO_TERRA_M = 6371000.0
+
+_baixadas: Optional[MemoryCache] = None
+
+
+def _cache_baixadas() -> MemoryCache:
+    """(Função auxiliar) Cache em memória dos bytes das imagens baixadas recentemente."""
+    global _baixadas
+    if _baixadas is None:
+        _baixadas = MemoryCache(config.IMAGE_DOWNLOAD_CACHE_TTL_S, config.IMAGE_DOWNLOAD_CACHE_MAX_ENTRIES)
+    return _baixadas
+
+
+def validar_url_imagem(url: str) -> None:
+    """
+    Verifica se a URL aponta para um host permitido (IMAGE_ALLOWED_HOSTS ou
+    um subdomínio dele) com um esquema permitido (IMAGE_ALLOWED_SCHEMES).
+    Lança ValueError caso contrário.
+    """
+    partes = urlsplit(url)
+    host = (partes.hostname or "").lower()
+    if partes.scheme.lower() not in config.IMAGE_ALLOWED_SCHEMES:
+        raise ValueError(f"Esquema não permitido para download de imagem: {url}")
+    if not any(host == permitido or host.endswith("." + permitido) for permitido in config.IMAGE_ALLOWED_HOSTS):
+        raise ValueError(f"Host não permitido para download de imagem: {url}")
+
+
+def baixar_imagem(url: str) -> bytes:
+    """
+    Baixa os bytes de uma imagem, respeitando o limite de tamanho e os hosts
+    permitidos (também a cada redirecionamento). Downloads recentes da mesma
+    URL são reaproveitados da memória.
+    Lança uma exceção se o download falhar, se o host não for permitido ou se
+    a imagem for grande demais.
+    """
+    cache = _cache_baixadas()
+    dados = cache.get(url)
+    if dados is not None:
+        return dados
+
+    destino = url
+    with httpx.Client(timeout=config.IMAGE_DOWNLOAD_TIMEOUT_S, follow_redirects=False) as cliente:
+        for _ in range(config.IMAGE_MAX_REDIRECTS + 1):
+            validar_url_imagem(destino)
+            with cliente.stream("GET", destino) as resposta:
+                if resposta.is_redirect:
+                    destino = urljoin(destino, resposta.headers["location"])
+                    continue
+                resposta.raise_for_status()
+                if int(resposta.headers.get("content-length") or 0) > config.IMAGE_MAX_BYTES:
+                    raise ValueError(f"Imagem maior que o limite de {config.IMAGE_MAX_BYTES} bytes: {url}")
+                partes = []
+                total = 0
+                for parte in resposta.iter_bytes():
+                    total += len(parte)
+                    if total > config.IMAGE_MAX_BYTES:
+                        raise ValueError(f"Imagem maior que o limite de {config.IMAGE_MAX_BYTES} bytes: {url}")
+                    partes.append(parte)
+                dados = b"".join(partes)
+                break
+        else:
+            raise ValueError(f"Redirecionamentos demais ao baixar a imagem: {url}")
+
+    cache.set(url, dados)
+    return dados
+
+
+def hash_conteudo(dados: bytes) -> str:
+    """Retorna o sha256 (hex) dos bytes de uma imagem."""
+    return hashlib.sha256(dados).hexdigest()
+
+
+def distancia_metros(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distância (haversine), em metros, entre dois pontos dados em graus."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * _RAIO_TERRA_M * math.asin(math.sqrt(a))
+
+
+def tipo_mime(dados: bytes) -> str:
+    """Identifica o tipo MIME de uma imagem pelos primeiros bytes (padrão: image/jpeg)."""
+    if dados.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if dados[:4] == b"RIFF" and dados[8:12] == b"WEBP":
+        return "image/webp"
+    if dados[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    if dados[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
@@ -0,0 +1,237 @@
+import time
+import inspect
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Métricas em memória, por processo, no formato de texto do Prometheus.
+# Com vários workers (ex: gunicorn), cada processo expõe os próprios valores.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Limites (em segundos) dos buckets dos histogramas de latência. Vão até 60s
+# porque as chamadas aos modelos podem levar dezenas de segundos.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> _LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: _LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pares = list(key) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    texto = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pares
+    )
+    return "{" + texto + "}"
+
+
+def _format_value(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+class _Metric:
+    tipo = ""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Contador que só cresce (ex: chamadas, erros)."""
+    tipo = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._values: Dict[_LabelKey, float] = {}
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> str:
+        with self._lock:
+            itens = sorted(self._values.items())
+        return "".join(f"{self.name}{_format_labels(k)} {_format_value(v)}\n" for k, v in itens)
+
+
+class Gauge(Counter):
+    """Valor que sobe e desce (ex: jobs em andamento, conexões em uso)."""
+    tipo = "gauge"
+
+    def dec(self, value: float = 1.0, **labels) -> None:
+        self.inc(-value, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = float(value)
+
+
+class Histogram(_Metric):
+    """Distribuição de valores (latências) em buckets cumulativos."""
+    tipo = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        # Por conjunto de labels: [contagem por bucket..., soma, contagem total]
+        self._values: Dict[_LabelKey, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            dados = self._values.get(key)
+            if dados is None:
+                dados = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if value <= limite:
+                    dados[i] += 1
+            dados[-2] += value
+            dados[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mede a duração de um bloco `with`."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, **labels)
+
+    def render(self) -> str:
+        with self._lock:
+            itens = sorted((k, list(v)) for k, v in self._values.items())
+        linhas = []
+        for key, dados in itens:
+            for limite, contagem in zip(self.buckets, dados):
+                linhas.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(limite)))} {contagem}\n")
+            linhas.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {dados[-1]}\n")
+            linhas.append(f"{self.name}_sum{_format_labels(key)} {_format_value(dados[-2])}\n")
+            linhas.append(f"{self.name}_count{_format_labels(key)} {dados[-1]}\n")
+        return "".join(linhas)
+
+
+# ==============================================================================
+# REGISTRO DO PROCESSO
+# ==============================================================================
+
+_registry: Dict[str, _Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_register(cls, name: str, help_text: str, **kwargs) -> Any:
+    with _registry_lock:
+        metrica = _registry.get(name)
+        if metrica is None:
+            metrica = _registry[name] = cls(name, help_text, **kwargs)
+        elif type(metrica) is not cls:
+            raise ValueError(f"A métrica '{name}' já foi registrada com outro tipo.")
+        return metrica
+
+
+def counter(name: str, help_text: str) -> Counter:
+    """Retorna o contador `name`, registrando-o na primeira chamada."""
+    return _get_or_register(Counter, name, help_text)
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    """Retorna o gauge `name`, registrando-o na primeira chamada."""
+    return _get_or_register(Gauge, name, help_text)
+
+
+def histogram(name: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """Retorna o histograma `name`, registrando-o na primeira chamada."""
+    return _get_or_register(Histogram, name, help_text, buckets=buckets)
+
+
+def set_gauges(prefix: str, valores: Dict[str, Any], help_text: str = "") -> None:
+    """
+    Publica um dicionário de números como gauges `<prefix>_<chave>`
+    (ex: as estatísticas do pool de conexões). Valores não numéricos são ignorados.
+    """
+    for chave, valor in valores.items():
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            gauge(f"{prefix}_{chave}", help_text or f"{prefix} {chave}").set(valor)
+
+
+def render_prometheus() -> str:
+    """Gera o texto de todas as métricas no formato de exposição do Prometheus."""
+    with _registry_lock:
+        metricas = sorted(_registry.values(), key=lambda m: m.name)
+    partes = []
+    for metrica in metricas:
+        partes.append(f"# HELP {metrica.name} {metrica.help}\n# TYPE {metrica.name} {metrica.tipo}\n")
+        partes.append(metrica.render())
+    return "".join(partes)
+
+
+# ==============================================================================
+# INSTRUMENTAÇÃO DAS ETAPAS
+# ==============================================================================
+
+STAGE_DURATION = histogram("cpted_stage_duration_seconds", "Duração de cada etapa instrumentada, em segundos.")
+STAGE_CALLS = counter("cpted_stage_calls_total", "Chamadas de cada etapa instrumentada.")
+STAGE_ERRORS = counter(
+    "cpted_stage_errors_total",
+    "Falhas de cada etapa instrumentada (exceção ou retorno None).",
+)
+
+
+def instrumented(stage: str) -> Callable:
+    """
+    Decorador que mede a duração, as chamadas e as falhas de uma etapa.
+
+    Como as funções deste projeto sinalizam erro retornando None, um retorno
+    None conta como falha, assim como uma exceção (que é propagada).
+    Funciona também com funções `async def`.
+    """
+    def registrar(inicio: float, sucesso: bool) -> None:
+        STAGE_DURATION.observe(time.perf_counter() - inicio, stage=stage)
+        STAGE_CALLS.inc(stage=stage)
+        if not sucesso:
+            STAGE_ERRORS.inc(stage=stage)
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper_async(*args, **kwargs):
+                inicio = time.perf_counter()
+                sucesso = False
+                try:
+                    resultado = await func(*args, **kwargs)
+                    sucesso = resultado is not None
+                    return resultado
+                finally:
+                    registrar(inicio, sucesso)
+            return wrapper_async
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            inicio = time.perf_counter()
+            sucesso = False
+            try:
+                resultado = func(*args, **kwargs)
+                sucesso = resultado is not None
+                return resultado
+            finally:
+                registrar(inicio, sucesso)
+        return wrapper
+    return decorator
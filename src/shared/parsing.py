@@ -1,13 +1,104 @@
-from src.info_extraction.schemas import AnaliseCptedDoLocal
-from typing import Dict, Any
+import re
+import unicodedata
+from typing import TYPE_CHECKING, Dict, Any, List, Tuple
 
+# O pydantic só é carregado quando uma análise é de fato validada, para não
+# pesar na inicialização da API (ver tests/run_import_budget.py).
+if TYPE_CHECKING:
+    from src.info_extraction.schemas import AnaliseCptedDoLocal
 
-def achatar_analise_cpted(analise: AnaliseCptedDoLocal) -> Dict[str, Any]:
+# Colunas de pipeline_output preenchidas a partir de uma análise, na ordem
+# produzida por `achatar_analise_cpted`.
+COLUNAS_ANALISE_ACHATADA = (
+    'titulo_analise',
+    'indice_cpted_geral',
+    'resumo_executivo',
+    'vigilancia_nivel_natural',
+    'vigilancia_iluminacao',
+    'vigilancia_pontos_cegos',
+    'vigilancia_formal',
+    'vigilancia_justificativa',
+    'controle_acesso_clareza_fronteiras',
+    'controle_acesso_barreiras_fisicas',
+    'controle_acesso_barreiras_simbolicas',
+    'controle_acesso_justificativa',
+    'manutencao_percepcao_cuidado',
+    'manutencao_sinais_desordem',
+    'manutencao_justificativa',
+    'suporte_atividades_legitimas',
+    'suporte_atividades_tipo_uso',
+    'suporte_atividades_areas_adjacentes',
+    'suporte_atividades_justificativa',
+    'recomendacoes',
+)
+
+# Colunas de lista (texto separado por "; " em pipeline_output) cujos itens
+# também são gravados como fatores normalizados (tabelas cpted_factor e
+# pipeline_output_factor), para consultas de "fatores mais comuns" no banco.
+COLUNAS_FATORES_CPTED = (
+    'vigilancia_pontos_cegos',
+    'vigilancia_formal',
+    'controle_acesso_barreiras_fisicas',
+    'controle_acesso_barreiras_simbolicas',
+    'manutencao_sinais_desordem',
+    'suporte_atividades_tipo_uso',
+    'suporte_atividades_areas_adjacentes',
+    'recomendacoes',
+)
+
+SEPARADOR_LISTA = "; "
+
+def normalizar_fator(texto: str) -> str:
+    """
+    Gera a chave normalizada de um fator, para que variações de escrita
+    ("Lixo acumulado.", "lixo  acumulado") caiam no mesmo item do vocabulário.
+    Remove acentos, caixa, pontuação nas pontas e espaços repetidos.
+    """
+    sem_acento = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    chave = re.sub(r"\s+", " ", sem_acento.lower()).strip()
+    return chave.strip(" .,;:!-")
+
+def separar_fatores(texto: str) -> List[str]:
+    """Separa uma coluna de lista achatada nos seus itens (sem vazios)."""
+    if not texto:
+        return []
+    return [item.strip() for item in texto.split(SEPARADOR_LISTA) if item.strip()]
+
+def extrair_fatores_cpted(dados_achatados: Dict[str, Any]) -> List[Tuple[str, str, str]]:
+    """
+    Extrai os fatores das colunas de lista de uma análise achatada.
+
+    Retorna:
+        Uma lista de tuplas (coluna, chave normalizada, texto original), sem
+        repetir a mesma chave dentro de uma coluna.
+    """
+    fatores = []
+    vistos = set()
+    for coluna in COLUNAS_FATORES_CPTED:
+        for item in separar_fatores(dados_achatados.get(coluna) or ""):
+            chave = normalizar_fator(item)
+            if not chave or (coluna, chave) in vistos:
+                continue
+            vistos.add((coluna, chave))
+            fatores.append((coluna, chave, item))
+    return fatores
+
+def validar_analise_cpted(dados: Any) -> "AnaliseCptedDoLocal":
+    """
+    Retorna `dados` como AnaliseCptedDoLocal: objetos já validados são
+    devolvidos como estão; dicionários são validados (pydantic.ValidationError).
+    """
+    from src.info_extraction.schemas import AnaliseCptedDoLocal
+    if isinstance(dados, AnaliseCptedDoLocal):
+        return dados
+    return AnaliseCptedDoLocal(**dados)
+
+def achatar_analise_cpted(analise: "AnaliseCptedDoLocal") -> Dict[str, Any]:
     """
     Converte um objeto de análise CPTED em um dicionário achatado,
     pronto para ser adicionado a um DataFrame.
     """
-    separador_lista = "; "
+    separador_lista = SEPARADOR_LISTA
     dados_achatados = {
         'titulo_analise': analise.titulo_analise,
         'indice_cpted_geral': analise.indice_cpted_geral.value,
@@ -30,4 +121,47 @@ def achatar_analise_cpted(analise: AnaliseCptedDoLocal) -> Dict[str, Any]:
         'suporte_atividades_justificativa': analise.suporte_de_atividades_e_uso_do_espaco.justificativa,
         'recomendacoes': separador_lista.join(analise.recomendacoes_cpted)
     }
-    return dados_achatados
\ No newline at end of file
+    return dados_achatados
+
+
+def desachatar_analise_cpted(dados_achatados: Dict[str, Any]) -> "AnaliseCptedDoLocal":
+    """
+    Operação inversa de `achatar_analise_cpted`: reconstrói o objeto de
+    análise a partir de uma linha achatada (ex: uma linha dos relatórios CSV).
+    Lança pydantic.ValidationError se a linha não formar uma análise válida.
+    """
+    from src.info_extraction.schemas import AnaliseCptedDoLocal
+
+    def lista(coluna: str) -> List[str]:
+        return separar_fatores(dados_achatados.get(coluna) or "")
+
+    return AnaliseCptedDoLocal(
+        titulo_analise=dados_achatados.get('titulo_analise'),
+        indice_cpted_geral=dados_achatados.get('indice_cpted_geral'),
+        resumo_executivo=dados_achatados.get('resumo_executivo'),
+        vigilancia={
+            'nivel_vigilancia_natural': dados_achatados.get('vigilancia_nivel_natural'),
+            'iluminacao': dados_achatados.get('vigilancia_iluminacao'),
+            'pontos_cegos_obstrucoes': lista('vigilancia_pontos_cegos'),
+            'presenca_vigilancia_formal': lista('vigilancia_formal'),
+            'justificativa': dados_achatados.get('vigilancia_justificativa'),
+        },
+        controle_de_acesso_e_territorialidade={
+            'clareza_das_fronteiras': dados_achatados.get('controle_acesso_clareza_fronteiras'),
+            'barreiras_fisicas': lista('controle_acesso_barreiras_fisicas'),
+            'barreiras_simbolicas': lista('controle_acesso_barreiras_simbolicas'),
+            'justificativa': dados_achatados.get('controle_acesso_justificativa'),
+        },
+        manutencao_e_zeladoria={
+            'percepcao_geral_de_cuidado': dados_achatados.get('manutencao_percepcao_cuidado'),
+            'sinais_de_desordem_fisica': lista('manutencao_sinais_desordem'),
+            'justificativa': dados_achatados.get('manutencao_justificativa'),
+        },
+        suporte_de_atividades_e_uso_do_espaco={
+            'presenca_de_atividades_legitimas': dados_achatados.get('suporte_atividades_legitimas'),
+            'tipo_de_uso_do_espaco': lista('suporte_atividades_tipo_uso'),
+            'influencia_de_areas_adjacentes': lista('suporte_atividades_areas_adjacentes'),
+            'justificativa': dados_achatados.get('suporte_atividades_justificativa'),
+        },
+        recomendacoes_cpted=lista('recomendacoes'),
+    )
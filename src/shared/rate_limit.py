@@ -0,0 +1,271 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict, Optional
+
+from src import config
+from src.shared import metrics
+
+# Limites de uso das APIs de modelos, compartilhados pelas threads do processo.
+# Cada provedor tem dois token buckets (requisições e tokens por minuto) e um
+# semáforo de chamadas simultâneas. Quem passa do limite espera na fila em vez
+# de receber um 429 do provedor.
+
+_EM_ANDAMENTO = metrics.gauge("cpted_upstream_in_flight", "Chamadas em andamento a cada provedor.")
+_ESPERA = metrics.histogram(
+    "cpted_upstream_queue_wait_seconds",
+    "Tempo de espera na fila do limitador antes de chamar o provedor, em segundos.",
+)
+_ESGOTADAS = metrics.counter(
+    "cpted_upstream_rate_limited_total",
+    "Chamadas que desistiram porque a espera no limitador passaria do prazo.",
+)
+_TOKENS = metrics.counter(
+    "cpted_upstream_tokens_total",
+    "Tokens usados nas chamadas a cada provedor, segundo o uso informado na resposta.",
+)
+
+
+class RateLimitTimeoutError(Exception):
+    """A vaga no limitador não sairia dentro do prazo da chamada."""
+
+
+class TokenBucket:
+    """
+    Token bucket com reserva: `reserve` debita a quantidade na hora (o saldo
+    pode ficar negativo) e diz quanto tempo esperar até ela estar coberta.
+    Assim as chamadas são atendidas na ordem em que chegaram.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate_per_s = per_minute / 60.0
+        self._saldo = self.capacity
+        self._atualizado_em = time.monotonic()
+        self._pausado_ate = 0.0
+        self._lock = threading.Lock()
+
+    def _reabastecer(self, agora: float) -> None:
+        self._saldo = min(self.capacity, self._saldo + (agora - self._atualizado_em) * self.rate_per_s)
+        self._atualizado_em = agora
+
+    def reserve(self, quantidade: float) -> float:
+        """Reserva `quantidade` e retorna a espera (em segundos) até ela estar disponível."""
+        quantidade = min(quantidade, self.capacity)
+        with self._lock:
+            agora = time.monotonic()
+            self._reabastecer(agora)
+            self._saldo -= quantidade
+            espera = -self._saldo / self.rate_per_s if self._saldo < 0 else 0.0
+            return max(espera, self._pausado_ate - agora)
+
+    def adjust(self, quantidade: float) -> None:
+        """Devolve (positivo) ou debita (negativo) tokens, ex: após saber o uso real."""
+        with self._lock:
+            self._reabastecer(time.monotonic())
+            self._saldo = min(self.capacity, self._saldo + quantidade)
+
+    def pause(self, segundos: float) -> None:
+        """Segura novas reservas por `segundos` (ex: após um 429 com Retry-After)."""
+        with self._lock:
+            self._pausado_ate = max(self._pausado_ate, time.monotonic() + segundos)
+
+
+class VagasSimultaneas:
+    """
+    Limite de chamadas simultâneas compartilhado por threads e event loops.
+
+    Quem não encontra vaga entra numa fila única (FIFO); ao liberar uma vaga,
+    ela é entregue diretamente ao primeiro da fila, que é acordado por um
+    `threading.Event` (threads) ou pelo seu event loop (corrotinas).
+    """
+
+    def __init__(self, maximo: int):
+        self._livres = maximo
+        self._fila: deque = deque()
+        self._lock = threading.Lock()
+
+    def _entrar_na_fila(self, acordar) -> Optional[dict]:
+        """(Função auxiliar) Pega uma vaga livre (retorna None) ou entra na fila."""
+        with self._lock:
+            if self._livres > 0 and not self._fila:
+                self._livres -= 1
+                return None
+            espera = {"acordar": acordar, "concedida": False}
+            self._fila.append(espera)
+            return espera
+
+    def _sair_da_fila(self, espera: dict) -> bool:
+        """(Função auxiliar) Desiste da espera; retorna True se a vaga já tinha sido entregue."""
+        with self._lock:
+            if espera["concedida"]:
+                return True
+            self._fila.remove(espera)
+            return False
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Espera uma vaga (bloqueando a thread). Retorna False se o `timeout` acabar."""
+        evento = threading.Event()
+        espera = self._entrar_na_fila(evento.set)
+        if espera is None:
+            return True
+        evento.wait(timeout)
+        return self._sair_da_fila(espera)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        """Espera uma vaga sem bloquear o event loop. Retorna False se o `timeout` acabar."""
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+
+        def acordar():
+            loop.call_soon_threadsafe(lambda: futuro.done() or futuro.set_result(None))
+
+        espera = self._entrar_na_fila(acordar)
+        if espera is None:
+            return True
+        try:
+            await asyncio.wait_for(futuro, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._sair_da_fila(espera)
+        except BaseException:
+            if self._sair_da_fila(espera):
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """Devolve uma vaga, entregando-a ao primeiro da fila se houver alguém esperando."""
+        with self._lock:
+            while self._fila:
+                espera = self._fila.popleft()
+                try:
+                    espera["acordar"]()
+                except RuntimeError:
+                    # O event loop de quem esperava já foi fechado
+                    continue
+                espera["concedida"] = True
+                return
+            self._livres += 1
+
+
+class _Vaga:
+    """Vaga obtida no limitador; permite corrigir a estimativa de tokens com o uso real."""
+
+    def __init__(self, limiter: "UpstreamLimiter", tokens_estimados: float):
+        self._limiter = limiter
+        self._tokens_estimados = tokens_estimados
+
+    def record_usage(self, tokens: Optional[int]) -> None:
+        if tokens is None:
+            return
+        _TOKENS.inc(tokens, upstream=self._limiter.name)
+        if self._limiter.tpm is None:
+            return
+        self._limiter.tpm.adjust(self._tokens_estimados - tokens)
+        self._tokens_estimados = tokens
+
+
+class UpstreamLimiter:
+    """Limites de um provedor: RPM, TPM e chamadas simultâneas (0 = sem limite)."""
+
+    def __init__(self, name: str, rpm: float, tpm: float, max_in_flight: int):
+        self.name = name
+        self.rpm = TokenBucket(rpm) if rpm > 0 else None
+        self.tpm = TokenBucket(tpm) if tpm > 0 else None
+        self._semaforo = VagasSimultaneas(max_in_flight) if max_in_flight > 0 else None
+        _EM_ANDAMENTO.set(0, upstream=name)
+
+    def pause(self, segundos: float) -> None:
+        """Segura as próximas chamadas ao provedor por `segundos`."""
+        for bucket in (self.rpm, self.tpm):
+            if bucket is not None:
+                bucket.pause(segundos)
+
+    def _reservar(self, tokens_estimados: float, timeout_s: Optional[float]):
+        """
+        (Função auxiliar) Reserva a vez nos buckets. Retorna a espera e as
+        reservas feitas (para devolvê-las se a chamada desistir).
+        """
+        reservas = []
+        espera = 0.0
+        for bucket, quantidade in ((self.rpm, 1), (self.tpm, tokens_estimados)):
+            if bucket is not None and quantidade > 0:
+                espera = max(espera, bucket.reserve(quantidade))
+                reservas.append((bucket, quantidade))
+        if timeout_s is not None and espera > timeout_s:
+            self._desistir(reservas, f"a próxima vaga sai em {espera:.1f}s, depois do prazo de {timeout_s:.1f}s")
+        return espera, reservas
+
+    def _desistir(self, reservas: list, motivo: str):
+        """(Função auxiliar) Devolve as reservas e lança RateLimitTimeoutError."""
+        for bucket, quantidade in reservas:
+            bucket.adjust(quantidade)
+        _ESGOTADAS.inc(upstream=self.name)
+        raise RateLimitTimeoutError(f"Limite de '{self.name}': {motivo}.")
+
+    @contextmanager
+    def _ocupar(self, inicio: float, tokens_estimados: float):
+        _ESPERA.observe(time.monotonic() - inicio, upstream=self.name)
+        _EM_ANDAMENTO.inc(upstream=self.name)
+        try:
+            yield _Vaga(self, tokens_estimados)
+        finally:
+            _EM_ANDAMENTO.dec(upstream=self.name)
+            if self._semaforo is not None:
+                self._semaforo.release()
+
+    @contextmanager
+    def slot(self, tokens_estimados: float = 0, timeout_s: Optional[float] = None):
+        """
+        Espera a vez de chamar o provedor e mantém a vaga durante o bloco `with`.
+
+        Raises:
+            RateLimitTimeoutError: se a espera passaria de `timeout_s`.
+        """
+        inicio = time.monotonic()
+        espera, reservas = self._reservar(tokens_estimados, timeout_s)
+        if espera > 0:
+            time.sleep(espera)
+        if self._semaforo is not None:
+            restante = None if timeout_s is None else max(0.0, timeout_s - (time.monotonic() - inicio))
+            if not self._semaforo.acquire(timeout=restante):
+                self._desistir(reservas, "chamadas simultâneas no máximo até o fim do prazo")
+        with self._ocupar(inicio, tokens_estimados) as vaga:
+            yield vaga
+
+    @asynccontextmanager
+    async def slot_async(self, tokens_estimados: float = 0, timeout_s: Optional[float] = None):
+        """
+        Versão de `slot` para o event loop: espera sem bloquear as outras
+        corrotinas. Os limites são os mesmos das threads.
+        """
+        inicio = time.monotonic()
+        espera, reservas = self._reservar(tokens_estimados, timeout_s)
+        if espera > 0:
+            await asyncio.sleep(espera)
+        if self._semaforo is not None:
+            restante = None if timeout_s is None else max(0.0, timeout_s - (time.monotonic() - inicio))
+            if not await self._semaforo.acquire_async(timeout=restante):
+                self._desistir(reservas, "chamadas simultâneas no máximo até o fim do prazo")
+        with self._ocupar(inicio, tokens_estimados) as vaga:
+            yield vaga
+
+
+_LIMITES = {
+    "kluster": lambda: (config.KUSTER_RPM, config.KUSTER_TPM, config.KUSTER_MAX_IN_FLIGHT),
+    "genai": lambda: (config.GOOGLE_RPM, config.GOOGLE_TPM, config.GOOGLE_MAX_IN_FLIGHT),
+}
+_limiters: Dict[str, UpstreamLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(upstream: str) -> UpstreamLimiter:
+    """Retorna o limitador (compartilhado pelo processo) do provedor."""
+    with _limiters_lock:
+        limiter = _limiters.get(upstream)
+        if limiter is None:
+            rpm, tpm, max_in_flight = _LIMITES[upstream]() if upstream in _LIMITES else (0, 0, 0)
+            limiter = _limiters[upstream] = UpstreamLimiter(upstream, rpm, tpm, max_in_flight)
+        return limiter
@@ -0,0 +1,394 @@
+import time
+import random
+import asyncio
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import httpx
+
+from src import config
+from src.shared import metrics
+from src.shared.rate_limit import RateLimitTimeoutError, get_limiter
+
+# Política de chamadas às APIs de modelos (Kluster e Google GenAI):
+# - prazo total por chamada, dividido entre as tentativas;
+# - novas tentativas com backoff exponencial e jitter, só para erros transitórios;
+# - circuit breaker por provedor, que falha na hora enquanto o provedor está fora
+#   do ar, em vez de prender threads esperando timeouts;
+# - limites de RPM/TPM e de chamadas simultâneas (src.shared.rate_limit).
+
+T = TypeVar("T")
+
+# Códigos HTTP que indicam falha transitória do provedor
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_VALOR_ESTADO = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_ESTADO_CIRCUITO = metrics.gauge(
+    "cpted_upstream_circuit_state",
+    "Estado do circuit breaker de cada provedor (0 fechado, 1 meio-aberto, 2 aberto).",
+)
+_CIRCUITO_ABERTO = metrics.counter("cpted_upstream_circuit_opened_total", "Vezes que o circuito de cada provedor abriu.")
+_REJEITADAS = metrics.counter(
+    "cpted_upstream_rejected_total",
+    "Chamadas recusadas sem contatar o provedor porque o circuito estava aberto.",
+)
+_TENTATIVAS = metrics.counter("cpted_upstream_attempts_total", "Tentativas de chamada a cada provedor, por resultado.")
+_RETENTATIVAS = metrics.counter("cpted_upstream_retries_total", "Novas tentativas após um erro transitório.")
+
+
+class CircuitOpenError(Exception):
+    """O circuito do provedor está aberto; a chamada nem foi feita."""
+
+
+class DeadlineExceededError(Exception):
+    """O prazo total da chamada terminou antes de uma resposta válida."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de um provedor.
+
+    Fechado: as chamadas passam. Após `failure_threshold` falhas transitórias
+    seguidas ele abre e recusa chamadas por `reset_timeout_s`. Depois disso
+    fica meio-aberto: uma única chamada de teste passa; se der certo o
+    circuito fecha, se falhar ele abre de novo.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout_s: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout_s = reset_timeout_s
+        self._falhas = 0
+        self._aberto_em: Optional[float] = None
+        # Número da chamada de teste em andamento no meio-aberto (0 = nenhuma)
+        self._sonda = 0
+        self._ultima_sonda = 0
+        self._lock = threading.Lock()
+        _ESTADO_CIRCUITO.set(_VALOR_ESTADO[CLOSED], upstream=name)
+
+    def _estado(self) -> str:
+        if self._aberto_em is None:
+            return CLOSED
+        if time.monotonic() - self._aberto_em >= self.reset_timeout_s:
+            return HALF_OPEN
+        return OPEN
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._estado()
+
+    def retry_after_s(self) -> float:
+        """Segundos até o circuito aceitar uma chamada de teste (0 se já aceita)."""
+        with self._lock:
+            if self._aberto_em is None:
+                return 0.0
+            return max(0.0, self.reset_timeout_s - (time.monotonic() - self._aberto_em))
+
+    def allow(self) -> Optional[int]:
+        """
+        Indica se uma chamada pode ser feita agora. Retorna None se não pode;
+        senão, 0 para uma chamada comum ou o número da chamada de teste, que
+        fica reservada para quem a recebeu (ver `release`).
+        """
+        with self._lock:
+            estado = self._estado()
+            if estado == CLOSED:
+                return 0
+            if estado == HALF_OPEN and not self._sonda:
+                self._ultima_sonda += 1
+                self._sonda = self._ultima_sonda
+                _ESTADO_CIRCUITO.set(_VALOR_ESTADO[HALF_OPEN], upstream=self.name)
+                return self._sonda
+            return None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._falhas = 0
+            self._aberto_em = None
+            self._sonda = 0
+            _ESTADO_CIRCUITO.set(_VALOR_ESTADO[CLOSED], upstream=self.name)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._falhas += 1
+            if self._sonda or self._falhas >= self.failure_threshold:
+                if self._aberto_em is None or self._sonda:
+                    _CIRCUITO_ABERTO.inc(upstream=self.name)
+                    print(f"Aviso: circuito de '{self.name}' aberto após {self._falhas} falhas seguidas.")
+                self._aberto_em = time.monotonic()
+                self._sonda = 0
+                _ESTADO_CIRCUITO.set(_VALOR_ESTADO[OPEN], upstream=self.name)
+
+    def release(self, sonda: int) -> None:
+        """
+        Libera a chamada de teste sem mudar o estado (ex: erro não transitório).
+        `sonda` é o retorno de `allow`: chamadas comuns (0) ou testes que já
+        não são o atual não mexem no teste em andamento.
+        """
+        with self._lock:
+            if sonda and sonda == self._sonda:
+                self._sonda = 0
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    """Retorna o circuit breaker (compartilhado pelo processo) do provedor."""
+    with _breakers_lock:
+        breaker = _breakers.get(upstream)
+        if breaker is None:
+            breaker = _breakers[upstream] = CircuitBreaker(
+                upstream, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_TIMEOUT_S
+            )
+        return breaker
+
+
+def open_circuits() -> List[str]:
+    """Provedores cujo circuito está aberto (recusando chamadas) neste processo."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [b.name for b in breakers if b.state == OPEN]
+
+
+def is_retryable(erro: Exception) -> bool:
+    """
+    Indica se o erro é transitório (timeout, falha de conexão, 429 ou 5xx).
+    Funciona com as exceções do SDK da OpenAI, do Google GenAI e do httpx.
+    """
+    if isinstance(erro, (httpx.TimeoutException, httpx.TransportError, TimeoutError, ConnectionError)):
+        return True
+    # openai.APIStatusError usa `status_code`; google.genai.errors.APIError usa `code`
+    status = getattr(erro, "status_code", None) or getattr(erro, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    # openai.APIConnectionError / APITimeoutError não têm código HTTP
+    return any(cls.__name__ in ("APIConnectionError", "APITimeoutError") for cls in type(erro).__mro__)
+
+
+def _retry_after(erro: Exception) -> Optional[float]:
+    """(Função auxiliar) Lê o cabeçalho Retry-After da resposta de erro, se houver."""
+    resposta = getattr(erro, "response", None)
+    headers = getattr(resposta, "headers", None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_s(tentativa: int, base_s: float, max_s: float) -> float:
+    """Espera antes da tentativa seguinte: backoff exponencial com jitter total."""
+    return random.uniform(0, min(max_s, base_s * (2 ** tentativa)))
+
+
+def _iniciar_tentativa(upstream: str, breaker: CircuitBreaker, limite: float,
+                       deadline_s: float) -> Tuple[float, int]:
+    """
+    (Função auxiliar) Consulta o circuito e o prazo antes de uma tentativa.
+    Retorna o tempo restante do prazo e a chamada de teste reservada (ver
+    CircuitBreaker.allow).
+    """
+    sonda = breaker.allow()
+    if sonda is None:
+        _REJEITADAS.inc(upstream=upstream)
+        raise CircuitOpenError(
+            f"Circuito de '{upstream}' aberto; nova tentativa em {breaker.retry_after_s():.0f}s."
+        )
+    restante = limite - time.monotonic()
+    if restante <= 0:
+        breaker.release(sonda)
+        raise DeadlineExceededError(f"Prazo de {deadline_s:.0f}s esgotado para '{upstream}'.")
+    return restante, sonda
+
+
+def _espera_apos_erro(upstream: str, erro: Exception, breaker: CircuitBreaker, sonda: int, limiter,
+                      tentativa: int, max_retries: int, limite: float) -> Optional[float]:
+    """
+    (Função auxiliar) Registra a falha de uma tentativa e decide se vale tentar
+    de novo. Retorna a espera antes da próxima tentativa, ou None para desistir.
+    """
+    if isinstance(erro, RateLimitTimeoutError):
+        breaker.release(sonda)
+        _TENTATIVAS.inc(upstream=upstream, outcome="rate_limited")
+        return None
+    if not is_retryable(erro):
+        # Erro da requisição (ex: 400), não do provedor: não conta para o circuito
+        breaker.release(sonda)
+        _TENTATIVAS.inc(upstream=upstream, outcome="error")
+        return None
+    breaker.record_failure()
+    _TENTATIVAS.inc(upstream=upstream, outcome="retryable_error")
+    espera = _retry_after(erro)
+    if espera is not None and (getattr(erro, "status_code", None) or getattr(erro, "code", None)) == 429:
+        # O provedor pediu para esperar: segura as outras chamadas também
+        limiter.pause(espera)
+    if espera is None:
+        espera = backoff_s(tentativa, config.RETRY_BACKOFF_BASE_S, config.RETRY_BACKOFF_MAX_S)
+    if tentativa >= max_retries or time.monotonic() + espera >= limite:
+        return None
+    _RETENTATIVAS.inc(upstream=upstream)
+    print(f"Aviso: erro transitório em '{upstream}' ({erro}); "
+          f"tentativa {tentativa + 2} de {max_retries + 1} em {espera:.1f}s.")
+    return espera
+
+
+def _registrar_sucesso(upstream: str, breaker: CircuitBreaker) -> None:
+    breaker.record_success()
+    _TENTATIVAS.inc(upstream=upstream, outcome="ok")
+
+
+def call_with_resilience(
+    upstream: str,
+    func: Callable[[float], T],
+    timeout_s: float,
+    deadline_s: float,
+    max_retries: int,
+    estimated_tokens: float = 0,
+    usage: Optional[Callable[[T], Optional[int]]] = None,
+) -> T:
+    """
+    Executa `func(timeout_da_tentativa)` com prazo, novas tentativas, circuit
+    breaker e os limites de uso do provedor.
+
+    Args:
+        upstream: Nome do provedor (ex: "kluster", "genai"); define o circuito e os labels.
+        func: Faz a chamada remota usando o timeout (em segundos) recebido.
+        timeout_s: Timeout máximo de uma tentativa.
+        deadline_s: Prazo total, somando tentativas e esperas.
+        max_retries: Novas tentativas após erros transitórios.
+        estimated_tokens: Tokens reservados no limite de TPM antes de cada tentativa.
+        usage: Extrai do retorno os tokens realmente usados, para corrigir a reserva.
+
+    Returns:
+        O retorno de `func`.
+
+    Raises:
+        CircuitOpenError: se o circuito do provedor estiver aberto.
+        DeadlineExceededError: se o prazo acabar antes de uma tentativa bem-sucedida.
+        RateLimitTimeoutError: se a vez no limitador não sair dentro do prazo.
+        Exception: o erro de `func`, se não for transitório ou se as tentativas acabarem.
+    """
+    breaker = get_breaker(upstream)
+    limiter = get_limiter(upstream)
+    limite = time.monotonic() + deadline_s
+    tentativa = 0
+    while True:
+        restante, sonda = _iniciar_tentativa(upstream, breaker, limite, deadline_s)
+        try:
+            # Espera a vez no limitador; o tempo na fila sai do prazo da chamada
+            with limiter.slot(estimated_tokens, timeout_s=restante) as vaga:
+                resultado = func(min(timeout_s, max(0.001, limite - time.monotonic())))
+                if usage is not None:
+                    vaga.record_usage(usage(resultado))
+        except Exception as e:
+            espera = _espera_apos_erro(upstream, e, breaker, sonda, limiter, tentativa, max_retries, limite)
+            if espera is None:
+                raise
+            tentativa += 1
+            time.sleep(espera)
+            continue
+        except BaseException:
+            # Cancelada (ex: asyncio.CancelledError) ou interrompida no meio da
+            # tentativa: devolve a chamada de teste do circuito, se era dela
+            breaker.release(sonda)
+            raise
+
+        _registrar_sucesso(upstream, breaker)
+        return resultado
+
+
+@contextmanager
+def stream_with_resilience(
+    upstream: str,
+    func: Callable[[float], T],
+    timeout_s: float,
+    deadline_s: float,
+    max_retries: int,
+    estimated_tokens: float = 0,
+) -> Iterator[T]:
+    """
+    Versão de `call_with_resilience` para chamadas que abrem um stream: só a
+    abertura (`func(timeout)`) passa pelas novas tentativas e pelo circuito.
+    A vaga no limitador do provedor fica ocupada até o fim do bloco `with`,
+    ou seja, até o stream ser consumido ou abandonado.
+
+    Uso:
+        with stream_with_resilience("kluster", abrir, ...) as stream:
+            for trecho in stream: ...
+    """
+    breaker = get_breaker(upstream)
+    limiter = get_limiter(upstream)
+    limite = time.monotonic() + deadline_s
+    tentativa = 0
+    while True:
+        restante, sonda = _iniciar_tentativa(upstream, breaker, limite, deadline_s)
+        vaga = ExitStack()
+        try:
+            vaga.enter_context(limiter.slot(estimated_tokens, timeout_s=restante))
+            stream = func(min(timeout_s, max(0.001, limite - time.monotonic())))
+        except Exception as e:
+            vaga.close()
+            espera = _espera_apos_erro(upstream, e, breaker, sonda, limiter, tentativa, max_retries, limite)
+            if espera is None:
+                raise
+            tentativa += 1
+            time.sleep(espera)
+            continue
+        except BaseException:
+            vaga.close()
+            breaker.release(sonda)
+            raise
+        break
+
+    _registrar_sucesso(upstream, breaker)
+    with vaga:
+        yield stream
+
+
+async def call_with_resilience_async(
+    upstream: str,
+    func: Callable[[float], Awaitable[T]],
+    timeout_s: float,
+    deadline_s: float,
+    max_retries: int,
+    estimated_tokens: float = 0,
+    usage: Optional[Callable[[T], Optional[int]]] = None,
+) -> T:
+    """
+    Versão de `call_with_resilience` para o event loop: `func(timeout)` é uma
+    corrotina e as esperas usam `asyncio.sleep`. Circuitos e limites são os
+    mesmos compartilhados com as chamadas síncronas do processo.
+    """
+    breaker = get_breaker(upstream)
+    limiter = get_limiter(upstream)
+    limite = time.monotonic() + deadline_s
+    tentativa = 0
+    while True:
+        restante, sonda = _iniciar_tentativa(upstream, breaker, limite, deadline_s)
+        try:
+            async with limiter.slot_async(estimated_tokens, timeout_s=restante) as vaga:
+                resultado = await func(min(timeout_s, max(0.001, limite - time.monotonic())))
+                if usage is not None:
+                    vaga.record_usage(usage(resultado))
+        except Exception as e:
+            espera = _espera_apos_erro(upstream, e, breaker, sonda, limiter, tentativa, max_retries, limite)
+            if espera is None:
+                raise
+            tentativa += 1
+            await asyncio.sleep(espera)
+            continue
+        except BaseException:
+            # Cancelada (ex: asyncio.CancelledError) ou interrompida no meio da
+            # tentativa: devolve a chamada de teste do circuito, se era dela
+            breaker.release(sonda)
+            raise
+
+        _registrar_sucesso(upstream, breaker)
+        return resultado
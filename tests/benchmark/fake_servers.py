@@ -0,0 +1,261 @@
+import io
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Servidor local que imita os dois provedores usados pelo pipeline, para
+# medir desempenho sem pagar por chamadas reais:
+# - POST .../chat/completions           -> API compatível com OpenAI (Kluster)
+# - POST .../models/<modelo>:generateContent -> API do Google GenAI
+# - GET /images/<nome>.jpg               -> foto sintética (requer Pillow), para
+#   os modos que baixam a imagem (pré-processamento e pipeline "fused")
+# A latência e a taxa de erro de cada provedor são configuráveis.
+
+INDICES = ["Alto / Forte", "Moderado", "Baixo / Fraco"]
+ILUMINACOES = ["Boa e uniforme", "Moderada com pontos de sombra", "Fraca / Mal Iluminada"]
+PERCEPCOES = ["Bem-Cuidado / Zelado", "Sinais de Negligência", "Abandonado / Degradado"]
+
+DESCRICAO_FALSA = (
+    "The image shows a residential street during the day. Natural surveillance is moderate: "
+    "a few windows face the sidewalk, but tall walls and a parked truck create blind spots. "
+    "Lighting poles are present but sparse. Boundaries between public and private space are "
+    "marked by walls and gates. There is some graffiti and accumulated trash near the corner. "
+    "Pedestrians and small shops indicate legitimate daytime activity."
+)
+
+
+def analise_falsa(semente: str) -> dict:
+    """Gera uma análise válida (formato AnaliseCptedDoLocal), variando com a semente."""
+    n = int(hashlib.sha256(semente.encode("utf-8")).hexdigest(), 16)
+    return {
+        "titulo_analise": f"Análise CPTED de rua residencial #{n % 10000}",
+        "indice_cpted_geral": INDICES[n % 3],
+        "resumo_executivo": "Local com vigilância natural moderada, sinais de desordem e boa atividade diurna.",
+        "vigilancia": {
+            "nivel_vigilancia_natural": INDICES[(n // 3) % 3],
+            "iluminacao": ILUMINACOES[(n // 9) % 3],
+            "pontos_cegos_obstrucoes": ["Muros altos", "Veículos estacionados"],
+            "presenca_vigilancia_formal": [],
+            "justificativa": "Poucas janelas voltadas para a rua e obstruções visuais.",
+        },
+        "controle_de_acesso_e_territorialidade": {
+            "clareza_das_fronteiras": "Moderado",
+            "barreiras_fisicas": ["Muros", "Portões"],
+            "barreiras_simbolicas": ["Mudança de pavimento"],
+            "justificativa": "Fronteiras marcadas por muros e portões.",
+        },
+        "manutencao_e_zeladoria": {
+            "percepcao_geral_de_cuidado": PERCEPCOES[(n // 27) % 3],
+            "sinais_de_desordem_fisica": ["Pichações", "Lixo acumulado"][: 1 + n % 2],
+            "justificativa": "Pichações e lixo na esquina.",
+        },
+        "suporte_de_atividades_e_uso_do_espaco": {
+            "presenca_de_atividades_legitimas": "Moderado",
+            "tipo_de_uso_do_espaco": ["Residencial", "Comercial"],
+            "influencia_de_areas_adjacentes": ["Pequenos comércios"],
+            "justificativa": "Pedestres e comércio indicam uso legítimo.",
+        },
+        "recomendacoes_cpted": ["Melhorar a iluminação", "Remover pichações", "Podar a vegetação"][: 2 + n % 2],
+    }
+
+
+class ConfiguracaoFalsa:
+    """Latência (ms) e taxa de erro (0 a 1) de cada provedor falso."""
+
+    def __init__(self, vision_latency_ms=800.0, vision_jitter_ms=200.0, vision_error_rate=0.0,
+                 genai_latency_ms=400.0, genai_jitter_ms=100.0, genai_error_rate=0.0,
+                 vision_batch_miss_rate=0.0):
+        self.vision_latency_ms = vision_latency_ms
+        self.vision_jitter_ms = vision_jitter_ms
+        self.vision_error_rate = vision_error_rate
+        # Chance de omitir a resposta de uma imagem em uma requisição com várias imagens
+        self.vision_batch_miss_rate = vision_batch_miss_rate
+        self.genai_latency_ms = genai_latency_ms
+        self.genai_jitter_ms = genai_jitter_ms
+        self.genai_error_rate = genai_error_rate
+        self.contagem = {"vision": 0, "genai": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def contar(self, chave: str) -> None:
+        with self._lock:
+            self.contagem[chave] += 1
+
+
+_IMAGENS: dict = {}
+
+
+def imagem_falsa(nome: str) -> bytes:
+    """JPEG sintético de 1600x1200, sempre o mesmo para o mesmo nome."""
+    if nome not in _IMAGENS:
+        from PIL import Image
+        n = int(hashlib.sha256(nome.encode("utf-8")).hexdigest(), 16)
+        imagem = Image.effect_noise((1600, 1200), 20 + n % 60).convert("RGB")
+        saida = io.BytesIO()
+        imagem.save(saida, format="JPEG", quality=90)
+        _IMAGENS[nome] = saida.getvalue()
+    return _IMAGENS[nome]
+
+
+def _criar_handler(cfg: ConfiguracaoFalsa):
+    class FakeModelHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, status: int, corpo: dict) -> None:
+            dados = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+
+        def _responder_stream(self, modelo: str) -> None:
+            """Resposta com stream=True: a descrição em pedaços, como eventos SSE."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            id_resposta = f"chatcmpl-fake-{random.getrandbits(32)}"
+            palavras = DESCRICAO_FALSA.split(" ")
+            for i, palavra in enumerate(palavras):
+                fim = i == len(palavras) - 1
+                chunk = {
+                    "id": id_resposta, "object": "chat.completion.chunk", "created": int(time.time()), "model": modelo,
+                    "choices": [{"index": 0, "delta": {"content": palavra if fim else palavra + " "},
+                                 "finish_reason": "stop" if fim else None}],
+                }
+                self._escrever_pedaco(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self._escrever_pedaco(b"data: [DONE]\n\n")
+            self._escrever_pedaco(b"")
+
+        def _escrever_pedaco(self, dados: bytes) -> None:
+            self.wfile.write(f"{len(dados):x}\r\n".encode("ascii") + dados + b"\r\n")
+            self.wfile.flush()
+
+        def _esperar(self, latencia_ms: float, jitter_ms: float) -> None:
+            time.sleep(max(0.0, random.gauss(latencia_ms, jitter_ms)) / 1000)
+
+        def _falhar(self, taxa: float) -> bool:
+            if random.random() < taxa:
+                cfg.contar("errors")
+                self._responder(503, {"error": {"code": 503, "message": "Falha simulada", "status": "UNAVAILABLE"}})
+                return True
+            return False
+
+        def do_GET(self):
+            if self.path.startswith("/images/"):
+                dados = imagem_falsa(self.path.split("?")[0])
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(dados)))
+                self.end_headers()
+                self.wfile.write(dados)
+                return
+            self._responder(404, {"error": {"message": f"Rota desconhecida: {self.path}"}})
+
+        def do_POST(self):
+            tamanho = int(self.headers.get("Content-Length") or 0)
+            corpo = json.loads(self.rfile.read(tamanho) or b"{}")
+
+            if self.path.rstrip("/").endswith("/chat/completions"):
+                cfg.contar("vision")
+                self._esperar(cfg.vision_latency_ms, cfg.vision_jitter_ms)
+                if self._falhar(cfg.vision_error_rate):
+                    return
+                if corpo.get("stream"):
+                    self._responder_stream(corpo.get("model", "fake"))
+                    return
+                conteudo = corpo.get("messages", [{}])[-1].get("content") or []
+                n_imagens = sum(1 for parte in conteudo if isinstance(parte, dict) and parte.get("type") == "image_url")
+                texto = DESCRICAO_FALSA
+                if n_imagens > 1:
+                    # Várias imagens: uma seção '### IMAGE k' por imagem
+                    texto = "\n\n".join(
+                        f"### IMAGE {k}\n{DESCRICAO_FALSA}" for k in range(1, n_imagens + 1)
+                        if random.random() >= cfg.vision_batch_miss_rate
+                    )
+                self._responder(200, {
+                    "id": f"chatcmpl-fake-{random.getrandbits(32)}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": corpo.get("model", "fake"),
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": texto},
+                    }],
+                    "usage": {"prompt_tokens": 900, "completion_tokens": 250, "total_tokens": 1150},
+                })
+                return
+
+            if ":generateContent" in self.path:
+                cfg.contar("genai")
+                self._esperar(cfg.genai_latency_ms, cfg.genai_jitter_ms)
+                if self._falhar(cfg.genai_error_rate):
+                    return
+                semente = json.dumps(corpo.get("contents"), sort_keys=True)
+                # Pedidos com a imagem (modo "fused") pagam os tokens dela na entrada
+                tokens_entrada = 1200 + (1032 if '"inlineData"' in semente or '"inline_data"' in semente else 0)
+                self._responder(200, {
+                    "candidates": [{
+                        "content": {"role": "model", "parts": [{"text": json.dumps(analise_falsa(semente), ensure_ascii=False)}]},
+                        "finishReason": "STOP",
+                        "index": 0,
+                    }],
+                    "usageMetadata": {"promptTokenCount": tokens_entrada, "candidatesTokenCount": 400,
+                                      "totalTokenCount": tokens_entrada + 400},
+                })
+                return
+
+            self._responder(404, {"error": {"message": f"Rota desconhecida: {self.path}"}})
+
+    return FakeModelHandler
+
+
+class _ServidorFalso(ThreadingHTTPServer):
+    # A fila padrão de conexões (5) recusaria conexões nos testes de carga
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def iniciar_servidor_falso(cfg: ConfiguracaoFalsa, host: str = "127.0.0.1", porta: int = 0) -> ThreadingHTTPServer:
+    """
+    Inicia o servidor falso em uma thread em background e o retorna.
+    Com porta 0 o sistema escolhe uma porta livre (ver `servidor.server_port`).
+    """
+    servidor = _ServidorFalso((host, porta), _criar_handler(cfg))
+    threading.Thread(target=servidor.serve_forever, name="fake-model-server", daemon=True).start()
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que imita as APIs da Kluster (OpenAI) e do Google GenAI.")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--vision-latency-ms", type=float, default=800)
+    parser.add_argument("--vision-error-rate", type=float, default=0.0)
+    parser.add_argument("--genai-latency-ms", type=float, default=400)
+    parser.add_argument("--genai-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    cfg = ConfiguracaoFalsa(
+        vision_latency_ms=args.vision_latency_ms, vision_error_rate=args.vision_error_rate,
+        genai_latency_ms=args.genai_latency_ms, genai_error_rate=args.genai_error_rate,
+    )
+    servidor = _ServidorFalso(("127.0.0.1", args.port), _criar_handler(cfg))
+    print(f"Servidor falso em http://127.0.0.1:{args.port}")
+    print(f"  KUSTER_BASE_URL=http://127.0.0.1:{args.port}/v1")
+    print(f"  GOOGLE_BASE_URL=http://127.0.0.1:{args.port}/")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
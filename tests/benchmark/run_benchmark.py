@@ -0,0 +1,324 @@
+import os
+import sys
+RAIZ = os.path.abspath(os.path.join(__file__, "../../../"))
+sys.path.append(RAIZ)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import io
+import json
+import math
+import time
+import argparse
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg2
+
+from fake_servers import ConfiguracaoFalsa, iniciar_servidor_falso
+
+# Benchmark offline: roda o pipeline, as rotas Flask e o database_manager
+# contra um servidor falso dos modelos (tests/benchmark/fake_servers.py) e um
+# banco PostgreSQL descartável, e reporta vazão e latências p50/p95/p99.
+#
+# Uso:
+#   python tests/benchmark/run_benchmark.py --requests 50 --concurrency 8 \
+#       --output tests/benchmark/resultado.json [--baseline tests/benchmark/baseline.json]
+#
+# O banco descartável é criado (e apagado ao final) no servidor configurado
+# pelas variáveis DB_* do .env; o usuário precisa de permissão CREATEDB.
+
+ESQUEMA_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+
+
+def percentil(valores: List[float], p: float) -> Optional[float]:
+    """Percentil pelo método nearest-rank (valores em qualquer ordem)."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def medir(nome: str, operacao: Callable[[Any], bool], entradas: List[Any], concorrencia: int) -> Dict[str, Any]:
+    """
+    Executa `operacao` para cada entrada com até `concorrencia` chamadas
+    simultâneas. A operação retorna True (sucesso) ou False/exceção (erro).
+    """
+    def cronometrar(entrada):
+        inicio = time.perf_counter()
+        try:
+            ok = bool(operacao(entrada))
+        except Exception:
+            ok = False
+        return time.perf_counter() - inicio, ok
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        resultados = list(executor.map(cronometrar, entradas))
+    duracao = time.perf_counter() - inicio
+
+    latencias_ms = [lat * 1000 for lat, _ in resultados]
+    erros = sum(1 for _, ok in resultados if not ok)
+    return {
+        "name": nome,
+        "requests": len(resultados),
+        "errors": erros,
+        "error_rate": round(erros / len(resultados), 4) if resultados else 0.0,
+        "duration_s": round(duracao, 3),
+        "throughput_per_s": round(len(resultados) / duracao, 2) if duracao > 0 else None,
+        "p50_ms": _arredondar(percentil(latencias_ms, 50)),
+        "p95_ms": _arredondar(percentil(latencias_ms, 95)),
+        "p99_ms": _arredondar(percentil(latencias_ms, 99)),
+    }
+
+
+def _arredondar(valor: Optional[float]) -> Optional[float]:
+    return round(valor, 2) if valor is not None else None
+
+
+# ==============================================================================
+# BANCO DESCARTÁVEL
+# ==============================================================================
+
+def _conectar(dbname: str):
+    return psycopg2.connect(
+        dbname=dbname,
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+
+
+def criar_banco_descartavel() -> str:
+    """Cria um banco novo no servidor configurado, aplica o esquema base e o retorna."""
+    nome = f"cpted_benchmark_{os.getpid()}_{int(time.time())}"
+    conn = _conectar(os.getenv("DB_NAME") or "postgres")
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'CREATE DATABASE "{nome}";')
+    conn.close()
+
+    conn = _conectar(nome)
+    with conn.cursor() as cur, open(ESQUEMA_BASE, encoding="utf-8") as arquivo:
+        cur.execute(arquivo.read())
+    conn.commit()
+    conn.close()
+    return nome
+
+
+def apagar_banco(nome: str, banco_original: str) -> None:
+    conn = _conectar(banco_original or "postgres")
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{nome}" WITH (FORCE);')
+    conn.close()
+
+
+# ==============================================================================
+# CENÁRIOS
+# ==============================================================================
+
+def executar_cenarios(n: int, concorrencia: int) -> List[Dict[str, Any]]:
+    # Importados aqui: dependem das variáveis de ambiente ajustadas em main()
+    import database_manager as db
+    from pipeline import run_full_pipeline
+    from src.jobs.worker import process_job
+    from src.shared.db_pool import close_shared_pool
+    from api.index import app
+
+    if not db.init_db_schema():
+        raise RuntimeError("Não foi possível aplicar o esquema auxiliar no banco de benchmark.")
+    user_app_id = db.add_user_app("Benchmark", f"benchmark-{time.time()}@example.com", str(time.time_ns())[-11:], "x")
+
+    client = app.test_client()
+    rodada = int(time.time())
+    resultados = []
+
+    def url(tipo: str, i: int) -> str:
+        return f"https://benchmark.local/{rodada}/{tipo}/{i}.jpg"
+
+    def coordenadas(i: int):
+        # Pontos espalhados em ~2 km ao redor do centro de São Paulo
+        return -23.55 + (i % 50) * 0.0004, -46.63 + (i // 50) * 0.0004
+
+    # --- Pipeline (modelos falsos) ---
+    resultados.append(medir("pipeline.run_full_pipeline",
+                            lambda i: run_full_pipeline(url("pipeline", i)) is not None,
+                            list(range(n)), concorrencia))
+
+    # --- database_manager ---
+    capturas: Dict[int, int] = {}
+
+    def inserir_captura(i):
+        lat, lon = coordenadas(i)
+        capturas[i] = db.add_capture(user_app_id, url("db", i), datetime.now(), lat, lon)
+        return capturas[i] is not None
+
+    resultados.append(medir("db.add_capture", inserir_captura, list(range(n)), concorrencia))
+
+    from fake_servers import analise_falsa
+    resultados.append(medir("db.add_pipeline_output",
+                            lambda i: db.add_pipeline_output(capturas[i], analise_falsa(str(i))) is not None,
+                            [i for i in range(n) if capturas.get(i)], concorrencia))
+    resultados.append(medir("db.get_full_analysis_by_url",
+                            lambda i: db.get_full_analysis_by_url(url("db", i)) is not None,
+                            list(range(n)), concorrencia))
+    resultados.append(medir("db.get_pipeline_output_by_capture_id",
+                            lambda i: db.get_pipeline_output_by_capture_id(capturas[i]) is not None,
+                            [i for i in range(n) if capturas.get(i)], concorrencia))
+
+    # --- Rotas Flask ---
+    jobs: Dict[int, int] = {}
+
+    def enviar_foto(i):
+        lat, lon = coordenadas(i)
+        resposta = client.post("/send-photo", json={
+            "user_app_id": user_app_id, "image_url": url("api", i),
+            "timestamp": datetime.now().isoformat(), "lat": lat, "long": lon,
+        })
+        if resposta.status_code == 202:
+            jobs[i] = resposta.get_json()["job_id"]
+        return resposta.status_code == 202
+
+    resultados.append(medir("POST /send-photo", enviar_foto, list(range(n)), concorrencia))
+
+    def processar_job(_):
+        job = db.claim_pipeline_job()
+        return bool(job) and process_job(job)
+
+    resultados.append(medir("worker.process_job", processar_job, list(jobs), concorrencia))
+    resultados.append(medir("GET /jobs/<id>",
+                            lambda i: client.get(f"/jobs/{jobs[i]}", query_string={"user_app_id": user_app_id}).status_code == 200,
+                            list(jobs), concorrencia))
+    resultados.append(medir("GET /get-analysis",
+                            lambda i: client.get("/get-analysis", query_string={"image_url": url("api", i)}).status_code == 200,
+                            list(range(n)), concorrencia))
+    resultados.append(medir("GET /user_photos",
+                            lambda _: client.get("/user_photos", query_string={"user_app_id": user_app_id, "limit": 50}).status_code == 200,
+                            list(range(n)), concorrencia))
+    def features(_):
+        resposta = client.get("/map/features", query_string={"bbox": "-46.7,-23.6,-46.5,-23.5", "zoom": 16})
+        # A resposta é transmitida em partes: consome o corpo inteiro
+        return resposta.status_code == 200 and len(json.loads(resposta.get_data())["features"]) > 0
+
+    resultados.append(medir("GET /map/features", features, list(range(n)), concorrencia))
+    # A primeira chamada monta o HTML; as seguintes medem o cache
+    resultados.append(medir("GET /generate_map",
+                            lambda _: client.get("/generate_map").status_code == 200,
+                            list(range(max(3, n // 10))), 1))
+    resultados.append(medir("GET /metrics",
+                            lambda _: client.get("/metrics").status_code == 200,
+                            list(range(n)), concorrencia))
+
+    close_shared_pool()
+    return resultados
+
+
+# ==============================================================================
+# RELATÓRIO E COMPARAÇÃO COM A LINHA DE BASE
+# ==============================================================================
+
+def imprimir_tabela(resultados: List[Dict[str, Any]]) -> None:
+    print(f"\n{'Endpoint':<38}{'req':>6}{'erros':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for r in resultados:
+        print(f"{r['name']:<38}{r['requests']:>6}{r['errors']:>7}{r['throughput_per_s'] or 0:>9}"
+              f"{r['p50_ms'] or 0:>10}{r['p95_ms'] or 0:>10}{r['p99_ms'] or 0:>10}")
+
+
+def comparar_com_baseline(resultados: List[Dict[str, Any]], baseline: Dict[str, Any], tolerancia: float) -> List[str]:
+    """
+    Compara p95 e taxa de erro com uma execução anterior. Retorna a lista de
+    regressões (p95 mais de `tolerancia` acima da linha de base, ou mais erros).
+    """
+    anteriores = {r["name"]: r for r in baseline.get("results", [])}
+    regressoes = []
+    for r in resultados:
+        anterior = anteriores.get(r["name"])
+        if not anterior or not anterior.get("p95_ms") or r["p95_ms"] is None:
+            continue
+        variacao = (r["p95_ms"] - anterior["p95_ms"]) / anterior["p95_ms"]
+        if variacao > tolerancia:
+            regressoes.append(f"{r['name']}: p95 {anterior['p95_ms']} ms -> {r['p95_ms']} ms ({variacao:+.0%})")
+        if r["error_rate"] > anterior.get("error_rate", 0) + 0.01:
+            regressoes.append(f"{r['name']}: taxa de erro {anterior.get('error_rate', 0):.2%} -> {r['error_rate']:.2%}")
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline, das rotas e do banco.")
+    parser.add_argument("--requests", type=int, default=50, help="Requisições por endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--vision-latency-ms", type=float, default=800)
+    parser.add_argument("--vision-error-rate", type=float, default=0.0)
+    parser.add_argument("--genai-latency-ms", type=float, default=400)
+    parser.add_argument("--genai-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Arquivo JSON onde salvar o resultado")
+    parser.add_argument("--baseline", help="Resultado JSON anterior para comparação")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Aumento máximo aceito do p95 em relação à linha de base (0.2 = 20%%)")
+    parser.add_argument("--keep-db", action="store_true", help="Não apaga o banco descartável ao final")
+    parser.add_argument("--verbose", action="store_true", help="Mostra os prints do pipeline e do banco")
+    args = parser.parse_args()
+
+    cfg = ConfiguracaoFalsa(
+        vision_latency_ms=args.vision_latency_ms, vision_error_rate=args.vision_error_rate,
+        genai_latency_ms=args.genai_latency_ms, genai_error_rate=args.genai_error_rate,
+    )
+    servidor = iniciar_servidor_falso(cfg)
+    base = f"http://127.0.0.1:{servidor.server_port}"
+
+    # Aponta os clientes para o servidor falso e desliga o que mascararia a medição
+    os.environ.update({
+        "KUSTER_API_KEY": "fake", "GOOGLE_API_KEY": "fake",
+        "KUSTER_BASE_URL": f"{base}/v1", "GOOGLE_BASE_URL": f"{base}/",
+        "KUSTER_MAX_RETRIES": "0", "GOOGLE_MAX_RETRIES": "0", "CACHE_BACKEND": "none", "IMAGE_CACHE_KEY_MODE": "url",
+        "NEAR_DUPLICATE_ENABLED": "false", "CIRCUIT_FAILURE_THRESHOLD": "1000000",
+        "JOB_WORKER_MODE": "external",
+        "DB_POOL_MAX_SIZE": str(max(10, args.concurrency + 2)),
+    })
+    # Carrega o .env antes de trocar DB_NAME, para que ele não sobrescreva o banco descartável
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(RAIZ, ".env"))
+    banco_original = os.getenv("DB_NAME")
+    banco = criar_banco_descartavel()
+    os.environ["DB_NAME"] = banco
+    print(f"Banco descartável: {banco} | modelos falsos em {base}")
+
+    try:
+        saida = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with saida:
+            resultados = executar_cenarios(args.requests, args.concurrency)
+    finally:
+        servidor.shutdown()
+        if not args.keep_db:
+            apagar_banco(banco, banco_original)
+
+    imprimir_tabela(resultados)
+    print(f"\nChamadas ao servidor falso: {cfg.contagem}")
+
+    relatorio = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "results": resultados,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as arquivo:
+            json.dump(relatorio, arquivo, indent=2, ensure_ascii=False)
+        print(f"Resultado salvo em '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as arquivo:
+            regressoes = comparar_com_baseline(resultados, json.load(arquivo), args.max_regression)
+        if regressoes:
+            print("\nREGRESSÕES EM RELAÇÃO À LINHA DE BASE:")
+            for linha in regressoes:
+                print(f"  - {linha}")
+            sys.exit(1)
+        print("\nNenhuma regressão em relação à linha de base.")
+
+
+if __name__ == "__main__":
+    main()
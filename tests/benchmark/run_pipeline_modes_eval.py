@@ -0,0 +1,216 @@
+import os
+import sys
+RAIZ = os.path.abspath(os.path.join(__file__, "../../../"))
+sys.path.append(RAIZ)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import io
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from run_benchmark import percentil, _arredondar
+
+# Avaliação dos modos do pipeline: roda a mesma amostra fixa de fotos no modo
+# "two_stage" (descrição do Kluster + extração do GenAI) e no modo "fused"
+# (uma chamada ao GenAI com a imagem) e compara latência, chamadas, tokens,
+# custo estimado e a concordância dos campos do AnaliseCptedDoLocal.
+#
+# Uso (APIs reais, chaves do .env; o cache é desligado para medir as chamadas):
+#   python tests/benchmark/run_pipeline_modes_eval.py \
+#       --samples tests/data/cpted_sample_images.txt \
+#       --kluster-usd-per-mtok 0.30 --genai-usd-per-mtok 0.40 --output avaliacao_modos.json
+#
+# Uso offline (modelos falsos de fake_servers.py e fotos sintéticas; só
+# valida o harness, os números de concordância não dizem nada sobre os modelos):
+#   python tests/benchmark/run_pipeline_modes_eval.py --fake --fake-samples 10
+
+AMOSTRA_PADRAO = os.path.join(RAIZ, "tests", "data", "cpted_sample_images.txt")
+MODOS = ("two_stage", "fused")
+UPSTREAMS = ("kluster", "genai")
+
+# Campos de escolha única (enum) comparados por igualdade
+CAMPOS_ENUM = (
+    'indice_cpted_geral',
+    'vigilancia_nivel_natural',
+    'vigilancia_iluminacao',
+    'controle_acesso_clareza_fronteiras',
+    'manutencao_percepcao_cuidado',
+    'suporte_atividades_legitimas',
+)
+
+
+def ler_amostra(caminho: str) -> List[str]:
+    """Lê as URLs da amostra (uma por linha, ignorando vazias e comentários)."""
+    with open(caminho, encoding="utf-8") as arquivo:
+        return [linha.strip() for linha in arquivo if linha.strip() and not linha.lstrip().startswith("#")]
+
+
+def _contadores() -> Dict[str, float]:
+    """Tokens e chamadas bem-sucedidas acumulados por provedor (métricas do processo)."""
+    from src.shared import metrics
+    tokens = metrics.counter("cpted_upstream_tokens_total", "")
+    tentativas = metrics.counter("cpted_upstream_attempts_total", "")
+    valores = {}
+    for upstream in UPSTREAMS:
+        valores[f"{upstream}_tokens"] = tokens.value(upstream=upstream)
+        valores[f"{upstream}_calls"] = sum(
+            tentativas.value(upstream=upstream, outcome=resultado)
+            for resultado in ("ok", "error", "retryable_error", "rate_limited")
+        )
+    return valores
+
+
+def rodar_modo(modo: str, urls: List[str], concorrencia: int, precos: Dict[str, float]) -> Dict[str, Any]:
+    """Roda o pipeline no `modo` para cada URL e reúne latências, uso e resultados."""
+    from pipeline import run_full_pipeline
+
+    def executar(url):
+        inicio = time.perf_counter()
+        try:
+            resultado = run_full_pipeline(url, mode=modo)
+        except Exception:
+            resultado = None
+        return url, time.perf_counter() - inicio, resultado
+
+    antes = _contadores()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        execucoes = list(executor.map(executar, urls))
+    duracao = time.perf_counter() - inicio
+    depois = _contadores()
+    uso = {chave: depois[chave] - antes[chave] for chave in depois}
+
+    latencias_ms = [segundos * 1000 for _, segundos, resultado in execucoes if resultado]
+    sucessos = len(latencias_ms)
+    custo = None
+    if any(precos.values()):
+        custo = sum(uso[f"{u}_tokens"] / 1e6 * precos[u] for u in UPSTREAMS)
+    return {
+        "mode": modo,
+        "samples": len(urls),
+        "succeeded": sucessos,
+        "duration_s": round(duracao, 3),
+        "p50_ms": _arredondar(percentil(latencias_ms, 50)),
+        "p95_ms": _arredondar(percentil(latencias_ms, 95)),
+        "calls_per_image": {u: round(uso[f"{u}_calls"] / len(urls), 2) for u in UPSTREAMS} if urls else None,
+        "tokens_per_image": {u: round(uso[f"{u}_tokens"] / len(urls), 1) for u in UPSTREAMS} if urls else None,
+        "cost_usd_per_image": round(custo / len(urls), 6) if custo is not None and urls else None,
+        "results": {url: resultado for url, _, resultado in execucoes},
+    }
+
+
+def _jaccard(a: set, b: set) -> float:
+    return 1.0 if not a and not b else len(a & b) / len(a | b)
+
+
+def concordancia(resultados_a: Dict[str, Optional[dict]], resultados_b: Dict[str, Optional[dict]]) -> Dict[str, Any]:
+    """
+    Concordância entre os dois modos nas fotos em que ambos tiveram sucesso:
+    fração de igualdade nos campos enum e Jaccard médio (itens normalizados
+    com `normalizar_fator`) nos campos de lista.
+    """
+    from src.shared.parsing import (
+        achatar_analise_cpted, validar_analise_cpted, separar_fatores, normalizar_fator, COLUNAS_FATORES_CPTED
+    )
+
+    pares = []
+    for url, a in resultados_a.items():
+        b = resultados_b.get(url)
+        if a and b:
+            pares.append((achatar_analise_cpted(validar_analise_cpted(a)), achatar_analise_cpted(validar_analise_cpted(b))))
+    if not pares:
+        return {"compared": 0, "fields": {}, "enum_agreement": None, "list_jaccard": None}
+
+    campos = {}
+    for campo in CAMPOS_ENUM:
+        campos[campo] = sum(1.0 for a, b in pares if a[campo] == b[campo]) / len(pares)
+    for campo in COLUNAS_FATORES_CPTED:
+        campos[campo] = sum(
+            _jaccard({normalizar_fator(f) for f in separar_fatores(a[campo])},
+                     {normalizar_fator(f) for f in separar_fatores(b[campo])})
+            for a, b in pares
+        ) / len(pares)
+    return {
+        "compared": len(pares),
+        "fields": {campo: round(valor, 3) for campo, valor in campos.items()},
+        "enum_agreement": round(sum(campos[c] for c in CAMPOS_ENUM) / len(CAMPOS_ENUM), 3),
+        "list_jaccard": round(sum(campos[c] for c in COLUNAS_FATORES_CPTED) / len(COLUNAS_FATORES_CPTED), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara os modos two_stage e fused do pipeline em uma amostra fixa.")
+    parser.add_argument("--samples", default=AMOSTRA_PADRAO, help="Arquivo com as URLs da amostra")
+    parser.add_argument("--concurrency", type=int, default=1, help="Imagens processadas ao mesmo tempo")
+    parser.add_argument("--kluster-usd-per-mtok", type=float, default=0.0, help="Preço do Kluster por milhão de tokens")
+    parser.add_argument("--genai-usd-per-mtok", type=float, default=0.0, help="Preço do GenAI por milhão de tokens")
+    parser.add_argument("--keep-cache", action="store_true", help="Não desliga o cache de resultados dos modelos")
+    parser.add_argument("--fake", action="store_true", help="Usa os modelos falsos e fotos sintéticas")
+    parser.add_argument("--fake-samples", type=int, default=10, help="Fotos sintéticas no modo --fake")
+    parser.add_argument("--output", help="Salva o relatório (com os resultados de cada foto) em JSON")
+    parser.add_argument("--verbose", action="store_true", help="Mostra os prints do pipeline")
+    args = parser.parse_args()
+
+    servidor = None
+    if args.fake:
+        from fake_servers import ConfiguracaoFalsa, iniciar_servidor_falso
+        servidor = iniciar_servidor_falso(ConfiguracaoFalsa())
+        base = f"http://127.0.0.1:{servidor.server_port}"
+        os.environ.update({
+            "KUSTER_API_KEY": "fake", "GOOGLE_API_KEY": "fake",
+            "KUSTER_BASE_URL": f"{base}/v1", "GOOGLE_BASE_URL": f"{base}/",
+        })
+        urls = [f"{base}/images/amostra_{i}.jpg" for i in range(args.fake_samples)]
+    else:
+        urls = ler_amostra(args.samples)
+    # O modo fused baixa as fotos: libera os hosts da amostra (escolhida por quem roda)
+    os.environ["IMAGE_ALLOWED_HOSTS"] = ",".join(sorted({urlsplit(u).hostname for u in urls if urlsplit(u).hostname}))
+    os.environ["IMAGE_ALLOWED_SCHEMES"] = "http,https"
+    if not args.keep_cache:
+        # Com o cache, a segunda rodada de uma foto não chamaria os modelos
+        os.environ["CACHE_BACKEND"] = "none"
+    if not urls:
+        print("Nenhuma URL na amostra.")
+        return
+
+    precos = {"kluster": args.kluster_usd_per_mtok, "genai": args.genai_usd_per_mtok}
+    try:
+        saida = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with saida:
+            relatorios = {modo: rodar_modo(modo, urls, args.concurrency, precos) for modo in MODOS}
+    finally:
+        if servidor is not None:
+            servidor.shutdown()
+    acordo = concordancia(relatorios["two_stage"]["results"], relatorios["fused"]["results"])
+
+    print(f"Amostra: {len(urls)} fotos | concorrência {args.concurrency}\n")
+    print(f"{'modo':<10} {'ok':>5} {'p50 (ms)':>10} {'p95 (ms)':>10} {'chamadas/foto':>22} {'tokens/foto':>26} {'US$/foto':>10}")
+    for modo in MODOS:
+        r = relatorios[modo]
+        chamadas = " + ".join(f"{u} {r['calls_per_image'][u]}" for u in UPSTREAMS)
+        tokens = " + ".join(f"{u} {r['tokens_per_image'][u]:.0f}" for u in UPSTREAMS)
+        custo = "-" if r["cost_usd_per_image"] is None else f"{r['cost_usd_per_image']:.5f}"
+        print(f"{modo:<10} {r['succeeded']:>5} {str(r['p50_ms']):>10} {str(r['p95_ms']):>10} "
+              f"{chamadas:>22} {tokens:>26} {custo:>10}")
+
+    print(f"\nConcordância fused x two_stage ({acordo['compared']} fotos com sucesso nos dois modos):")
+    if acordo["compared"]:
+        print(f"  campos enum (igualdade): {acordo['enum_agreement']:.1%}")
+        print(f"  campos de lista (Jaccard médio): {acordo['list_jaccard']:.1%}")
+        for campo, valor in acordo["fields"].items():
+            print(f"    {campo:<40} {valor:.1%}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as arquivo:
+            json.dump({"samples": urls, "modes": relatorios, "agreement": acordo}, arquivo,
+                      ensure_ascii=False, indent=2, default=str)
+        print(f"\nRelatório salvo em {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import os
+import sys
+RAIZ = os.path.abspath(os.path.join(__file__, "../../../"))
+sys.path.append(RAIZ)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import io
+import time
+import asyncio
+import argparse
+import threading
+import contextlib
+from datetime import datetime
+from typing import Any, Callable, Dict
+
+from fake_servers import ConfiguracaoFalsa, iniciar_servidor_falso
+from run_benchmark import criar_banco_descartavel, apagar_banco
+
+# Teste de carga do worker do pipeline: enfileira N jobs e mede quanto tempo
+# um único processo leva para concluí-los com o worker em threads
+# (`python -m src.jobs.worker`, uma thread por job simultâneo) e com o worker
+# assíncrono (`python -m src.jobs.worker --async`, um event loop).
+# Usa os modelos falsos de fake_servers.py e um banco descartável.
+#
+# Uso:
+#   python tests/benchmark/run_worker_load.py --jobs 400 --threads 8 --async-concurrency 200
+
+
+def _submeter_jobs(db, user_app_id: int, n: int, rotulo: str) -> None:
+    rodada = time.time_ns()
+    for i in range(n):
+        db.submit_capture(user_app_id, f"https://load.local/{rotulo}/{rodada}/{i}.jpg", datetime.now(),
+                          -23.55 + (i % 50) * 0.0004, -46.63 + (i // 50) * 0.0004)
+
+
+def _medir_modo(nome: str, executar: Callable[[], None], n: int) -> Dict[str, Any]:
+    """Roda o worker até esvaziar a fila, amostrando os jobs simultâneos e as threads."""
+    from src.jobs.worker import _JOBS_EM_ANDAMENTO, _JOBS_FINALIZADOS
+
+    concluidos_antes = _JOBS_FINALIZADOS.value(status="done")
+    picos = {"jobs": 0.0, "threads": 0}
+    parar = threading.Event()
+
+    def amostrar():
+        while not parar.wait(0.05):
+            picos["jobs"] = max(picos["jobs"], _JOBS_EM_ANDAMENTO.value())
+            # Não conta as threads do servidor falso, que roda no mesmo processo
+            threads = sum(1 for t in threading.enumerate() if "process_request_thread" not in t.name)
+            picos["threads"] = max(picos["threads"], threads)
+
+    amostrador = threading.Thread(target=amostrar, daemon=True)
+    amostrador.start()
+    inicio = time.perf_counter()
+    executar()
+    duracao = time.perf_counter() - inicio
+    parar.set()
+    amostrador.join()
+
+    concluidos = int(_JOBS_FINALIZADOS.value(status="done") - concluidos_antes)
+    return {
+        "modo": nome, "jobs": n, "concluidos": concluidos, "duracao_s": round(duracao, 2),
+        "jobs_por_s": round(concluidos / duracao, 2) if duracao > 0 else None,
+        "pico_jobs_simultaneos": int(picos["jobs"]), "pico_threads": picos["threads"],
+    }
+
+
+def executar_carga(n: int, threads: int, concorrencia_async: int) -> list:
+    # Importados aqui: dependem das variáveis de ambiente ajustadas em main()
+    import database_manager as db
+    from src.jobs.worker import run_worker, run_async_worker
+    from src.shared.db_pool import close_shared_pool
+
+    if not db.init_db_schema():
+        raise RuntimeError("Não foi possível aplicar o esquema auxiliar no banco de carga.")
+    user_app_id = db.add_user_app("Carga", f"carga-{time.time()}@example.com", str(time.time_ns())[-11:], "x")
+    resultados = []
+
+    _submeter_jobs(db, user_app_id, n, "threads")
+
+    def com_threads():
+        workers = [threading.Thread(target=run_worker, kwargs={"poll_interval": 0.05, "until_empty": True})
+                   for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+
+    resultados.append(_medir_modo(f"threads ({threads})", com_threads, n))
+
+    _submeter_jobs(db, user_app_id, n, "async")
+    resultados.append(_medir_modo(
+        f"async ({concorrencia_async})",
+        lambda: asyncio.run(run_async_worker(concorrencia_async, poll_interval=0.05, until_empty=True)),
+        n,
+    ))
+
+    close_shared_pool()
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do worker do pipeline: threads vs. async.")
+    parser.add_argument("--jobs", type=int, default=400, help="Jobs enfileirados para cada modo")
+    parser.add_argument("--threads", type=int, default=8, help="Threads do worker síncrono")
+    parser.add_argument("--async-concurrency", type=int, default=200, help="Jobs simultâneos do worker async")
+    parser.add_argument("--vision-latency-ms", type=float, default=800)
+    parser.add_argument("--genai-latency-ms", type=float, default=400)
+    parser.add_argument("--keep-db", action="store_true", help="Não apaga o banco descartável ao final")
+    parser.add_argument("--verbose", action="store_true", help="Mostra os prints do pipeline e do banco")
+    args = parser.parse_args()
+
+    cfg = ConfiguracaoFalsa(vision_latency_ms=args.vision_latency_ms, genai_latency_ms=args.genai_latency_ms)
+    servidor = iniciar_servidor_falso(cfg)
+    base = f"http://127.0.0.1:{servidor.server_port}"
+
+    simultaneos = str(max(args.threads, args.async_concurrency))
+    os.environ.update({
+        "KUSTER_API_KEY": "fake", "GOOGLE_API_KEY": "fake",
+        "KUSTER_BASE_URL": f"{base}/v1", "GOOGLE_BASE_URL": f"{base}/",
+        "KUSTER_MAX_RETRIES": "0", "GOOGLE_MAX_RETRIES": "0", "CACHE_BACKEND": "none", "IMAGE_CACHE_KEY_MODE": "url",
+        "NEAR_DUPLICATE_ENABLED": "false", "CIRCUIT_FAILURE_THRESHOLD": "1000000",
+        "JOB_WORKER_MODE": "external",
+        # Os limites por provedor não devem ser o gargalo medido
+        "KUSTER_MAX_IN_FLIGHT": simultaneos, "GOOGLE_MAX_IN_FLIGHT": simultaneos,
+        "HTTP_MAX_CONNECTIONS": simultaneos, "HTTP_MAX_KEEPALIVE_CONNECTIONS": simultaneos,
+        "DB_POOL_MAX_SIZE": str(args.threads + 40),
+    })
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(RAIZ, ".env"))
+    banco_original = os.getenv("DB_NAME")
+    banco = criar_banco_descartavel()
+    os.environ["DB_NAME"] = banco
+    print(f"Banco descartável: {banco} | modelos falsos em {base}")
+
+    try:
+        saida = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with saida:
+            resultados = executar_carga(args.jobs, args.threads, args.async_concurrency)
+    finally:
+        servidor.shutdown()
+        if not args.keep_db:
+            apagar_banco(banco, banco_original)
+
+    print(f"\n{'modo':<16} {'jobs':>6} {'ok':>6} {'duração (s)':>12} {'jobs/s':>8} {'pico jobs':>10} {'pico threads':>13}")
+    for r in resultados:
+        print(f"{r['modo']:<16} {r['jobs']:>6} {r['concluidos']:>6} {r['duracao_s']:>12} "
+              f"{r['jobs_por_s']:>8} {r['pico_jobs_simultaneos']:>10} {r['pico_threads']:>13}")
+    print(f"\nChamadas ao servidor falso: {cfg.contagem}")
+
+
+if __name__ == "__main__":
+    main()
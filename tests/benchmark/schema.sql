@@ -0,0 +1,53 @@
+-- Tabelas base usadas pela API e pelo pipeline, para criar um banco
+-- descartável de benchmark. As tabelas auxiliares (jobs, fatores, resumo
+-- do dashboard...) são criadas depois por database_manager.init_db_schema().
+CREATE TABLE IF NOT EXISTS user_app (
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    email TEXT UNIQUE,
+    cpf TEXT UNIQUE,
+    password TEXT
+);
+
+CREATE TABLE IF NOT EXISTS user_platform (
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    email TEXT UNIQUE,
+    cpf TEXT UNIQUE,
+    password TEXT
+);
+
+CREATE TABLE IF NOT EXISTS capture (
+    id SERIAL PRIMARY KEY,
+    user_app_id INTEGER REFERENCES user_app(id),
+    url TEXT UNIQUE NOT NULL,
+    date TIMESTAMP,
+    lat DOUBLE PRECISION,
+    long DOUBLE PRECISION
+);
+
+CREATE TABLE IF NOT EXISTS pipeline_output (
+    id SERIAL PRIMARY KEY,
+    capture_id INTEGER UNIQUE REFERENCES capture(id),
+    titulo_analise TEXT,
+    indice_cpted_geral TEXT,
+    resumo_executivo TEXT,
+    vigilancia_nivel_natural TEXT,
+    vigilancia_iluminacao TEXT,
+    vigilancia_pontos_cegos TEXT,
+    vigilancia_formal TEXT,
+    vigilancia_justificativa TEXT,
+    controle_acesso_clareza_fronteiras TEXT,
+    controle_acesso_barreiras_fisicas TEXT,
+    controle_acesso_barreiras_simbolicas TEXT,
+    controle_acesso_justificativa TEXT,
+    manutencao_percepcao_cuidado TEXT,
+    manutencao_sinais_desordem TEXT,
+    manutencao_justificativa TEXT,
+    suporte_atividades_legitimas TEXT,
+    suporte_atividades_tipo_uso TEXT,
+    suporte_atividades_areas_adjacentes TEXT,
+    suporte_atividades_justificativa TEXT,
+    recomendacoes TEXT,
+    data_processamento TIMESTAMP DEFAULT now()
+);
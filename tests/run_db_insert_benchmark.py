@@ -0,0 +1,111 @@
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(__file__, "../../")))
+
+import csv
+import time
+import statistics
+from datetime import datetime
+
+import database_manager as db
+from src.info_extraction.schemas import AnaliseCptedDoLocal
+from src.shared.parsing import achatar_analise_cpted, desachatar_analise_cpted
+
+# Quantidade de inserções/leituras medidas em cada modo
+N_OPERACOES = 500
+RELATORIO_EXEMPLO = "tests/data/reports/relatorio_cpted_extraido1.csv"
+PREFIXO_URL = "benchmark://db-insert"
+
+
+def inserir_sem_preparar(capture_id, dados):
+    """Caminho antigo: valida o dicionário e remonta o INSERT a cada chamada."""
+    dados = AnaliseCptedDoLocal(**dados)
+    dados_achatados = achatar_analise_cpted(dados)
+    colunas = ", ".join(dados_achatados.keys())
+    placeholders = ", ".join(["%s"] * len(dados_achatados))
+    sql = f"INSERT INTO pipeline_output (capture_id, {colunas}) VALUES (%s, {placeholders}) RETURNING id;"
+    with db.db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, [int(capture_id)] + list(dados_achatados.values()))
+            output_id = cur.fetchone()[0]
+            db._gravar_fatores(cur, output_id, dados_achatados)
+            conn.commit()
+            return output_id
+
+
+def ler_sem_preparar(capture_id):
+    """Leitura antiga de get_pipeline_output_by_capture_id, sem PREPARE."""
+    with db.db_connection() as conn:
+        with conn.cursor(cursor_factory=db.psycopg2.extras.DictCursor) as cur:
+            cur.execute("SELECT * FROM pipeline_output WHERE capture_id = %s;", (capture_id,))
+            return dict(cur.fetchone())
+
+
+def medir(nome, funcao, argumentos):
+    """Executa `funcao` para cada argumento e imprime as latências (ms)."""
+    latencias = []
+    for args in argumentos:
+        inicio = time.perf_counter()
+        funcao(*args)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+    latencias.sort()
+    p95 = latencias[int(len(latencias) * 0.95) - 1]
+    print(f"{nome:<42} média {statistics.mean(latencias):7.3f} ms | "
+          f"p50 {statistics.median(latencias):7.3f} ms | p95 {p95:7.3f} ms")
+    return statistics.mean(latencias)
+
+
+def limpar():
+    with db.db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM pipeline_output WHERE capture_id IN (SELECT id FROM capture WHERE url LIKE %s);",
+                (PREFIXO_URL + "%",),
+            )
+            cur.execute("DELETE FROM capture WHERE url LIKE %s;", (PREFIXO_URL + "%",))
+            conn.commit()
+
+
+def main():
+    """
+    Micro-benchmark do caminho de escrita/leitura de pipeline_output:
+    INSERT remontado e revalidado a cada chamada vs. SQL montado na
+    importação + PREPARE no servidor (e objeto já validado).
+    Usa o banco configurado no .env e apaga as linhas criadas ao final.
+    """
+    with open(RELATORIO_EXEMPLO, newline="", encoding="utf-8-sig") as arquivo:
+        analise = desachatar_analise_cpted(next(csv.DictReader(arquivo)))
+    dados = analise.model_dump()
+
+    usuario = db.get_all_users()
+    if not usuario:
+        print("Benchmark abortado: é preciso ao menos um usuário em user_app.")
+        return
+    user_app_id = usuario[0]["id"]
+
+    limpar()
+    rodada = int(time.time())
+    capturas = db.add_captures_bulk([
+        {"user_app_id": user_app_id, "url": f"{PREFIXO_URL}/{rodada}/{i}", "date": datetime.now()}
+        for i in range(3 * N_OPERACOES)
+    ])
+    ids = [c["capture_id"] for c in capturas]
+    antes, depois, depois_obj = ids[:N_OPERACOES], ids[N_OPERACOES:2 * N_OPERACOES], ids[2 * N_OPERACOES:]
+
+    try:
+        print(f"--- INSERÇÃO ({N_OPERACOES} linhas por modo) ---")
+        t_antes = medir("antes (SQL remontado, sem PREPARE)", inserir_sem_preparar, [(i, dados) for i in antes])
+        t_depois = medir("depois (SQL fixo + PREPARE, dict)", db.add_pipeline_output, [(i, dados) for i in depois])
+        t_obj = medir("depois (SQL fixo + PREPARE, objeto)", db.add_pipeline_output, [(i, analise) for i in depois_obj])
+        print(f"Ganho por inserção: {t_antes - t_depois:.3f} ms (dict), {t_antes - t_obj:.3f} ms (objeto)")
+
+        print(f"\n--- LEITURA POR capture_id ({N_OPERACOES} leituras por modo) ---")
+        l_antes = medir("antes (sem PREPARE)", ler_sem_preparar, [(i,) for i in antes])
+        l_depois = medir("depois (PREPARE)", db.get_pipeline_output_by_capture_id, [(i,) for i in antes])
+        print(f"Ganho por leitura: {l_antes - l_depois:.3f} ms")
+    finally:
+        limpar()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+RAIZ = os.path.abspath(os.path.join(__file__, "../../"))
+
+# Tempo máximo (mediana) para importar api.index em um interpretador novo,
+# que é o custo pago em cada cold start da função serverless (vercel.json).
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "500"))
+# Bibliotecas pesadas que só devem ser carregadas pelas rotas que as usam
+MODULOS_PROIBIDOS = ("pandas", "folium", "openai", "google.genai", "pydantic", "PIL")
+
+# Executado no subprocesso: mede a importação e lista os módulos carregados
+_SCRIPT_FILHO = """
+import sys, time, json
+inicio = time.perf_counter()
+import api.index
+duracao_ms = (time.perf_counter() - inicio) * 1000
+print(json.dumps({"ms": duracao_ms, "modules": sorted(sys.modules)}))
+"""
+
+
+def medir_importacao() -> dict:
+    """Importa api.index em um interpretador novo e retorna o tempo e os módulos."""
+    resultado = subprocess.run(
+        [sys.executable, "-c", _SCRIPT_FILHO],
+        cwd=RAIZ, capture_output=True, text=True, check=True,
+    )
+    return json.loads(resultado.stdout.strip().splitlines()[-1])
+
+
+def importacoes_mais_lentas(top_n: int = 10) -> list:
+    """Usa `python -X importtime` para listar os módulos mais caros (tempo cumulativo)."""
+    resultado = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.index"],
+        cwd=RAIZ, capture_output=True, text=True,
+    )
+    linhas = []
+    for linha in resultado.stderr.splitlines():
+        partes = linha.split("|")
+        if len(partes) != 3 or not partes[1].strip().isdigit():
+            continue
+        linhas.append((int(partes[1]) / 1000, partes[2].strip()))
+    return sorted(linhas, reverse=True)[:top_n]
+
+
+def main():
+    """
+    Falha (código de saída 1) se importar api.index passar do orçamento de
+    tempo ou carregar alguma das bibliotecas pesadas de MODULOS_PROIBIDOS.
+    """
+    parser = argparse.ArgumentParser(description="Orçamento de tempo de importação da API.")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5, help="Importações medidas (usa a mediana)")
+    args = parser.parse_args()
+
+    medicoes = [medir_importacao() for _ in range(args.runs)]
+    mediana = statistics.median(m["ms"] for m in medicoes)
+    carregados = set(medicoes[-1]["modules"])
+    proibidos = [m for m in MODULOS_PROIBIDOS if m in carregados]
+
+    print(f"Importação de api.index: mediana {mediana:.0f} ms em {args.runs} execuções "
+          f"(orçamento: {args.budget_ms:.0f} ms)")
+    print("\nMódulos mais caros (cumulativo):")
+    for ms, modulo in importacoes_mais_lentas():
+        print(f"  {ms:8.1f} ms  {modulo}")
+
+    falhou = False
+    if proibidos:
+        print(f"\nFALHA: bibliotecas pesadas carregadas na importação: {', '.join(proibidos)}")
+        falhou = True
+    if mediana > args.budget_ms:
+        print(f"\nFALHA: importação acima do orçamento ({mediana:.0f} ms > {args.budget_ms:.0f} ms)")
+        falhou = True
+    if falhou:
+        sys.exit(1)
+    print("\nOK: dentro do orçamento.")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,14 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(__file__, "../../")))
 
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from src.shared.clients import get_genai_client
 from src.info_extraction.agent import extrair_dados_cpted
 from src.shared.parsing import achatar_analise_cpted
 
+# Número máximo de descrições enviadas à API ao mesmo tempo
+MAX_CONCORRENCIA = 4
+
 def main():
     """
     Script principal para extrair dados CPTED de uma lista de descrições
@@ -45,12 +49,13 @@ In conclusion, while the image shows a generally well-maintained and active stre
     
     lista_de_resultados_achatados = []
 
-    print(f"Iniciando processamento de {len(descricoes_de_locais)} descrições...")
-    for i, descricao in enumerate(descricoes_de_locais, 1):
-        print(f"\nProcessando Descrição #{i}...")
-        
-        analise_obj = extrair_dados_cpted(descricao, client)
-        
+    # As chamadas à API são independentes: processa várias descrições em paralelo,
+    # mantendo a ordem original nos resultados.
+    print(f"Iniciando processamento de {len(descricoes_de_locais)} descrições (até {MAX_CONCORRENCIA} em paralelo)...")
+    with ThreadPoolExecutor(max_workers=MAX_CONCORRENCIA) as executor:
+        analises = list(executor.map(lambda descricao: extrair_dados_cpted(descricao, client), descricoes_de_locais))
+
+    for i, analise_obj in enumerate(analises, 1):
         if analise_obj:
             dados_para_linha = achatar_analise_cpted(analise_obj)
             lista_de_resultados_achatados.append(dados_para_linha)